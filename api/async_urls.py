@@ -0,0 +1,31 @@
+from . import async_views
+from .urls import urlpatterns as sync_urlpatterns
+
+# The same routes as api/urls.py, with every view that has an async
+# implementation swapped for it. Token refresh, batch and metrics stay sync.
+ASYNC_VIEWS = {
+    'authenticate_user': async_views.authenticate_user,
+    'user': async_views.user_profile,
+    'follow_user': async_views.follow_user,
+    'unfollow_user': async_views.unfollow_user,
+    'user_relationships': async_views.user_relationships,
+    'create_post': async_views.create_post,
+    'delete_post': async_views.delete_post,
+    'post_comments': async_views.post_comments,
+    'like_post': async_views.like_post,
+    'unlike_post': async_views.unlike_post,
+    'add_comment': async_views.add_comment,
+    'all_posts': async_views.all_posts,
+    'home_feed': async_views.home_feed,
+    'notifications': async_views.notifications_list,
+}
+
+
+def _swap(pattern):
+    view = ASYNC_VIEWS.get(pattern.name)
+    if view is None:
+        return pattern
+    return type(pattern)(pattern.pattern, view, pattern.default_args, pattern.name)
+
+
+urlpatterns = [_swap(pattern) for pattern in sync_urlpatterns]
@@ -0,0 +1,269 @@
+import asyncio
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponseNotAllowed
+
+from .models import User, Post, Comment, Notification
+from .serializers import prefetch_posts, serialize_post, serialize_comment, serialize_feed_post, serialize_relationship, serialize_notification
+from .pagination import InvalidPage, akeyset_paginate
+from .auth import jwt_required, issue_tokens
+from .renderers import JsonResponse
+from .views import BEARER_ERRORS, _login_busy, _post_detail
+from . import cache, feed, login, notifications, relations, sharding, suggestions, tasks, throttling
+
+# Async implementations of the API views, served by the ASGI application (see
+# reunion/asgi_urls.py). Reads use the async ORM; the transactional toggles in
+# relations.py run in a worker thread through sync_to_async.
+
+
+def api_view(methods):
+    # Async counterpart of @csrf_exempt + @require_http_methods, whose Django 4.2
+    # versions only wrap sync views
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+async def _exists(queryset):
+    return await queryset.aexists()
+
+
+@api_view(['POST'])
+async def authenticate_user(request):
+    # The password hash runs on api/login.py's pool, so the event loop stays free
+    data = json.loads(request.body)
+    username = data.get('username')
+    password = data.get('password')
+    if username is None or password is None:
+        return JsonResponse({'error': 'Please provide both username and password'}, status=400)
+    try:
+        user = await login.aauthenticate(username, password)
+    except login.LoginBusy:
+        return _login_busy()
+    if user is None:
+        return JsonResponse({'error': 'Invalid email or password'}, status=401)
+    return JsonResponse(issue_tokens(user))
+
+
+@api_view(['GET'])
+@jwt_required(load_user=False)
+async def user_profile(request):
+    user = await User.objects.filter(id=request.api_user_id).afirst()
+    if user is None:
+        return JsonResponse({'error': 'User does not exist'}, status=404)
+    return JsonResponse({
+        'username': user.username,
+        'followers_count': user.followers_count,
+        'following_count': user.following_count
+    })
+
+
+@api_view(['POST'])
+@throttling.throttle('follow')
+@jwt_required(load_user=False)
+async def follow_user(request, id):
+    following = await sync_to_async(relations.follow)(request.api_user_id, id)
+    if following is None:
+        if await User.objects.filter(id__in=[id, request.api_user_id]).acount() < len({id, request.api_user_id}):
+            return JsonResponse({'error': 'User does not exist'}, status=404)
+        return JsonResponse({'error': 'Already following this user'}, status=400)
+
+    await sync_to_async(tasks.enqueue)('backfill', request.api_user_id, [following.id])
+    suggestions.follow(request.api_user_id, [following.id])
+    await sync_to_async(tasks.enqueue)('notify', Notification.FOLLOW, following.id, request.api_user_id, 0)
+    return JsonResponse({'success': f'You are now following {following.username}!'})
+
+
+@api_view(['POST'])
+@throttling.throttle('follow')
+@jwt_required(load_user=False)
+async def unfollow_user(request, id):
+    unfollowing = await sync_to_async(relations.unfollow)(request.api_user_id, id)
+    if unfollowing is None:
+        if not await _exists(User.objects.filter(id=id)):
+            return JsonResponse({'error': 'User does not exist'}, status=404)
+        return JsonResponse({'error': 'You are not following this user'}, status=400)
+
+    await sync_to_async(feed.remove_author)(request.api_user_id, unfollowing.id)
+    suggestions.unfollow(request.api_user_id, unfollowing.id)
+    return JsonResponse({'success': f'You have unfollowed {unfollowing.username}!'})
+
+
+@api_view(['POST'])
+@jwt_required(load_user=False)
+async def user_relationships(request):
+    try:
+        ids = relations.parse_ids(json.loads(request.body), settings.RELATIONSHIPS_MAX_IDS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e) if isinstance(e, relations.RelationshipsError) else 'Invalid JSON'}, status=400)
+
+    users = {user.id: user async for user in relations.relationships(request.api_user_id, ids)}
+    return JsonResponse({
+        'relationships': [serialize_relationship(users[id]) for id in ids if id in users],
+        'not_found': [id for id in ids if id not in users],
+    })
+
+
+@api_view(['POST'])
+@jwt_required()
+async def create_post(request):
+    data = json.loads(request.body)
+    title = data.get('title')
+    content = data.get('description')
+    if title is None or content is None:
+        return JsonResponse({'error': 'Please provide both title and description'}, status=400)
+
+    post = Post(title=title, content=content, author=request.api_user)
+    await sync_to_async(sharding.save_new)(post, sharding.for_user(request.api_user_id))
+    await sync_to_async(tasks.enqueue)('fan_out_post', post.id, key=f'fan_out_post:{post.id}')
+
+    return JsonResponse({
+        'id': post.id,
+        'title': post.title,
+        'created_at': post.created_at.strftime('%Y-%m-%d %H:%M:%S UTC'),
+    })
+
+
+@api_view(['DELETE', 'GET'])
+async def delete_post(request, id):
+    if request.method == 'GET':
+        body, etag = await sync_to_async(cache.get_post_response)(id, lambda: _post_detail(id))
+        return cache.conditional_response(request, body, etag)
+    return await _delete_post(request, id)
+
+
+@jwt_required(load_user=False)
+async def _delete_post(request, id):
+    post = await sharding.using(Post.objects, sharding.for_post(id)).filter(id=id).afirst()
+    if post is None:
+        return JsonResponse({'error': 'Post does not exist'}, status=404)
+    if post.author_id != request.api_user_id:
+        return JsonResponse({'error': 'You are not authorized to delete this post'}, status=403)
+
+    await post.adelete()
+    await sync_to_async(cache.invalidate_post)(id)
+    return JsonResponse({'success': 'Post deleted successfully'})
+
+
+@api_view(['POST'])
+@throttling.throttle('like')
+@jwt_required()
+async def like_post(request, id):
+    # jwt_required() loads the user (from the user cache when warm) first, so
+    # a token for a deleted user writes nothing
+    user = request.api_user
+    post = await sync_to_async(relations.like)(id, user.id)
+    if post is None:
+        if not await _exists(sharding.using(Post.objects, sharding.for_post(id)).filter(id=id)):
+            return JsonResponse({'error': 'Post does not exist'}, status=404)
+        return JsonResponse({'error': 'Already liked this post'}, status=400)
+    await sync_to_async(cache.invalidate_post)(id)
+    await sync_to_async(tasks.enqueue)('trending', id, settings.TRENDING_LIKE_WEIGHT)
+    await sync_to_async(tasks.enqueue)('notify', Notification.LIKE, post.author_id, user.id, id)
+
+    return JsonResponse({
+        'post_id': post.id,
+        'title': post.title,
+        'created_at': post.created_at.strftime('%Y-%m-%d %H:%M:%S %Z'),
+        'message': f'{user.username} liked this post!'
+    })
+
+
+@api_view(['POST'])
+@throttling.throttle('like')
+@jwt_required(status=401, load_user=False)
+async def unlike_post(request, id):
+    if await sync_to_async(relations.unlike)(id, request.api_user_id) is None:
+        if not await _exists(sharding.using(Post.objects, sharding.for_post(id)).filter(id=id)):
+            return JsonResponse({'error': 'Post does not exist'}, status=404)
+        return JsonResponse({'error': 'You have not liked this post yet'}, status=400)
+    await sync_to_async(cache.invalidate_post)(id)
+    await sync_to_async(tasks.enqueue)('trending', id, -settings.TRENDING_LIKE_WEIGHT)
+    return JsonResponse({'success': 'Post unliked successfully'})
+
+
+@api_view(['POST'])
+@jwt_required(status=401)
+async def add_comment(request, id):
+    comment_content = request.POST.get('comment')
+    if not comment_content or comment_content.isspace():
+        return JsonResponse({'error': 'Please provide a comment'}, status=400)
+    author_id = await sharding.using(Post.objects, sharding.for_post(id)).filter(id=id).values_list('author_id', flat=True).afirst()
+    if author_id is None:
+        return JsonResponse({'error': 'Post does not exist'}, status=404)
+
+    comment = await sync_to_async(_save_comment)(id, author_id, request.api_user_id, comment_content)
+    await sync_to_async(cache.invalidate_post)(id)
+    return JsonResponse({'comment_id': comment.id})
+
+
+def _save_comment(post_id, author_id, user_id, content):
+    alias = sharding.for_post(post_id)
+    with transaction.atomic(using=alias):
+        comment = Comment(post_id=post_id, author_id=user_id, content=content)
+        sharding.save_new(comment, alias)
+        sharding.using(Post.objects, alias).filter(id=post_id).update(comments_count=F('comments_count') + 1)
+    tasks.enqueue('index_comments', post_id, content, key=f'comment:{comment.id}')
+    tasks.enqueue('trending', post_id, settings.TRENDING_COMMENT_WEIGHT)
+    tasks.enqueue('notify', Notification.COMMENT, author_id, user_id, post_id)
+    return comment
+
+
+@api_view(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+async def all_posts(request):
+    alias = sharding.for_user(request.api_user_id)
+    posts = prefetch_posts(sharding.using(Post.objects, alias).filter(author_id=request.api_user_id), alias)
+    try:
+        page, next_cursor = await akeyset_paginate(posts, request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'posts': [serialize_post(post) for post in page], 'next_cursor': next_cursor}, status=201)
+
+
+@api_view(['GET'])
+async def post_comments(request, id):
+    alias = sharding.for_post(id)
+    comments = sharding.with_authors(sharding.using(Comment.objects, alias).filter(post_id=id), alias)
+    try:
+        # The existence check and the page read are independent
+        exists, (page, next_cursor) = await asyncio.gather(
+            _exists(sharding.using(Post.objects, alias).filter(id=id)),
+            akeyset_paginate(comments, request, descending=False),
+        )
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not exists:
+        return JsonResponse({'error': 'Post does not exist'}, status=404)
+    return JsonResponse({'comments': [serialize_comment(comment) for comment in page], 'next_cursor': next_cursor})
+
+
+@api_view(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+async def home_feed(request):
+    try:
+        page, next_cursor = await feed.aread_feed(request.api_user_id, request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'posts': [serialize_feed_post(post) for post in page], 'next_cursor': next_cursor})
+
+
+@api_view(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+async def notifications_list(request):
+    try:
+        page, next_cursor = await akeyset_paginate(notifications.stream(request.api_user_id), request, time_field='updated_at')
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'notifications': [serialize_notification(n) for n in page], 'next_cursor': next_cursor})
@@ -0,0 +1,216 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import jwt
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .models import User
+from .renderers import JsonResponse
+
+
+class TokenError(Exception):
+    def __init__(self, reason):
+        # reason is one of 'missing', 'expired' or 'invalid'
+        super().__init__(reason)
+        self.reason = reason
+
+
+class LRUCache:
+    # A small thread-safe LRU whose entries may also carry an expiry timestamp
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= (now or time.time()):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+token_cache = LRUCache(settings.JWT_TOKEN_CACHE_SIZE)
+user_cache = LRUCache(settings.JWT_USER_CACHE_SIZE)
+
+
+def issue_token(user):
+    # Access token, accepted by jwt_required until it expires
+    payload = {'user_id': user.id, 'username': user.username, 'exp': int(time.time()) + settings.JWT_ACCESS_TOKEN_LIFETIME}
+    return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
+
+
+def _password_fingerprint(user):
+    return salted_hmac('api.auth.refresh', user.password, algorithm='sha256').hexdigest()[:16]
+
+
+def issue_refresh_token(user):
+    # Long-lived token that is only accepted by the refresh endpoint. It carries
+    # a fingerprint of the password hash, so changing the password revokes it.
+    payload = {
+        'user_id': user.id,
+        'type': 'refresh',
+        'pwd': _password_fingerprint(user),
+        'exp': int(time.time()) + settings.JWT_REFRESH_TOKEN_LIFETIME,
+    }
+    return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
+
+
+def issue_tokens(user):
+    return {
+        'token': issue_token(user),
+        'refresh': issue_refresh_token(user),
+        'expires_in': settings.JWT_ACCESS_TOKEN_LIFETIME,
+    }
+
+
+def refresh_user(token):
+    # Returns the active user a refresh token was issued to, or raises TokenError
+    try:
+        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise TokenError('expired')
+    except jwt.InvalidTokenError:
+        raise TokenError('invalid')
+    user_id = payload.get('user_id')
+    if payload.get('type') != 'refresh' or not isinstance(user_id, int):
+        raise TokenError('invalid')
+    user = User.objects.filter(id=user_id, is_active=True).only('id', 'username', 'password').first()
+    if user is None or not constant_time_compare(payload.get('pwd', ''), _password_fingerprint(user)):
+        raise TokenError('invalid')
+    return user
+
+
+def decode_token(token):
+    # Returns the user id of a verified token. The result of a successful HMAC
+    # verification is remembered until the token's own `exp`, so repeated
+    # requests with the same token skip the signature check.
+    now = time.time()
+    user_id = token_cache.get(token, now)
+    if user_id is not None:
+        return user_id
+    try:
+        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise TokenError('expired')
+    except jwt.InvalidTokenError:
+        raise TokenError('invalid')
+    user_id = payload.get('user_id')
+    if payload.get('type', 'access') != 'access' or not isinstance(user_id, int):
+        raise TokenError('invalid')
+    token_cache.set(token, user_id, payload.get('exp'))
+    return user_id
+
+
+def get_request_user_id(request):
+    header = request.headers.get('Authorization')
+    if not header:
+        raise TokenError('missing')
+    parts = header.split(' ')
+    if len(parts) < 2:
+        raise TokenError('missing')
+    return decode_token(parts[1])
+
+
+def get_user(user_id):
+    # User rows are cached for a few seconds; saving or deleting a user drops
+    # its entry in this process
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.objects.filter(id=user_id).first()
+        if user is None:
+            return None
+        user_cache.set(user_id, user, time.time() + settings.JWT_USER_CACHE_TTL)
+    return copy.copy(user)
+
+
+async def aget_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await User.objects.filter(id=user_id).afirst()
+        if user is None:
+            return None
+        user_cache.set(user_id, user, time.time() + settings.JWT_USER_CACHE_TTL)
+    return copy.copy(user)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    user_cache.pop(instance.id)
+
+
+TOKEN_ERRORS = {
+    'missing': 'Please provide a valid token',
+    'expired': 'Please provide a valid token',
+    'invalid': 'Please provide a valid token',
+}
+
+
+def jwt_required(status=400, errors=None, load_user=True):
+    # Authenticates the request from its bearer token and sets request.api_user_id.
+    # With load_user, request.api_user is also set, or a 404 is returned when the
+    # user no longer exists. Views that only need the id should pass load_user=False.
+    # Works on both sync and async views.
+    errors = {**TOKEN_ERRORS, **(errors or {})}
+
+    def authenticate(request):
+        try:
+            request.api_user_id = get_request_user_id(request)
+        except TokenError as e:
+            return JsonResponse({'error': errors[e.reason]}, status=status)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                error = authenticate(request)
+                if error is not None:
+                    return error
+                if load_user:
+                    request.api_user = await aget_user(request.api_user_id)
+                    if request.api_user is None:
+                        return JsonResponse({'error': 'User does not exist'}, status=404)
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            error = authenticate(request)
+            if error is not None:
+                return error
+            if load_user:
+                request.api_user = get_user(request.api_user_id)
+                if request.api_user is None:
+                    return JsonResponse({'error': 'User does not exist'}, status=404)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,155 @@
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import User, Post, Comment, Notification
+from . import cache, relations, sharding, suggestions, tasks
+
+Follow = User.followers.through
+Like = Post.likes.through
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _count_update(counts, field):
+    # F(field) + CASE id WHEN ... THEN n END, so one UPDATE adjusts many rows
+    return F(field) + Case(
+        *[When(id=id, then=Value(n)) for id, n in counts.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def parse_actions(data, max_actions):
+    actions = data.get('actions') if isinstance(data, dict) else None
+    if not isinstance(actions, list):
+        raise BatchError('Please provide a list of actions')
+    if len(actions) > max_actions:
+        raise BatchError(f'A batch can contain at most {max_actions} actions')
+    # Normalize every action to (kind, id, comment); malformed ones get kind None
+    parsed = []
+    for action in actions:
+        if not isinstance(action, dict) or not isinstance(action.get('id'), int):
+            parsed.append((None, None, None))
+        else:
+            parsed.append((action.get('action'), action['id'], action.get('comment')))
+    return parsed
+
+
+def apply_actions(user_id, actions):
+    # Validate every action with a handful of set-based queries, then apply all
+    # of them with one bulk insert per table and one UPDATE per counter table
+    post_ids = {id for kind, id, _ in actions if kind in ('like', 'comment')}
+    user_ids = {id for kind, id, _ in actions if kind == 'follow'}
+    shards = sharding.group_by_shard(post_ids)
+    existing_posts, liked = {}, set()
+    for alias, ids in shards.items():
+        # Post id -> author id, who is told about the likes and comments
+        existing = dict(sharding.using(Post.objects, alias).filter(id__in=ids).values_list('id', 'author_id'))
+        existing_posts.update(existing)
+        if existing:
+            liked.update(sharding.using(Like.objects, alias).filter(user_id=user_id, post_id__in=existing).values_list('post_id', flat=True))
+    existing_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True)) if user_ids else set()
+    followed = set(Follow.objects.filter(to_user_id=user_id, from_user_id__in=existing_users).values_list('from_user_id', flat=True)) if existing_users else set()
+
+    results = []
+    comments = []
+    for kind, id, content in actions:
+        if kind == 'like':
+            if id not in existing_posts:
+                results.append({'status': 404, 'error': 'Post does not exist'})
+            elif id in liked:
+                results.append({'status': 400, 'error': 'Already liked this post'})
+            else:
+                liked.add(id)
+                results.append({'status': 200, 'like': id})
+        elif kind == 'follow':
+            if id not in existing_users:
+                results.append({'status': 404, 'error': 'User does not exist'})
+            elif id in followed:
+                results.append({'status': 400, 'error': 'Already following this user'})
+            else:
+                followed.add(id)
+                results.append({'status': 200, 'follow': id})
+        elif kind == 'comment':
+            if id not in existing_posts:
+                results.append({'status': 404, 'error': 'Post does not exist'})
+            elif not isinstance(content, str) or len(content) == 0 or content.isspace():
+                results.append({'status': 400, 'error': 'Please provide a comment'})
+            else:
+                comment = Comment(post_id=id, author_id=user_id, content=content)
+                comments.append(comment)
+                results.append({'status': 200, 'comment': comment})
+        else:
+            results.append({'status': 400, 'error': 'Unknown action'})
+
+    # Posts to like and users to follow; a concurrent request may write some of
+    # these links first, so only those inserted below count
+    likes = [result['like'] for result in results if 'like' in result]
+    follows = [result['follow'] for result in results if 'follow' in result]
+    comment_counts = Counter(comment.post_id for comment in comments)
+    # One transaction per database written to. They commit together at the
+    # end, but a failure to commit one shard does not roll back the others.
+    with ExitStack() as transactions:
+        transactions.enter_context(transaction.atomic())
+        for alias in shards:
+            if alias != 'default':
+                transactions.enter_context(transaction.atomic(using=alias))
+        liked_now = set()
+        for alias, ids in shards.items():
+            ids = set(ids)
+            inserted = relations.insert_links(Like, 'post', 'user', [(post_id, user_id) for post_id in likes if post_id in ids], using=alias)
+            liked_now.update(post_id for post_id, _ in inserted)
+            sharding.bulk_create_new(Comment, [comment for comment in comments if comment.post_id in ids], alias)
+            shard_likes = {post_id: 1 for post_id, _ in inserted}
+            shard_comments = {post_id: n for post_id, n in comment_counts.items() if post_id in ids}
+            if shard_likes or shard_comments:
+                sharding.using(Post.objects, alias).filter(id__in=shard_likes.keys() | shard_comments.keys()).update(
+                    likes_count=_count_update(shard_likes, 'likes_count'),
+                    comments_count=_count_update(shard_comments, 'comments_count'),
+                )
+        followed_now = {id for id, _ in relations.insert_links(
+            Follow, 'from_user', 'to_user', [(id, user_id) for id in follows], guards=[(User, user_id)],
+        )}
+        if followed_now:
+            User.objects.filter(id__in=[*followed_now, user_id]).update(
+                followers_count=_count_update({id: 1 for id in followed_now}, 'followers_count'),
+                following_count=_count_update({user_id: len(followed_now)}, 'following_count'),
+            )
+
+    like_counts = Counter(liked_now)
+    likes = [post_id for post_id in likes if post_id in liked_now]
+    follows = [id for id in follows if id in followed_now]
+
+    if like_counts or comment_counts:
+        cache.invalidate_post(*(like_counts.keys() | comment_counts.keys()))
+    if follows:
+        suggestions.follow(user_id, follows)
+
+    # The same deferred work as the single-action endpoints, queued together
+    jobs = [('index_comments', [comment.post_id, comment.content], f'comment:{comment.id}') for comment in comments]
+    jobs += [
+        ('trending', [post_id, like_counts[post_id] * settings.TRENDING_LIKE_WEIGHT + comment_counts[post_id] * settings.TRENDING_COMMENT_WEIGHT], None)
+        for post_id in like_counts.keys() | comment_counts.keys()
+    ]
+    if follows:
+        jobs.append(('backfill', [user_id, follows], None))
+    jobs += [('notify', [Notification.LIKE, existing_posts[post_id], user_id, post_id], None) for post_id in likes]
+    jobs += [('notify', [Notification.COMMENT, existing_posts[comment.post_id], user_id, comment.post_id], None) for comment in comments]
+    jobs += [('notify', [Notification.FOLLOW, id, user_id, 0], None) for id in follows]
+    tasks.enqueue_many(jobs)
+
+    for result in results:
+        comment = result.pop('comment', None)
+        if comment is not None:
+            result['comment_id'] = comment.id
+        if 'like' in result and result.pop('like') not in liked_now:
+            result.update(status=400, error='Already liked this post')
+        if 'follow' in result and result.pop('follow') not in followed_now:
+            result.update(status=400, error='Already following this user')
+    return results
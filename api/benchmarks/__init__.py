@@ -0,0 +1,33 @@
+import statistics
+
+# Benchmark suites run by `manage.py benchmark <suite>`. Each suite module
+# defines add_arguments(parser) and run(options, stdout) -> dict.
+SUITES = {
+    'encoders': 'api.benchmarks.encoders',
+    'endpoints': 'api.benchmarks.endpoints',
+    'login': 'api.benchmarks.login',
+    'search': 'api.benchmarks.fulltext',
+    'serving': 'api.benchmarks.serving',
+    'suggestions': 'api.benchmarks.graph',
+    'tasks': 'api.benchmarks.workers',
+    'throttle': 'api.benchmarks.throttle',
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def summarize(latencies, wall):
+    # Latency percentiles in milliseconds and throughput of a timed run
+    return {
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / wall, 1) if wall else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
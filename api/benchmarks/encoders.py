@@ -0,0 +1,88 @@
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from api.renderers import ORJSONRenderer, StdlibRenderer, orjson
+from . import percentile
+
+# Times the response renderers on synthetic all_posts pages of increasing
+# size. Needs no database.
+
+
+def renderers():
+    available = {'stdlib': StdlibRenderer()}
+    if orjson is not None:
+        available['orjson'] = ORJSONRenderer(native_datetimes=False)
+        available['orjson_native_datetimes'] = ORJSONRenderer(native_datetimes=True)
+    return available
+
+
+def build_page(rng, posts, comments, likes):
+    # Shaped like the all_posts response built by serialize_post
+    now = datetime.now(timezone.utc)
+
+    def moment():
+        return now - timedelta(seconds=rng.randrange(10 ** 7), microseconds=rng.randrange(10 ** 6))
+
+    return {
+        'posts': [
+            {
+                'id': post_id,
+                'title': f'Post {post_id}',
+                'description': 'lorem ipsum ' * rng.randint(1, 20),
+                'created_at': moment(),
+                'comments': [
+                    {'id': post_id * 1000 + i, 'author': f'user{rng.randrange(10000)}', 'content': 'nice post ' * rng.randint(1, 5), 'created_at': moment()}
+                    for i in range(rng.randint(0, 2 * comments))
+                ],
+                'likes': [{'id': user_id, 'username': f'user{user_id}'} for user_id in rng.sample(range(10000), rng.randint(0, 2 * likes))],
+            }
+            for post_id in range(1, posts + 1)
+        ],
+        'next_cursor': 'WyIyMDIzLTA0LTEwVDEwOjAwOjAwKzAwOjAwIiwxXQ',
+    }
+
+
+def time_renderer(renderer, page, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = renderer.render(page)
+        timings.append(time.perf_counter() - start)
+    median = percentile(timings, 50)
+    return {
+        'bytes': len(body),
+        'median_ms': round(median * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'mb_per_sec': round(len(body) / median / 1e6, 1) if median else 0,
+    }, body
+
+
+def add_arguments(parser):
+    parser.add_argument('--posts', type=int, nargs='*', default=[20, 100, 1000], help='Page sizes to encode')
+    parser.add_argument('--comments', type=int, default=10, help='Average number of comments per post')
+    parser.add_argument('--likes', type=int, default=25, help='Average number of likes per post')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed encodings per renderer and page size')
+
+
+def run(options, stdout):
+    rng = random.Random(options['seed'])
+    available = renderers()
+    pages = {}
+    for posts in options['posts']:
+        stdout.write(f'encoding pages of {posts} posts\n')
+        page = build_page(rng, posts, options['comments'], options['likes'])
+        results = {}
+        reference = None
+        for name, renderer in available.items():
+            results[name], body = time_renderer(renderer, page, options['repeat'])
+            if reference is None:
+                reference = json.loads(body)
+            else:
+                results[name]['same_as_stdlib'] = json.loads(body) == reference
+        baseline = results['stdlib']['median_ms']
+        for name, result in results.items():
+            result['speedup'] = round(baseline / result['median_ms'], 2) if result['median_ms'] else None
+        pages[str(posts)] = results
+    return {'renderers': list(available), 'pages': pages}
@@ -0,0 +1,171 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from api.auth import issue_refresh_token, issue_token
+from api.models import User
+from api.urls import urlpatterns
+from . import seed, summarize
+
+# One request generator per named route in api/urls.py. Each returns the
+# arguments for Client.generic(): method, path, body and content type.
+
+
+def _json(data):
+    return json.dumps(data), 'application/json'
+
+
+SCENARIOS = {
+    'authenticate_user': lambda ctx, rng, user_id: ('POST', reverse('authenticate_user'), *_json({'username': ctx.usernames[user_id], 'password': seed.PASSWORD})),
+    'refresh_token': lambda ctx, rng, user_id: ('POST', reverse('refresh_token'), *_json({'refresh': ctx.refresh_tokens[user_id]})),
+    'user': lambda ctx, rng, user_id: ('GET', reverse('user'), '', None),
+    'follow_user': lambda ctx, rng, user_id: ('POST', reverse('follow_user', args=[rng.choice(ctx.user_ids)]), '', None),
+    'unfollow_user': lambda ctx, rng, user_id: ('POST', reverse('unfollow_user', args=[rng.choice(ctx.user_ids)]), '', None),
+    'user_relationships': lambda ctx, rng, user_id: ('POST', reverse('user_relationships'), *_json({'ids': rng.sample(ctx.user_ids, min(100, len(ctx.user_ids)))})),
+    'create_post': lambda ctx, rng, user_id: ('POST', reverse('create_post'), *_json({'title': 'Benchmark', 'description': 'Benchmark post'})),
+    'delete_post': lambda ctx, rng, user_id: ('GET', reverse('delete_post', args=[rng.choice(ctx.post_ids)]), '', None),
+    'post_comments': lambda ctx, rng, user_id: ('GET', reverse('post_comments', args=[rng.choice(ctx.post_ids)]), '', None),
+    'like_post': lambda ctx, rng, user_id: ('POST', reverse('like_post', args=[rng.choice(ctx.post_ids)]), '', None),
+    'unlike_post': lambda ctx, rng, user_id: ('POST', reverse('unlike_post', args=[rng.choice(ctx.post_ids)]), '', None),
+    'add_comment': lambda ctx, rng, user_id: ('POST', reverse('add_comment', args=[rng.choice(ctx.post_ids)]), 'comment=Benchmark', 'application/x-www-form-urlencoded'),
+    'all_posts': lambda ctx, rng, user_id: ('GET', reverse('all_posts'), '', None),
+    'export_posts': lambda ctx, rng, user_id: ('GET', reverse('export_posts'), '', None),
+    'search_posts': lambda ctx, rng, user_id: ('GET', reverse('search_posts') + '?q=' + rng.choice(['lorem', 'great post', 'ipsum dolor']), '', None),
+    'trending_posts': lambda ctx, rng, user_id: ('GET', reverse('trending_posts'), '', None),
+    'suggested_users': lambda ctx, rng, user_id: ('GET', reverse('suggested_users'), '', None),
+    'home_feed': lambda ctx, rng, user_id: ('GET', reverse('home_feed'), '', None),
+    'notifications': lambda ctx, rng, user_id: ('GET', reverse('notifications'), '', None),
+    'batch_actions': lambda ctx, rng, user_id: ('POST', reverse('batch_actions'), *_json({'actions': [
+        {'action': rng.choice(['like', 'comment']), 'id': rng.choice(ctx.post_ids), 'comment': 'Benchmark'} for _ in range(20)
+    ]})),
+    'request_metrics': lambda ctx, rng, user_id: ('GET', reverse('request_metrics'), '', None),
+}
+
+
+class Context:
+    def __init__(self, user_ids, post_ids):
+        self.user_ids = user_ids
+        self.post_ids = post_ids
+        users = User.objects.filter(id__in=user_ids).only('id', 'username', 'password')
+        self.usernames = {user.id: user.username for user in users}
+        self.tokens = {user.id: issue_token(user) for user in users}
+        self.refresh_tokens = {user.id: issue_refresh_token(user) for user in users}
+
+
+class QueryCounter:
+    # Counts queries through an execute wrapper, which works with DEBUG off.
+    # Installed on every database alias, so replica and shard queries count too.
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def drive(ctx, name, requests, concurrency, seed):
+    scenario = SCENARIOS[name]
+    latencies, queries, statuses = [], [], Counter()
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(SERVER_NAME='localhost')
+        counter = QueryCounter()
+        try:
+            with ExitStack() as wrappers:
+                for connection in connections.all():
+                    wrappers.enter_context(connection.execute_wrapper(counter))
+                for _ in range(count):
+                    user_id = rng.choice(ctx.user_ids)
+                    method, path, body, content_type = scenario(ctx, rng, user_id)
+                    extra = {'HTTP_AUTHORIZATION': f'Bearer {ctx.tokens[user_id]}'}
+                    if content_type:
+                        extra['content_type'] = content_type
+                    counter.count = 0
+                    start = time.perf_counter()
+                    response = client.generic(method, path, body, **extra)
+                    if response.streaming:
+                        # Streamed bodies are produced, and queried for, as they are read
+                        b''.join(response.streaming_content)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        queries.append(counter.count)
+                        statuses[response.status_code] += 1
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connections.close_all()
+
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    if concurrency == 1:
+        # Run in the calling thread so the benchmark also works inside a test transaction
+        worker(0, requests)
+    else:
+        threads = [threading.Thread(target=worker, args=(i, share)) for i, share in enumerate(shares)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - start
+
+    report = summarize(latencies, wall)
+    report['queries_per_request'] = round(sum(queries) / len(queries), 2) if queries else 0
+    report['status_codes'] = {str(code): n for code, n in sorted(statuses.items())}
+    return report
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000, help='Number of synthetic users to seed')
+    parser.add_argument('--avg-following', type=float, default=20, help='Average number of accounts each user follows')
+    parser.add_argument('--avg-posts', type=float, default=10, help='Average number of posts per user')
+    parser.add_argument('--avg-likes', type=float, default=5, help='Average number of likes per post')
+    parser.add_argument('--avg-comments', type=float, default=2, help='Average number of comments per post')
+    parser.add_argument('--prefix', default='bench_', help='Username prefix of the synthetic users')
+    parser.add_argument('--reuse', action='store_true', help='Reuse a graph seeded by an earlier run with the same prefix')
+    parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic graph when done')
+    parser.add_argument('--requests', type=int, default=200, help='Requests sent to each route')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--routes', nargs='*', help='Only benchmark these route names')
+
+
+def run(options, stdout):
+    if options['reuse']:
+        user_ids, post_ids = seed.load_graph(options['prefix'])
+    else:
+        user_ids, post_ids = seed.seed_graph(
+            options['users'], options['avg_following'], options['avg_posts'], options['avg_likes'],
+            options['avg_comments'], prefix=options['prefix'], seed=options['seed'], stdout=stdout,
+        )
+    try:
+        ctx = Context(user_ids, post_ids)
+        routes = {}
+        # The test client's requests come from 127.0.0.1, which may scrape the
+        # metrics, and are not throttled: every request of a route is timed
+        # doing its work rather than answering 429
+        with override_settings(API_METRICS_ALLOWED_IPS=[*settings.API_METRICS_ALLOWED_IPS, '127.0.0.1'], THROTTLE_RATES={}):
+            for pattern in urlpatterns:
+                name = pattern.name
+                if name is None or (options['routes'] and name not in options['routes']):
+                    continue
+                if name not in SCENARIOS or not post_ids:
+                    routes[name] = {'skipped': True}
+                    continue
+                routes[name] = drive(ctx, name, options['requests'], options['concurrency'], options['seed'])
+        return {
+            'graph': {'users': len(user_ids), 'posts': len(post_ids)},
+            'concurrency': options['concurrency'],
+            'routes': routes,
+        }
+    finally:
+        if options['cleanup']:
+            seed.delete_graph(options['prefix'])
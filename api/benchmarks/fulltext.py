@@ -0,0 +1,130 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.db.models import Q
+from django.test import RequestFactory
+
+from api import search
+from api.models import User, Post
+from . import seed, summarize
+
+# Times ranked search over a synthetic corpus, one million posts by default.
+# Words follow a Zipf distribution, so queries can target common, mid-frequency
+# and rare terms. A few unindexed icontains queries for rare terms, which
+# have to read the whole table, are timed for comparison.
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'tu', 'ra', 'po', 've', 'di', 'gu', 'ba', 'ze', 'fo', 'hi', 'ju', 'wa']
+BATCH_SIZE = 5000
+
+
+def make_vocabulary(size):
+    # Distinct pronounceable words; the i-th word is the i-th most frequent
+    words = []
+    for length in itertools.count(2):
+        for parts in itertools.product(SYLLABLES, repeat=length):
+            words.append(''.join(parts))
+            if len(words) == size:
+                return words
+
+
+def seed_corpus(posts, vocabulary_size, prefix, seed_value, stdout):
+    rng = random.Random(seed_value)
+    vocabulary = make_vocabulary(vocabulary_size)
+    cum_weights = list(itertools.accumulate(seed.zipf_weights(vocabulary_size)))
+
+    def text(low, high):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(low, high)))
+
+    author = User.objects.create(username=f'{prefix}author', email=f'{prefix}author@bench.invalid', password=make_password(seed.PASSWORD))
+    for start in range(0, posts, BATCH_SIZE):
+        Post.objects.bulk_create([
+            Post(author=author, title=text(3, 8), content=text(20, 60))
+            for _ in range(min(BATCH_SIZE, posts - start))
+        ])
+        stdout.write(f'seeded {min(start + BATCH_SIZE, posts)} posts\n')
+
+    start = time.perf_counter()
+    search.rebuild()
+    return vocabulary, time.perf_counter() - start
+
+
+def delete_corpus(prefix):
+    # Raw deletes: going through the ORM would load every post to send signals
+    posts = Post.objects.filter(author__username=f'{prefix}author').values('id')
+    sql, params = posts.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {search.TABLE} WHERE rowid IN ({sql})', params)
+        cursor.execute(f'DELETE FROM {Post._meta.db_table} WHERE id IN ({sql})', params)
+    User.objects.filter(username=f'{prefix}author').delete()
+
+
+def time_queries(queries, pages):
+    factory = RequestFactory()
+    latencies = []
+    for query in queries:
+        cursor = None
+        for _ in range(pages):
+            request = factory.get('/', {'q': query, **({'cursor': cursor} if cursor else {})})
+            start = time.perf_counter()
+            _, cursor = search.search(query, request)
+            latencies.append(time.perf_counter() - start)
+            if cursor is None:
+                break
+    return summarize(latencies, sum(latencies))
+
+
+def time_scans(queries):
+    latencies = []
+    for query in queries:
+        words = query.split()
+        condition = Q()
+        for word in words:
+            condition &= Q(title__icontains=word) | Q(content__icontains=word)
+        start = time.perf_counter()
+        list(Post.objects.filter(condition).order_by('-id')[:20])
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, sum(latencies))
+
+
+def add_arguments(parser):
+    parser.add_argument('--posts', type=int, default=1000000, help='Number of posts in the corpus')
+    parser.add_argument('--vocabulary', type=int, default=50000, help='Number of distinct words')
+    parser.add_argument('--prefix', default='search_bench_', help='Username prefix of the corpus author')
+    parser.add_argument('--reuse', action='store_true', help='Reuse a corpus seeded by an earlier run with the same prefix and seed')
+    parser.add_argument('--cleanup', action='store_true', help='Delete the corpus when done')
+    parser.add_argument('--queries', type=int, default=50, help='Queries timed per query class')
+    parser.add_argument('--pages', type=int, default=1, help='Result pages read per query, following the cursor')
+    parser.add_argument('--scan-queries', type=int, default=5, help='Unindexed icontains queries timed for comparison')
+
+
+def run(options, stdout):
+    if search.get_backend() is None:
+        raise search.SearchUnavailable(connection.vendor)
+    report = {}
+    if options['reuse']:
+        vocabulary = make_vocabulary(options['vocabulary'])
+    else:
+        vocabulary, build = seed_corpus(options['posts'], options['vocabulary'], options['prefix'], options['seed'], stdout)
+        report['index_build_seconds'] = round(build, 2)
+    try:
+        rng = random.Random(options['seed'])
+        n = options['queries']
+        rare = vocabulary[len(vocabulary) // 2:]
+        classes = {
+            'common': rng.choices(vocabulary[:10], k=n),
+            'mid': rng.choices(vocabulary[100:1000], k=n),
+            'rare': rng.choices(rare, k=n),
+            'two_terms': [f'{a} {b}' for a, b in zip(rng.choices(vocabulary[:10], k=n), rng.choices(vocabulary[100:1000], k=n))],
+        }
+        report['posts'] = Post.objects.filter(author__username=f'{options["prefix"]}author').count()
+        report['queries'] = {name: time_queries(queries, options['pages']) for name, queries in classes.items()}
+        if options['scan_queries']:
+            report['icontains_scan'] = time_scans(classes['rare'][:options['scan_queries']])
+        return report
+    finally:
+        if options['cleanup']:
+            delete_corpus(options['prefix'])
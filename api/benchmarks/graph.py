@@ -0,0 +1,107 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.db.models import Count
+
+from api import suggestions
+from api.models import User, Follow
+from . import seed, summarize
+
+# Times follow suggestions on a synthetic follow graph, about a million edges
+# by default: loading the in-memory graph, ranking suggestions from it, serving
+# them from the per-user cache, and, for comparison, the same ranking as a
+# friends-of-friends aggregate over the through table.
+
+
+def seed_follows(users, avg_following, prefix, seed_value, stdout):
+    # Only users and follows; seed.seed_graph also writes posts and timelines
+    rng = random.Random(seed_value)
+    password = make_password(seed.PASSWORD)
+    User.objects.bulk_create(
+        [User(username=f'{prefix}{i}', email=f'{prefix}{i}@bench.invalid', password=password) for i in range(users)],
+        batch_size=seed.BATCH_SIZE,
+    )
+    user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+    cum_weights = list(itertools.accumulate(seed.zipf_weights(len(user_ids))))
+
+    follows, seeded = [], 0
+    for user_id in user_ids:
+        count = min(int(rng.expovariate(1 / avg_following)), len(user_ids) - 1)
+        followed = set()
+        while len(followed) < count:
+            followed.update(rng.choices(user_ids, cum_weights=cum_weights, k=count - len(followed)))
+            followed.discard(user_id)
+        follows += [Follow(from_user_id=followed_id, to_user_id=user_id) for followed_id in followed]
+        if len(follows) >= seed.BATCH_SIZE * 10:
+            Follow.objects.bulk_create(follows, batch_size=seed.BATCH_SIZE)
+            seeded += len(follows)
+            stdout.write(f'seeded {seeded} follows\n')
+            follows = []
+    Follow.objects.bulk_create(follows, batch_size=seed.BATCH_SIZE)
+    return user_ids
+
+
+def orm_suggest(user_id, n):
+    following = Follow.objects.filter(to_user_id=user_id).values('from_user_id')
+    return list(
+        Follow.objects.filter(to_user_id__in=following)
+        .exclude(from_user_id__in=following).exclude(from_user_id=user_id)
+        .values('from_user_id').annotate(mutual=Count('id')).order_by('-mutual', 'from_user_id')[:n]
+    )
+
+
+def timed(calls):
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, sum(latencies))
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=50000, help='Number of synthetic users to seed')
+    parser.add_argument('--avg-following', type=float, default=20, help='Average number of accounts each user follows')
+    parser.add_argument('--prefix', default='graph_bench_', help='Username prefix of the synthetic users')
+    parser.add_argument('--reuse', action='store_true', help='Reuse a graph seeded by an earlier run with the same prefix')
+    parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic graph when done')
+    parser.add_argument('--queries', type=int, default=200, help='Users whose suggestions are ranked from the in-memory graph')
+    parser.add_argument('--orm-queries', type=int, default=20, help='Users whose suggestions are ranked with the ORM aggregate')
+    parser.add_argument('--limit', type=int, default=20, help='Suggestions returned per user')
+
+
+def run(options, stdout):
+    if options['reuse']:
+        user_ids = list(User.objects.filter(username__startswith=options['prefix']).order_by('id').values_list('id', flat=True))
+    else:
+        user_ids = seed_follows(options['users'], options['avg_following'], options['prefix'], options['seed'], stdout)
+    try:
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        graph = suggestions.FollowGraph.load()
+        load = time.perf_counter() - start
+        arrays = (graph.owners, graph.offsets, graph.targets)
+
+        sample = rng.choices(user_ids, k=options['queries'])
+        in_memory = timed(lambda user_id=user_id: graph.suggest(user_id, options['limit']) for user_id in sample)
+        suggestions.store.clear()
+        suggestions.store.graph, suggestions.store.loaded_at = graph, time.time()
+        for user_id in sample:
+            suggestions.suggest(user_id, options['limit'])
+        return {
+            'graph': {
+                'users': len(user_ids),
+                'edges': graph.edges,
+                'load_seconds': round(load, 2),
+                'array_bytes': sum(a.itemsize * len(a) for a in arrays),
+            },
+            'in_memory': in_memory,
+            'cached': timed(lambda user_id=user_id: suggestions.suggest(user_id, options['limit']) for user_id in sample),
+            'orm_aggregate': timed(lambda user_id=user_id: orm_suggest(user_id, options['limit']) for user_id in sample[:options['orm_queries']]),
+        }
+    finally:
+        suggestions.store.clear()
+        if options['cleanup']:
+            seed.delete_graph(options['prefix'])
@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+from django.test import override_settings
+
+from api import login
+from api.models import User
+
+# Times logins through api/login.py with each password hasher at its configured
+# cost: a full check, which hashes the password, and a repeated login served by
+# the remembered result. Logins per core divide by the CPU time of the process,
+# so they do not depend on how many cores the machine has.
+
+PASSWORD = 'benchmark-password'
+
+
+def timed(count, call):
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(count):
+        call()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {
+        'logins': count,
+        'ms_per_login': round(wall / count * 1000, 3),
+        'logins_per_sec_per_core': round(count / cpu, 1) if cpu else 0,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--hashers', nargs='+', default=list(settings.API_PASSWORD_HASHERS), choices=list(settings.API_PASSWORD_HASHERS),
+                        help='Password hashers to time')
+    parser.add_argument('--logins', type=int, default=20, help='Logins timed with a full password check per hasher')
+    parser.add_argument('--cached-logins', type=int, default=1000, help='Logins timed on the remembered-result path')
+    parser.add_argument('--username', default='login_bench', help='Username of the temporary benchmark user')
+
+
+def run(options, stdout):
+    report = {'hashers': {}}
+    for name in options['hashers']:
+        path = settings.API_PASSWORD_HASHERS[name]
+        with override_settings(PASSWORD_HASHERS=[path]):
+            try:
+                user = User.objects.create_user(username=options['username'], email=f"{options['username']}@bench.invalid", password=PASSWORD)
+            except ValueError as e:
+                # The hasher's library is missing, e.g. argon2-cffi
+                report['hashers'][name] = {'skipped': str(e)}
+                continue
+            try:
+                authenticate = lambda: login.authenticate(options['username'], PASSWORD)
+                full = timed(options['logins'], lambda: (login.verified.clear(), authenticate()))
+                stdout.write(f'{name}: {full["ms_per_login"]} ms per login\n')
+                report['hashers'][name] = {'full': full, 'cached': timed(options['cached_logins'], authenticate)}
+            finally:
+                login.verified.clear()
+                user.delete()
+    return report
@@ -0,0 +1,98 @@
+import random
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+
+from api.models import User, Post, Comment
+from api import feed, search, trending
+
+Follow = User.followers.through
+Like = Post.likes.through
+
+BATCH_SIZE = 2000
+PASSWORD = 'bench-password'
+
+
+def zipf_weights(n, s=1.1):
+    # Popularity of the i-th most popular user; a handful of accounts receive
+    # most follows and likes, as on a real social network
+    return [1 / (rank + 1) ** s for rank in range(n)]
+
+
+def sample_distinct(rng, population, weights, k, exclude=None):
+    k = min(k, len(population) - (1 if exclude is not None else 0))
+    picked = set()
+    while len(picked) < k:
+        for value in rng.choices(population, weights=weights, k=k - len(picked)):
+            if value != exclude:
+                picked.add(value)
+    return picked
+
+
+def seed_graph(users, avg_following, avg_posts, avg_likes, avg_comments, prefix='bench_', seed=0, stdout=None):
+    # Seeds a synthetic social graph and returns the created user and post ids
+    rng = random.Random(seed)
+    log = stdout.write if stdout is not None else (lambda message: None)
+
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [User(username=f'{prefix}{i}', email=f'{prefix}{i}@bench.invalid', password=password) for i in range(users)],
+        batch_size=BATCH_SIZE,
+    )
+    user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+    weights = zipf_weights(len(user_ids))
+    log(f'seeded {len(user_ids)} users')
+
+    follows = []
+    following = {}
+    for user_id in user_ids:
+        count = min(int(rng.expovariate(1 / avg_following)) if avg_following else 0, len(user_ids) - 1)
+        following[user_id] = sample_distinct(rng, user_ids, weights, count, exclude=user_id)
+        follows += [Follow(from_user_id=target, to_user_id=user_id) for target in following[user_id]]
+    Follow.objects.bulk_create(follows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    log(f'seeded {len(follows)} follows')
+
+    Post.objects.bulk_create(
+        [Post(author_id=user_id, title=f'Post {i} by {user_id}', content='Lorem ipsum dolor sit amet ' * 4)
+         for user_id in user_ids for i in range(int(rng.expovariate(1 / avg_posts)) if avg_posts else 0)],
+        batch_size=BATCH_SIZE,
+    )
+    post_ids = list(Post.objects.filter(author_id__in=user_ids).order_by('id').values_list('id', flat=True))
+    log(f'seeded {len(post_ids)} posts')
+
+    likes, comments = [], []
+    for post_id in post_ids:
+        likers = sample_distinct(rng, user_ids, weights, int(rng.expovariate(1 / avg_likes)) if avg_likes else 0)
+        likes += [Like(post_id=post_id, user_id=user_id) for user_id in likers]
+        for _ in range(int(rng.expovariate(1 / avg_comments)) if avg_comments else 0):
+            comments.append(Comment(post_id=post_id, author_id=rng.choices(user_ids, weights=weights)[0], content='Great post!'))
+    Like.objects.bulk_create(likes, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    Comment.objects.bulk_create(comments, batch_size=BATCH_SIZE)
+    log(f'seeded {len(likes)} likes and {len(comments)} comments')
+
+    for user_id, followed in following.items():
+        if followed:
+            feed.backfill(user_id, followed)
+    call_command('recount_counters', stdout=stdout)
+    if search.get_backend() is not None:
+        search.rebuild()
+    # Give every engaged post a trending score, as if its likes and comments were just made
+    weights = Counter()
+    for like in likes:
+        weights[like.post_id] += settings.TRENDING_LIKE_WEIGHT
+    for comment in comments:
+        weights[comment.post_id] += settings.TRENDING_COMMENT_WEIGHT
+    trending.record([(post_id, weight, None) for post_id, weight in weights.items()])
+    return user_ids, post_ids
+
+
+def load_graph(prefix='bench_'):
+    user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+    post_ids = list(Post.objects.filter(author_id__in=user_ids).order_by('id').values_list('id', flat=True))
+    return user_ids, post_ids
+
+
+def delete_graph(prefix='bench_'):
+    User.objects.filter(username__startswith=prefix).delete()
@@ -0,0 +1,181 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+from django.conf import settings
+
+from . import seed, summarize
+from .endpoints import SCENARIOS, Context
+
+# Compares the throughput of server setups over real HTTP. Each profile is a
+# server command started against the configured database, so the production
+# profile needs Postgres through the POSTGRES_* variables (see
+# reunion/settings_production.py). Only read routes are driven by default, so
+# every profile sees the same data.
+
+PROFILES = {
+    # The current setup: the development server with reunion/settings.py
+    'dev': {
+        'command': [sys.executable, 'manage.py', 'runserver', '--noreload', '127.0.0.1:{port}'],
+        'env': {},
+    },
+    'production': {
+        'command': ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}', 'reunion.wsgi:application'],
+        'env': {'DJANGO_SETTINGS_MODULE': 'reunion.settings_production', 'DJANGO_ALLOWED_HOSTS': 'localhost'},
+    },
+}
+
+READ_ROUTES = ['user', 'all_posts', 'home_feed', 'delete_post', 'post_comments']
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(profile, timeout):
+    port = _free_port()
+    command = [part.format(port=port) for part in PROFILES[profile]['command']]
+    env = {**os.environ, **PROFILES[profile]['env']}
+    process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # localhost is in the ALLOWED_HOSTS of every settings module
+    url = f'http://localhost:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{profile} server exited with status {process.returncode}: {" ".join(command)}')
+        try:
+            urllib.request.urlopen(url + '/api/metrics/', timeout=1).close()
+            return process, url
+        except urllib.error.HTTPError:
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f'{profile} server did not start within {timeout}s')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _send(url, method, path, body, content_type, token):
+    request = urllib.request.Request(url + path, data=body.encode() or None, method=method)
+    request.add_header('Authorization', f'Bearer {token}')
+    if content_type:
+        request.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def drive(url, ctx, name, requests, concurrency, seed):
+    scenario = SCENARIOS[name]
+    latencies, statuses = [], Counter()
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(seed * 1000 + index)
+        for _ in range(count):
+            user_id = rng.choice(ctx.user_ids)
+            method, path, body, content_type = scenario(ctx, rng, user_id)
+            start = time.perf_counter()
+            status = _send(url, method, path, body, content_type, ctx.tokens[user_id])
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(i, share)) for i, share in enumerate(shares)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = summarize(latencies, time.perf_counter() - start)
+    report['status_codes'] = {str(code): n for code, n in sorted(statuses.items())}
+    return report
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000, help='Number of synthetic users to seed')
+    parser.add_argument('--avg-following', type=float, default=20, help='Average number of accounts each user follows')
+    parser.add_argument('--avg-posts', type=float, default=10, help='Average number of posts per user')
+    parser.add_argument('--avg-likes', type=float, default=5, help='Average number of likes per post')
+    parser.add_argument('--avg-comments', type=float, default=2, help='Average number of comments per post')
+    parser.add_argument('--prefix', default='bench_', help='Username prefix of the synthetic users')
+    parser.add_argument('--reuse', action='store_true', help='Reuse a graph seeded by an earlier run with the same prefix')
+    parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic graph when done')
+    parser.add_argument('--requests', type=int, default=500, help='Requests sent to each route')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--routes', nargs='*', default=READ_ROUTES, help='Route names to benchmark')
+    parser.add_argument('--profiles', nargs='*', default=list(PROFILES), choices=list(PROFILES), help='Server setups to compare')
+    parser.add_argument('--url', action='append', default=[], metavar='PROFILE=URL',
+                        help='Benchmark an already running server for this profile instead of starting one')
+    parser.add_argument('--startup-timeout', type=float, default=30, help='Seconds to wait for a server to answer')
+
+
+def run(options, stdout):
+    urls = dict(value.split('=', 1) for value in options['url'])
+    if options['reuse']:
+        user_ids, post_ids = seed.load_graph(options['prefix'])
+    else:
+        user_ids, post_ids = seed.seed_graph(
+            options['users'], options['avg_following'], options['avg_posts'], options['avg_likes'],
+            options['avg_comments'], prefix=options['prefix'], seed=options['seed'], stdout=stdout,
+        )
+    try:
+        ctx = Context(user_ids, post_ids)
+        profiles = {}
+        for profile in options['profiles']:
+            process = None
+            url = urls.get(profile)
+            if url is None:
+                stdout.write(f'Starting {profile} server\n')
+                process, url = start_server(profile, options['startup_timeout'])
+            try:
+                profiles[profile] = {
+                    name: drive(url, ctx, name, options['requests'], options['concurrency'], options['seed'])
+                    for name in options['routes']
+                }
+            finally:
+                if process is not None:
+                    stop_server(process)
+
+        report = {
+            'graph': {'users': len(user_ids), 'posts': len(post_ids)},
+            'concurrency': options['concurrency'],
+            'profiles': profiles,
+        }
+        if len(profiles) > 1:
+            # Throughput of every profile relative to the first one
+            baseline, *others = options['profiles']
+            report['speedup'] = {
+                profile: {
+                    name: round(route['requests_per_sec'] / profiles[baseline][name]['requests_per_sec'], 2)
+                    if profiles[baseline][name]['requests_per_sec'] else None
+                    for name, route in profiles[profile].items()
+                }
+                for profile in others
+            }
+        return report
+    finally:
+        if options['cleanup']:
+            seed.delete_graph(options['prefix'])
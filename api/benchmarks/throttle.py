@@ -0,0 +1,58 @@
+import random
+import time
+
+import jwt
+from django.conf import settings
+from django.test import RequestFactory, override_settings
+
+from api import auth, throttling
+
+# Times the throttle check on its own: one bucket take per backend, and the
+# full check a throttled view runs (token lookup plus the user and IP buckets).
+# Needs no database.
+
+BACKENDS = {
+    'local': throttling.LocalBackend,
+    'cache': throttling.CacheBackend,
+}
+
+
+def time_per_call(calls, call):
+    start = time.perf_counter()
+    for args in calls:
+        call(*args)
+    return round((time.perf_counter() - start) / len(calls) * 1e6, 3)
+
+
+def add_arguments(parser):
+    parser.add_argument('--keys', type=int, default=5000, help='Number of distinct users (and IPs) taking tokens')
+    parser.add_argument('--checks', type=int, default=100000, help='Number of takes timed per backend')
+
+
+def run(options, stdout):
+    rng = random.Random(options['seed'])
+    user_ids = [rng.randrange(options['keys']) + 1 for _ in range(options['checks'])]
+    requests, period = settings.THROTTLE_RATES['like']['user']
+    report = {'microseconds_per_take': {}}
+    for name, backend_class in BACKENDS.items():
+        backend = backend_class()
+        report['microseconds_per_take'][name] = time_per_call(
+            [(f'bench:user:{user_id}', requests, period) for user_id in user_ids], backend.take,
+        )
+
+    # The user's token is already verified and cached, as it is for repeat requests
+    factory = RequestFactory()
+    tokens = {user_id: jwt.encode({'user_id': user_id}, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM) for user_id in set(user_ids)}
+    checks = [
+        (factory.post('/', HTTP_AUTHORIZATION=f'Bearer {tokens[user_id]}', REMOTE_ADDR=f'10.0.{user_id // 256 % 256}.{user_id % 256}'), 'bench')
+        for user_id in user_ids
+    ]
+    for token in tokens.values():
+        auth.decode_token(token)
+    # Every authenticated view parses request.headers anyway; time only what the check adds
+    for request, _ in checks:
+        request.headers
+    with override_settings(THROTTLE_RATES={'bench': settings.THROTTLE_RATES['like']}):
+        report['microseconds_per_check'] = time_per_call(checks, throttling.check)
+    report['keys'] = len(tokens)
+    return report
@@ -0,0 +1,73 @@
+import time
+
+from django.test import override_settings
+
+from api import tasks
+from api.models import Job
+
+# Times the task queue of api/tasks.py: how long a view spends enqueueing a job,
+# and how many jobs per second the workers then get through, per backend and
+# worker batch size. Each job does one indexed read, like the real tasks do at
+# least; the batch variant does one read per batch of jobs, as the trending and
+# comment indexing tasks do.
+
+BACKENDS = {
+    'local': 'api.tasks.LocalBackend',
+    'database': 'api.tasks.DatabaseBackend',
+}
+
+
+def _read():
+    Job.objects.filter(id=0).exists()
+
+
+@tasks.task('benchmark.single')
+def single(n):
+    _read()
+
+
+@tasks.task('benchmark.batch', batch=True)
+def batch(payloads):
+    _read()
+
+
+def add_arguments(parser):
+    parser.add_argument('--jobs', type=int, default=2000, help='Number of jobs queued per run')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS), help='Backends to time')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 100], help='Worker batch sizes to time')
+    parser.add_argument('--workers', type=int, default=2, help='Threads of the local backend')
+
+
+def run_once(backend_path, name, jobs, batch_size, workers):
+    with override_settings(TASK_BACKEND=backend_path, TASK_BATCH_SIZE=batch_size, TASK_WORKERS=workers):
+        backend = tasks.get_backend()
+        start = time.perf_counter()
+        for n in range(jobs):
+            tasks.enqueue(name, n)
+        enqueued = time.perf_counter()
+        if isinstance(backend, tasks.DatabaseBackend):
+            # Timed from here only: the jobs wait for a worker to be started
+            enqueued_at, ran = enqueued, backend.run_pending(batch_size)
+        else:
+            enqueued_at, ran = start, jobs
+            backend.join()
+        done = time.perf_counter()
+    return {
+        'enqueue_us_per_job': round((enqueued - start) / jobs * 1e6, 3),
+        'jobs_per_sec': round(ran / (done - enqueued_at), 1),
+    }
+
+
+def run(options, stdout):
+    report = {'jobs': options['jobs'], 'backends': {}}
+    try:
+        for backend in options['backends']:
+            results = report['backends'][backend] = {}
+            for batch_size in options['batch_sizes']:
+                for name in ('single', 'batch'):
+                    result = run_once(BACKENDS[backend], f'benchmark.{name}', options['jobs'], batch_size, options['workers'])
+                    results[f'{name}_batch_size_{batch_size}'] = result
+                    stdout.write(f'{backend} {name} batch size {batch_size}: {result["jobs_per_sec"]} jobs/s\n')
+    finally:
+        Job.objects.filter(name__startswith='benchmark.').delete()
+    return report
@@ -0,0 +1,91 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+from .models import Post
+
+
+def _cache():
+    return caches[settings.POST_CACHE_ALIAS]
+
+
+def _keys(post_id):
+    return f'post:{post_id}:body', f'post:{post_id}:version', f'post:{post_id}:lock'
+
+
+def make_etag(body):
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+
+def conditional_response(request, body, etag):
+    # The post detail response, or 304 Not Modified when If-None-Match is * or
+    # lists etag, compared weakly as the RFC requires for GET
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def get_post_response(post_id, build):
+    # Returns (body, etag) for a post, calling build() -> bytes on a miss.
+    #
+    # Every cached body is tagged with the post's current version token and is
+    # only served while that token is unchanged, so a body built from data read
+    # before an invalidation can never be served after it. Concurrent misses
+    # are collapsed behind a short lock: one caller builds while the others
+    # wait for its result instead of all hitting the database at once.
+    cache = _cache()
+    body_key, version_key, lock_key = _keys(post_id)
+
+    deadline = time.monotonic() + settings.POST_CACHE_LOCK_TIMEOUT
+    while True:
+        cached = cache.get_many([body_key, version_key])
+        version = cached.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(version_key, version, timeout=settings.POST_CACHE_TIMEOUT):
+                version = cache.get(version_key, version)
+        entry = cached.get(body_key)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+
+        if cache.add(lock_key, 1, timeout=settings.POST_CACHE_LOCK_TIMEOUT):
+            break
+        if time.monotonic() >= deadline:
+            # The builder is taking too long; build our own copy
+            return _build(cache, body_key, version, build, store=False)
+        time.sleep(0.01)
+
+    try:
+        return _build(cache, body_key, version, build)
+    finally:
+        cache.delete(lock_key)
+
+
+def _build(cache, body_key, version, build, store=True):
+    body = build()
+    etag = make_etag(body)
+    if store:
+        cache.set(body_key, (version, body, etag), timeout=settings.POST_CACHE_TIMEOUT)
+    return body, etag
+
+
+def invalidate_post(*post_ids):
+    # Rotating the version token makes every cached body of the post stale. A
+    # version token never outlives the bodies tagged with an older one, so it
+    # can expire with the same timeout.
+    cache = _cache()
+    cache.set_many({_keys(post_id)[1]: uuid.uuid4().hex for post_id in post_ids}, timeout=settings.POST_CACHE_TIMEOUT)
+    cache.delete_many([_keys(post_id)[0] for post_id in post_ids])
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_deleted_post(sender, instance, **kwargs):
+    # Also covers posts removed by cascade and ids reused after a deletion
+    invalidate_post(instance.id)
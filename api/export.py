@@ -0,0 +1,35 @@
+from django.conf import settings
+
+from . import sharding
+from .models import Post
+from .pagination import InvalidPage, seek
+from .renderers import get_renderer
+from .serializers import prefetch_posts, serialize_post
+
+
+def get_start(user_id, after):
+    # Position to resume an export from, given the id of the last post the
+    # client received. Checked before the response starts streaming, so a bad
+    # id is still answered with an error status.
+    if after is None:
+        return None
+    try:
+        after = int(after)
+    except ValueError:
+        raise InvalidPage('Invalid after')
+    position = sharding.using(Post.objects, sharding.for_user(user_id)).filter(id=after, author_id=user_id).values_list('created_at', 'id').first()
+    if position is None:
+        raise InvalidPage('Invalid after')
+    return position
+
+
+def stream_posts(user_id, position):
+    # Yields one JSON line per post, oldest first. The posts are read with a
+    # server-side cursor where the database supports one, and comments and
+    # likes are prefetched one chunk at a time, so memory use does not grow
+    # with the size of the account.
+    alias = sharding.for_user(user_id)
+    posts = seek(prefetch_posts(sharding.using(Post.objects, alias).filter(author_id=user_id), alias), position, descending=False)
+    renderer = get_renderer()
+    for post in posts.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+        yield renderer.render(serialize_post(post)) + b'\n'
@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import sharding
+from .models import User, Post, TimelineEntry
+from .pagination import encode_cursor, get_page_size, get_position, seek
+
+Follow = User.followers.through
+
+# Post ids deleted per statement by remove_author on a sharded store
+REMOVE_BATCH_SIZE = 1000
+
+
+def fan_out_post(post):
+    # Write the new post into the timeline of its author and of every follower.
+    # Accounts with more followers than FEED_FANOUT_THRESHOLD are skipped and
+    # merged into their followers' feeds at read time instead. Nothing is
+    # written when the author was deleted before the fan-out job ran.
+    followers_count = User.objects.filter(id=post.author_id).values_list('followers_count', flat=True).first()
+    if followers_count is None:
+        return
+    owner_ids = [post.author_id]
+    if followers_count <= settings.FEED_FANOUT_THRESHOLD:
+        owner_ids += Follow.objects.filter(from_user_id=post.author_id).values_list('to_user_id', flat=True)
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner_id=owner_id, post_id=post.id, post_created_at=post.created_at) for owner_id in owner_ids],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def backfill(owner_id, author_ids):
+    # Copy the most recent posts of newly followed accounts into the owner's timeline
+    by_shard = {}
+    for author_id in author_ids:
+        by_shard.setdefault(sharding.for_user(author_id), []).append(author_id)
+    recent = [
+        sharding.using(Post.objects, alias).filter(author_id__in=ids).order_by('-created_at', '-id')
+        .values_list('created_at', 'id')[:settings.FEED_BACKFILL_SIZE]
+        for alias, ids in by_shard.items()
+    ]
+    posts = heapq.merge(*recent, reverse=True) if len(recent) > 1 else (recent[0] if recent else [])
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner_id=owner_id, post_id=post_id, post_created_at=created_at) for created_at, post_id in list(posts)[:settings.FEED_BACKFILL_SIZE]],
+        ignore_conflicts=True,
+    )
+
+
+def remove_author(owner_id, author_id):
+    alias = sharding.for_user(author_id)
+    if alias == 'default':
+        TimelineEntry.objects.filter(owner_id=owner_id, post__author_id=author_id).delete()
+        return
+    # The author's posts are on another database, so their ids are read there
+    # and deleted from the timeline a batch at a time
+    post_ids = Post.objects.using(alias).filter(author_id=author_id).values_list('id', flat=True).iterator(chunk_size=REMOVE_BATCH_SIZE)
+    batch = []
+    for post_id in post_ids:
+        batch.append(post_id)
+        if len(batch) == REMOVE_BATCH_SIZE:
+            TimelineEntry.objects.filter(owner_id=owner_id, post_id__in=batch).delete()
+            batch = []
+    if batch:
+        TimelineEntry.objects.filter(owner_id=owner_id, post_id__in=batch).delete()
+
+
+@receiver(post_delete, sender=Post)
+def remove_deleted_post(sender, instance, using, **kwargs):
+    # On 'default' the entries go with the post through the delete cascade
+    if using != 'default':
+        TimelineEntry.objects.filter(post_id=instance.id).delete()
+
+
+def _celebrities(user_id):
+    return (
+        Follow.objects.filter(to_user_id=user_id, from_user__followers_count__gt=settings.FEED_FANOUT_THRESHOLD)
+        .values_list('from_user_id', flat=True)
+    )
+
+
+def followed_celebrities(user_id):
+    return list(_celebrities(user_id))
+
+
+def _timeline_keys(user_id, position, limit):
+    entries = seek(TimelineEntry.objects.filter(owner_id=user_id), position, time_field='post_created_at', id_field='post_id')
+    return entries.values_list('post_created_at', 'post_id')[:limit + 1]
+
+
+def _pulled_keys(celebrity_ids, position, limit):
+    # One limited scan of post_author_created_idx per celebrity, combined with
+    # UNION ALL. A single author_id IN (...) query would have to sort the
+    # authors' posts together; _merge orders the few rows returned instead.
+    # Each scan is wrapped in a derived table, since SQLite does not allow
+    # LIMIT directly in the arms of a compound query. There is one such query
+    # per shard holding any of the celebrities.
+    by_shard = {}
+    for author_id in celebrity_ids:
+        by_shard.setdefault(sharding.for_user(author_id), []).append(author_id)
+    keys = []
+    for alias, author_ids in by_shard.items():
+        parts, params = [], []
+        for author_id in author_ids:
+            scan = seek(Post.objects.filter(author_id=author_id), position).values_list('created_at', 'id')[:limit + 1]
+            sql, scan_params = scan.query.sql_with_params()
+            parts.append(f'SELECT * FROM ({sql}) AS scan_{len(parts)}')
+            params += scan_params
+        posts = sharding.using(Post.objects, alias).raw(' UNION ALL '.join(parts), params)
+        keys += [(post.created_at, post.id) for post in posts]
+    return keys
+
+
+def _merge(keys, limit):
+    keys = sorted(set(keys), reverse=True)
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = encode_cursor(*keys[-1])
+    return keys, next_cursor
+
+
+def _posts_for(keys):
+    posts = []
+    for alias, post_ids in sharding.group_by_shard(post_id for _, post_id in keys).items():
+        posts += sharding.with_authors(sharding.using(Post.objects, alias), alias).filter(id__in=post_ids)
+    return posts
+
+
+def _in_order(keys, posts):
+    posts = {post.id: post for post in posts}
+    return [posts[post_id] for _, post_id in keys if post_id in posts]
+
+
+def read_feed(user_id, request):
+    # Merge one page of the materialized timeline with one page of posts pulled
+    # from followed celebrities; both are keyset scans, so the cost of a page
+    # does not depend on how many accounts the user follows
+    limit = get_page_size(request)
+    position = get_position(request)
+
+    keys = list(_timeline_keys(user_id, position, limit))
+    celebrity_ids = followed_celebrities(user_id)
+    if celebrity_ids:
+        keys += _pulled_keys(celebrity_ids, position, limit)
+
+    keys, next_cursor = _merge(keys, limit)
+    return _in_order(keys, _posts_for(keys)), next_cursor
+
+
+async def aread_feed(user_id, request):
+    limit = get_page_size(request)
+    position = get_position(request)
+
+    # The timeline page and the celebrity lookup are independent
+    keys, celebrity_ids = await asyncio.gather(
+        _alist(_timeline_keys(user_id, position, limit)),
+        _alist(_celebrities(user_id)),
+    )
+    if celebrity_ids:
+        keys += await sync_to_async(_pulled_keys)(celebrity_ids, position, limit)
+
+    keys, next_cursor = _merge(keys, limit)
+    return _in_order(keys, await sync_to_async(_posts_for)(keys)), next_cursor
+
+
+async def _alist(queryset):
+    return [row async for row in queryset]
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+# Django's password hashers with their cost read from settings, so the cost can
+# be tuned per deployment without a code change. A stored hash made with other
+# parameters still verifies, and is rehashed with the current ones on the
+# user's next login (see api/login.py). Each keeps Django's algorithm name, so
+# hashes written by the stock hashers are understood as well.
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    # Memory-hard, and needs nothing beyond the standard library: each hash
+    # fills 128 * work_factor * block_size bytes (16 MiB with the defaults)
+
+    @property
+    def work_factor(self):
+        return settings.PASSWORD_SCRYPT_WORK_FACTOR
+
+    @property
+    def block_size(self):
+        return settings.PASSWORD_SCRYPT_BLOCK_SIZE
+
+    @property
+    def parallelism(self):
+        return settings.PASSWORD_SCRYPT_PARALLELISM
+
+    # OpenSSL refuses to use more than 32 MiB unless told otherwise. This is
+    # only a cap, and it must also fit hashes stored with a higher cost.
+    maxmem = 2 ** 30
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    # Memory-hard; requires the argon2-cffi package
+
+    @property
+    def time_cost(self):
+        return settings.PASSWORD_ARGON2_TIME_COST
+
+    @property
+    def memory_cost(self):
+        return settings.PASSWORD_ARGON2_MEMORY_COST
+
+    @property
+    def parallelism(self):
+        return settings.PASSWORD_ARGON2_PARALLELISM
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    # Django's default, CPU-bound only
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_PBKDF2_ITERATIONS
@@ -0,0 +1,76 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import sharding
+from .models import AppliedKey
+
+# Exactly-once effects for the tasks that add to counters. The database task
+# backend runs jobs at least once: a worker that dies after a job's writes
+# commit but before the job is marked done leaves it to run again. Such tasks
+# get their job's key with each event (see api/tasks.py) and apply the events
+# through apply_once(), on the database holding their effect. It records the
+# keys there in the transaction applying the events, and leaves out the events
+# whose key it had seen, so the events of a job that runs twice are only
+# applied once.
+#
+# Keys are forgotten TASK_KEY_TTL seconds after they were applied, long after
+# the lease and the retries of their job are over. Each process deletes the
+# expired keys of a database at most every SWEEP_INTERVAL seconds.
+
+SWEEP_INTERVAL = 60
+
+# Keys written per statement by fresh()
+RECORD_BATCH_SIZE = 500
+
+_swept_at = {}
+
+
+def _quote(name):
+    return connections['default'].ops.quote_name(name)
+
+
+def fresh(keys, using='default'):
+    # Records keys on using and returns the set of those not recorded before
+    if not keys:
+        return set()
+    _sweep(using)
+    connection = connections[using]
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    table, column = _quote(AppliedKey._meta.db_table), _quote('key')
+    keys = list(dict.fromkeys(keys))
+    new = set()
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), RECORD_BATCH_SIZE):
+            batch = keys[start:start + RECORD_BATCH_SIZE]
+            cursor.execute(
+                f'INSERT INTO {table} ({column}, {_quote("applied_at")}) VALUES {", ".join(["(%s, %s)"] * len(batch))} '
+                f'ON CONFLICT DO NOTHING RETURNING {column}',
+                [param for key in batch for param in (key, now)],
+            )
+            new.update(row[0] for row in cursor.fetchall())
+    return new
+
+
+def apply_once(events, apply, using='default'):
+    # Calls apply with the events whose key, their last item, is None or was
+    # not recorded on using before, and returns what it returns. Events without
+    # a key need no transaction.
+    keys = [event[-1] for event in events if event[-1] is not None]
+    if not keys:
+        return apply(events)
+    with transaction.atomic(using=using):
+        new = fresh(keys, using)
+        return apply([event for event in events if event[-1] is None or event[-1] in new])
+
+
+def _sweep(using):
+    now = time.monotonic()
+    if now - _swept_at.get(using, float('-inf')) < SWEEP_INTERVAL:
+        return
+    _swept_at[using] = now
+    cutoff = timezone.now() - timedelta(seconds=settings.TASK_KEY_TTL)
+    sharding.using(AppliedKey.objects, using).filter(applied_at__lt=cutoff).delete()
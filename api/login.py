@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.crypto import salted_hmac
+
+from .auth import LRUCache
+from .models import User
+
+# Credential checks of the authenticate endpoint.
+#
+# Password hashes are computed on a bounded pool of PASSWORD_HASH_WORKERS
+# threads (hashlib releases the GIL while it hashes), with at most
+# PASSWORD_HASH_QUEUE more waiting. A login surge therefore occupies only that
+# many cores, and logins beyond it are refused with LoginBusy straight away
+# instead of tying up every request thread. The database reads and writes stay
+# on the request's thread.
+#
+# A successful check is remembered for LOGIN_CACHE_TTL seconds, keyed by an
+# HMAC of the username and password and tied to the stored hash, so a client
+# logging in again with the same credentials costs one indexed read instead of
+# a hash. Changing the password changes the stored hash, which ends the entry.
+# Failed checks are never remembered.
+
+
+class LoginBusy(Exception):
+    pass
+
+
+class HashPool:
+    def __init__(self, workers, queue):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue)
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise LoginBusy
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+
+@lru_cache(maxsize=None)
+def get_pool():
+    return HashPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_QUEUE)
+
+
+@receiver(setting_changed)
+def reset_pool(setting, **kwargs):
+    if setting in ('PASSWORD_HASH_WORKERS', 'PASSWORD_HASH_QUEUE'):
+        get_pool.cache_clear()
+
+
+verified = LRUCache(settings.LOGIN_CACHE_SIZE)
+
+
+def _cache_key(username, password):
+    return salted_hmac('api.login', f'{username}\0{password}', algorithm='sha256').digest()
+
+
+def _check(password, encoded):
+    # Runs on the pool. Returns whether the password matches, and whether its
+    # hash should be redone with the preferred hasher and its current cost.
+    rehash = []
+    return check_password(password, encoded, setter=rehash.append), bool(rehash)
+
+
+def _users(username):
+    return User._default_manager.filter(**{User.USERNAME_FIELD: username}).only('id', 'username', 'password', 'is_active')
+
+
+def authenticate(username, password):
+    # Returns the active user with these credentials, or None. Raises LoginBusy
+    # when the hash pool is full.
+    pool = get_pool()
+    user = _users(username).first()
+    if user is None:
+        # Hash anyway, so an unknown username takes as long as a wrong password
+        pool.run(make_password, password)
+        return None
+    key = _cache_key(username, password)
+    if verified.get(key) != user.password:
+        correct, rehash = pool.run(_check, password, user.password)
+        if not correct:
+            return None
+        if rehash:
+            user.password = pool.run(make_password, password)
+            user.save(update_fields=['password'])
+        verified.set(key, user.password, time.time() + settings.LOGIN_CACHE_TTL)
+    return user if user.is_active else None
+
+
+async def aauthenticate(username, password):
+    pool = get_pool()
+    user = await _users(username).afirst()
+    if user is None:
+        await pool.arun(make_password, password)
+        return None
+    key = _cache_key(username, password)
+    if verified.get(key) != user.password:
+        correct, rehash = await pool.arun(_check, password, user.password)
+        if not correct:
+            return None
+        if rehash:
+            user.password = await pool.arun(make_password, password)
+            await user.asave(update_fields=['password'])
+        verified.set(key, user.password, time.time() + settings.LOGIN_CACHE_TTL)
+    return user if user.is_active else None
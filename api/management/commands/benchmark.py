@@ -0,0 +1,26 @@
+import json
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import SUITES
+
+
+class Command(BaseCommand):
+    help = 'Run a benchmark suite against the configured database and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for reproducible runs')
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+        suites = parser.add_subparsers(dest='suite', required=True)
+        for name, path in SUITES.items():
+            import_module(path).add_arguments(suites.add_parser(name))
+
+    def handle(self, *args, **options):
+        report = import_module(SUITES[options['suite']]).run(options, self.stderr)
+        report = {'suite': options['suite'], 'seed': options['seed'], **report}
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of posts and comments from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of posts reindexed per statement')
+
+    def handle(self, *args, **options):
+        try:
+            search.rebuild(options['batch_size'])
+        except search.SearchUnavailable as e:
+            raise CommandError(f'Search is not available on {e} databases')
+        self.stdout.write('Search index rebuilt')
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from api.models import User, Post, Comment
+from api.pagination import id_ranges
+
+Follow = User.followers.through
+Like = Post.likes.through
+
+
+def count_of(queryset, field):
+    # Correlated COUNT(*) of the rows in queryset whose `field` points at the outer row
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts), Value(0))
+
+
+COUNTERS = [
+    (User, 'followers_count', lambda: count_of(Follow.objects.all(), 'from_user')),
+    (User, 'following_count', lambda: count_of(Follow.objects.all(), 'to_user')),
+    (Post, 'likes_count', lambda: count_of(Like.objects.all(), 'post')),
+    (Post, 'comments_count', lambda: count_of(Comment.objects.all(), 'post')),
+]
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized follower, following, like and comment counters and fix any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of rows recounted per UPDATE statement')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model, field, expression in COUNTERS:
+            fixed = 0
+            # Posts are counted on each shard, against the likes and comments
+            # stored with them
+            for alias in settings.SHARDS if model is Post else ['default']:
+                objects = model.objects.using(alias)
+                # Walk the table in primary key ranges so no single statement holds
+                # row locks on the whole table; only rows that drifted are written
+                for start, end in id_ranges(objects, batch_size):
+                    rows = objects.filter(id__gt=start, id__lte=end)
+                    fixed += rows.exclude(**{field: expression()}).update(**{field: expression()})
+            self.stdout.write(f'{model.__name__}.{field}: fixed {fixed} rows')
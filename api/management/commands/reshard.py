@@ -0,0 +1,180 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from api import cache, search, sharding
+from api.models import Comment, Notification, Post, PostLike, TimelineEntry, TrendingScore
+from api.pagination import id_ranges
+
+# Moves the post store onto a new list of shard aliases (see api/sharding.py).
+#
+# First, posts whose id does not carry their author's logical shard, such as
+# those written before the store was sharded, get a new id in place, along with
+# every row pointing at them; comments are renumbered the same way. Then the
+# rows of every logical shard whose alias changes are copied to the new alias
+# and deleted from the old one, one batch of posts at a time. A batch is copied
+# before it is deleted and copies skip rows already present, so an interrupted
+# run is finished by running the command again.
+#
+# Writes to the posts being moved are lost, so run it with the API stopped,
+# then set SHARDS to the list it prints.
+
+# Tables holding a post id, other than api_post itself, on the post's shard
+POST_REFERENCES = [(Comment, 'post'), (PostLike, 'post'), (TrendingScore, 'post')]
+
+# Tables holding a post id on 'default', whatever the post's shard
+DEFAULT_POST_REFERENCES = [(TimelineEntry, 'post'), (Notification, 'post_id')]
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def _column(model, field):
+    return _quote(model._meta.get_field(field).column)
+
+
+def _renumber(alias, model, field, ids):
+    # ids is a list of (old, new) values of model.field
+    table, column = _quote(model._meta.db_table), _column(model, field)
+    with connections[alias].cursor() as cursor:
+        cursor.executemany(f'UPDATE {table} SET {column} = %s WHERE {column} = %s', [(new, old) for old, new in ids])
+
+
+def _copy(model, source, target, field, ids):
+    # INSERT the rows whose field is in ids from source into target, leaving
+    # out rows already there. Likes are numbered by each database, so their
+    # ids are not copied; post and comment ids are the same everywhere.
+    fields = [f for f in model._meta.concrete_fields if not (model is PostLike and f.primary_key)]
+    rows = model.objects.using(source).filter(**{f'{field}__in': ids}).values_list(*[f.attname for f in fields])
+    target_connection = connections[target]
+    values = [[f.get_db_prep_save(value, target_connection) for f, value in zip(fields, row)] for row in rows]
+    if values:
+        columns = ', '.join(_quote(f.column) for f in fields)
+        placeholders = ', '.join(['%s'] * len(fields))
+        with target_connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {_quote(model._meta.db_table)} ({columns}) VALUES ({placeholders}) ON CONFLICT DO NOTHING',
+                values,
+            )
+
+
+def _delete(model, alias, field, ids):
+    # A plain DELETE: the post_delete receivers would also clear the timelines
+    # and the leaderboard of posts that are only moving
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {_quote(model._meta.db_table)} WHERE {_column(model, field)} IN ({", ".join(["%s"] * len(ids))})',
+            list(ids),
+        )
+
+
+def _created_ms(created_at):
+    return max(int(created_at.timestamp() * 1000), sharding.ID_EPOCH_MS)
+
+
+class Command(BaseCommand):
+    help = 'Move posts, comments, likes and trending scores onto a new list of shard databases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shards', nargs='+', help="New value of SHARDS: database aliases, usually starting with 'default'")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of posts renumbered or moved per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the posts and comments that would be renumbered or moved')
+
+    def handle(self, *args, **options):
+        shards = options['shards']
+        unknown = [alias for alias in shards if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f'Unknown database aliases: {", ".join(unknown)}')
+        if len(set(shards)) != len(shards):
+            raise CommandError('Each database can appear only once')
+        if set(shards) & set(settings.DATABASE_REPLICAS):
+            raise CommandError('Replicas cannot hold shards')
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+
+        for alias in settings.SHARDS:
+            self.renumber_posts(alias)
+            self.renumber_comments(alias)
+        for alias in settings.SHARDS:
+            self.move(alias, shards)
+        self.stdout.write(f'Set SHARDS = {shards!r}')
+
+    def renumber_posts(self, alias):
+        renumbered = 0
+        for start, end in id_ranges(Post.objects.using(alias), self.batch_size):
+            rows = Post.objects.using(alias).filter(id__gt=start, id__lte=end).values_list('id', 'author_id', 'created_at')
+            ids = [
+                (id, sharding.make_id(sharding.logical_shard_of_user(author_id), _created_ms(created_at)))
+                for id, author_id, created_at in rows
+                if sharding.logical_shard_of_id(id) != sharding.logical_shard_of_user(author_id)
+            ]
+            renumbered += len(ids)
+            if not ids or self.dry_run:
+                continue
+            # The foreign keys to api_post are checked at commit, by which time
+            # every reference has been renumbered too
+            with transaction.atomic(using=alias), transaction.atomic():
+                _renumber(alias, Post, 'id', ids)
+                for model, field in POST_REFERENCES:
+                    _renumber(alias, model, field, ids)
+                backend = search.get_backend()
+                if backend is not None:
+                    with connections[alias].cursor() as cursor:
+                        backend.renumber(cursor, ids)
+                for model, field in DEFAULT_POST_REFERENCES:
+                    _renumber('default', model, field, ids)
+            cache.invalidate_post(*[old for old, _ in ids])
+        self.stdout.write(f'{alias}: renumbered {renumbered} posts')
+
+    def renumber_comments(self, alias):
+        renumbered = 0
+        for start, end in id_ranges(Comment.objects.using(alias), self.batch_size):
+            rows = Comment.objects.using(alias).filter(id__gt=start, id__lte=end).values_list('id', 'post_id', 'created_at')
+            ids = [
+                (id, sharding.make_id(sharding.logical_shard_of_id(post_id), _created_ms(created_at)))
+                for id, post_id, created_at in rows
+                if sharding.logical_shard_of_id(id) != sharding.logical_shard_of_id(post_id)
+            ]
+            renumbered += len(ids)
+            if ids and not self.dry_run:
+                with transaction.atomic(using=alias):
+                    _renumber(alias, Comment, 'id', ids)
+        self.stdout.write(f'{alias}: renumbered {renumbered} comments')
+
+    def move(self, source, shards):
+        moved = defaultdict(int)
+        for start, end in id_ranges(Post.objects.using(source), self.batch_size):
+            targets = defaultdict(list)
+            for id in Post.objects.using(source).filter(id__gt=start, id__lte=end).values_list('id', flat=True):
+                target = sharding.for_post(id, shards)
+                if target != source:
+                    targets[target].append(id)
+            for target, ids in targets.items():
+                moved[target] += len(ids)
+                if not self.dry_run:
+                    self.move_posts(source, target, ids)
+        for target, count in moved.items():
+            self.stdout.write(f'{source}: moved {count} posts to {target}')
+
+    def move_posts(self, source, target, ids):
+        backend = search.get_backend()
+        with transaction.atomic(using=target):
+            _copy(Post, source, target, 'id', ids)
+            for model, field in POST_REFERENCES:
+                _copy(model, source, target, field, ids)
+            if backend is not None:
+                with connections[source].cursor() as source_cursor, connections[target].cursor() as target_cursor:
+                    backend.copy(source_cursor, target_cursor, ids)
+        with transaction.atomic(using=source):
+            if backend is not None:
+                with connections[source].cursor() as cursor:
+                    for id in ids:
+                        backend.remove(cursor, id)
+            for model, field in POST_REFERENCES:
+                _delete(model, source, field, ids)
+            _delete(Post, source, 'id', ids)
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run the jobs queued in the database by api.tasks.DatabaseBackend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.TASK_WORKERS,
+                            help='Number of threads claiming and running jobs')
+        parser.add_argument('--batch-size', type=int, default=settings.TASK_BATCH_SIZE,
+                            help='Number of jobs claimed at a time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before looking again when no job is due')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs that are due, then exit')
+
+    def handle(self, *args, **options):
+        backend = tasks.DatabaseBackend()
+        if options['once']:
+            count = backend.run_pending(options['batch_size'])
+            self.stdout.write(f'Ran {count} jobs, pruned {backend.prune()}')
+            return
+        threads = [
+            threading.Thread(target=self.work, args=(backend, options), name=f'api-task-{i}', daemon=True)
+            for i in range(options['threads'])
+        ]
+        for thread in threads:
+            thread.start()
+        # Finished jobs are pruned by the main thread, once per key lifetime
+        while True:
+            time.sleep(settings.TASK_KEY_TTL)
+            backend.prune()
+            close_old_connections()
+
+    def work(self, backend, options):
+        while True:
+            count = backend.run_batch(options['batch_size'])
+            close_old_connections()
+            if not count:
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,75 @@
+import bisect
+import threading
+
+# In-process request histograms, rendered in the Prometheus text format by the
+# metrics endpoint. Every worker process keeps its own counts.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+METRICS = {
+    'api_request_duration_seconds': ('Wall time spent handling the request', DURATION_BUCKETS),
+    'api_request_db_duration_seconds': ('Time spent in database queries while handling the request', DURATION_BUCKETS),
+    'api_request_db_queries': ('Number of database queries run while handling the request', QUERY_BUCKETS),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, metric, view):
+        key = (metric, view)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(METRICS[metric][1]))
+        return histogram
+
+    def observe_request(self, view, duration, queries, db_duration):
+        self.histogram('api_request_duration_seconds', view).observe(duration)
+        self.histogram('api_request_db_duration_seconds', view).observe(db_duration)
+        self.histogram('api_request_db_queries', view).observe(queries)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+        for metric, (help, buckets) in METRICS.items():
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} histogram')
+            views = sorted(view for name, view in list(self.histograms) if name == metric)
+            for view in views:
+                counts, total = self.histograms[(metric, view)].snapshot()
+                label = view.replace('\\', '\\\\').replace('"', '\\"')
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{view="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{view="{label}"}} {total}')
+                lines.append(f'{metric}_count{{view="{label}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
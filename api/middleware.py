@@ -0,0 +1,193 @@
+import heapq
+import json
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from .auth import TokenError, get_request_user_id
+from .metrics import registry
+from .routers import RouteState, current_route, is_pinned, pin
+
+logger = logging.getLogger('api.metrics')
+
+
+class QueryRecorder:
+    # Execute wrapper that times every query. It keeps only a count, a running
+    # total, the few slowest statements and a counter per SQL template, so it is
+    # cheap enough to leave on in production.
+
+    def __init__(self, keep_slowest):
+        self.count = 0
+        self.duration = 0
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+        self.templates = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.duration += elapsed
+            # Queries that differ only in their parameters share a template; the
+            # same query run once on each shard is not a repeat
+            self.templates[context['connection'].alias, sql] += 1
+            entry = (elapsed, self.count, sql)
+            if len(self.slowest) < self.keep_slowest:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def duplicates(self, threshold):
+        return [(sql, n) for (_, sql), n in self.templates.most_common() if n >= threshold]
+
+
+# The recorder of the request being handled. A context variable rather than a
+# per-request execute_wrapper() block, because async views run their queries on
+# other threads' connections; sync_to_async copies the context over to them.
+current_recorder = ContextVar('api_query_recorder', default=None)
+
+
+def record_queries(execute, sql, params, many, context):
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_recorder(connection, **kwargs):
+    # connection_created receiver, also called for connections that were
+    # already open when the first request came in
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_queries)
+
+
+class RequestMetricsMiddleware:
+    # Records wall time, query count and database time per request. The numbers
+    # are exposed as a Server-Timing header, a JSON log line on the api.metrics
+    # logger and the per-view histograms served by the metrics endpoint.
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        for connection in connections.all():
+            install_recorder(connection)
+        recorder = QueryRecorder(settings.API_METRICS_SLOW_QUERIES)
+        token = current_recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        return self.finish(request, response, recorder, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder(settings.API_METRICS_SLOW_QUERIES)
+        token = current_recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        return self.finish(request, response, recorder, time.perf_counter() - start)
+
+    def finish(self, request, response, recorder, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else '<unresolved>'
+        registry.observe_request(view, duration, recorder.count, recorder.duration)
+
+        response['Server-Timing'] = (
+            f'app;dur={duration * 1000:.2f}, '
+            f'db;dur={recorder.duration * 1000:.2f};desc="{recorder.count} queries"'
+        )
+
+        duplicates = recorder.duplicates(settings.API_METRICS_DUPLICATE_THRESHOLD)
+        if logger.isEnabledFor(logging.INFO) or duplicates:
+            record = {
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2),
+                'db_queries': recorder.count,
+                'db_ms': round(recorder.duration * 1000, 2),
+                'slowest': [{'ms': round(elapsed * 1000, 2), 'sql': sql} for elapsed, _, sql in sorted(recorder.slowest, reverse=True)],
+            }
+            if duplicates:
+                # The same statement run over and over in one request usually means an N+1 loop
+                record['duplicates'] = [{'count': n, 'sql': sql} for sql, n in duplicates]
+                logger.warning(json.dumps(record))
+            else:
+                logger.info(json.dumps(record))
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    # Lets the reads of GET and HEAD requests go to the read replicas (see
+    # api/routers.py), unless the client wrote within REPLICA_PIN_SECONDS, and
+    # pins clients whose request wrote: one that went through the router, or
+    # any successful request of another method, since some writes are raw SQL
+    # on the primary's connection. Does nothing without DATABASE_REPLICAS.
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        user_id, state = self.start(request)
+        token = current_route.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_route.reset(token)
+        self.finish(request, response, user_id, state)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return await self.get_response(request)
+        user_id, state = self.start(request)
+        token = current_route.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_route.reset(token)
+        self.finish(request, response, user_id, state)
+        return response
+
+    def start(self, request):
+        try:
+            user_id = get_request_user_id(request)
+        except TokenError:
+            user_id = None
+        read_only = request.method in ('GET', 'HEAD') and (user_id is None or not is_pinned(user_id))
+        return user_id, RouteState(read_only)
+
+    def finish(self, request, response, user_id, state):
+        if user_id is None:
+            return
+        if state.wrote or (request.method not in ('GET', 'HEAD') and response.status_code < 400):
+            pin(user_id)
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+# Creates and fills the full-text index used by api/search.py. The table has
+# no model: its layout depends on the database vendor.
+
+POSTGRES = [
+    'CREATE TABLE api_post_search ('
+    ' post_id bigint PRIMARY KEY REFERENCES api_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,'
+    ' document tsvector NOT NULL)',
+    'CREATE INDEX api_post_search_document_idx ON api_post_search USING GIN (document)',
+    "INSERT INTO api_post_search (post_id, document) "
+    "SELECT p.id, setweight(to_tsvector('english', p.title), 'A') || setweight(to_tsvector('english', p.content), 'B') "
+    "|| setweight(to_tsvector('english', coalesce((SELECT string_agg(c.content, ' ') FROM api_comment c WHERE c.post_id = p.id), '')), 'C') "
+    "FROM api_post p",
+]
+
+SQLITE = [
+    "CREATE VIRTUAL TABLE api_post_search USING fts5(title, content, comments, tokenize = 'porter unicode61')",
+    "INSERT INTO api_post_search (rowid, title, content, comments) "
+    "SELECT p.id, p.title, p.content, coalesce((SELECT group_concat(c.content, ' ') FROM api_comment c WHERE c.post_id = p.id), '') "
+    "FROM api_post p",
+]
+
+
+def create_index(apps, schema_editor):
+    statements = {'postgresql': POSTGRES, 'sqlite': SQLITE}.get(schema_editor.connection.vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP TABLE api_post_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_follow_postlike_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 05:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppliedKey',
+            fields=[
+                ('key', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('applied_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='appliedkey',
+            index=models.Index(fields=['applied_at'], name='appliedkey_applied_at_idx'),
+        ),
+    ]
@@ -38,7 +38,10 @@ class User(AbstractBaseUser):
     password = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
-    followers = models.ManyToManyField('self', symmetrical=False, related_name='following', blank=True)
+    followers = models.ManyToManyField('self', through='Follow', symmetrical=False, related_name='following', blank=True)
+    # Denormalized counters, kept in sync by the views; see the recount_counters command
+    followers_count = models.IntegerField(default=0, db_index=True)
+    following_count = models.IntegerField(default=0)
 
     objects = UserManager()
 
@@ -57,6 +60,24 @@ class User(AbstractBaseUser):
     @property
     def is_staff(self):
         return self.is_admin
+
+
+class Follow(models.Model):
+    # Through table of User.followers: to_user follows from_user. Same table and
+    # columns as the table Django generated before the model was made explicit.
+    # The unique constraint serves lookups by from_user (the followers of a user);
+    # the covering index serves lookups by to_user (the accounts a user follows).
+    from_user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='+', db_index=False)
+    to_user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='+', db_index=False)
+
+    class Meta:
+        db_table = 'api_user_followers'
+        constraints = [
+            models.UniqueConstraint(fields=['from_user', 'to_user'], name='follow_from_to_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['to_user', 'from_user'], name='follow_to_from_idx'),
+        ]
     
 
 
@@ -65,19 +86,148 @@ User = get_user_model()
 class Post(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
-    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
+    # Indexed through post_author_created_idx, which leads with the author.
+    # Posts, comments and likes may live on another database than the users
+    # (see api/sharding.py), so their foreign keys to users and timeline rows'
+    # foreign keys to posts have no database constraint; deletions still
+    # cascade through Django.
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts', db_index=False, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    likes = models.ManyToManyField(User, related_name='liked_posts', blank=True)
+    likes = models.ManyToManyField(User, through='PostLike', related_name='liked_posts', blank=True)
+    likes_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of an author's posts, newest first
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_created_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+class PostLike(models.Model):
+    # Through table of Post.likes, laid out like Follow: the unique constraint
+    # serves the likers of a post, the covering index the posts a user liked
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='like_rows', db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False, db_constraint=False)
+
+    class Meta:
+        db_table = 'api_post_likes'
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'user'], name='postlike_post_user_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'post'], name='postlike_user_post_idx'),
+        ]
+
 class Comment(models.Model):
-    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
-    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed through comment_post_created_idx
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments', db_index=False)
+    author = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of a post's comments, oldest first
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+        ]
+
     def __str__(self):
-        return f"{self.post.title} - {self.author.username}"
\ No newline at end of file
+        return f"{self.post.title} - {self.author.username}"
+
+class TimelineEntry(models.Model):
+    # Materialized home timeline: one row per post fanned out to a follower
+    # Indexed through timeline_owner_created_idx
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    post_created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'post'], name='timeline_owner_post_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-post_created_at', '-post'], name='timeline_owner_created_idx'),
+        ]
+
+class TrendingScore(models.Model):
+    # Time-decayed engagement of a post, maintained by api/trending.py. score is
+    # stored relative to the start of epoch, so rows of one epoch compare directly.
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    epoch = models.IntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            # Backs reading the best posts of an epoch
+            models.Index(fields=['epoch', '-score', '-post'], name='trending_epoch_score_idx'),
+        ]
+
+class Job(models.Model):
+    # Deferred work queued by the database task backend and run by
+    # manage.py run_tasks; see api/tasks.py
+    QUEUED, DONE, FAILED = 0, 1, 2
+
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list)
+    # Idempotency key: a job whose key is already queued or recently done is
+    # not queued again
+    key = models.CharField(max_length=200, null=True, unique=True)
+    status = models.SmallIntegerField(default=QUEUED)
+    # When a queued job may next run, past the lease of the worker running it;
+    # when a done job finished
+    run_at = models.DateTimeField()
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Backs claiming the jobs that are due, and pruning finished ones
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+class Notification(models.Model):
+    # One row of a user's activity stream, maintained by api/notifications.py.
+    # Likes, comments and follows are coalesced as they are written: every
+    # event of a kind about the same post (or, for follows, the same recipient)
+    # within one NOTIFICATION_WINDOW adds to the same row.
+    LIKE, COMMENT, FOLLOW = 'like', 'comment', 'follow'
+
+    # Indexed through notification_group_unique and notification_recipient_idx
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_index=False)
+    kind = models.CharField(max_length=10)
+    # The liked or commented post, which may be on another shard; 0 for follows
+    post_id = models.BigIntegerField(default=0)
+    # Start (in seconds since the Unix epoch) of the window the events fell in
+    bucket = models.IntegerField()
+    # The latest of the count users behind the events
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    count = models.IntegerField(default=1)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'kind', 'post_id', 'bucket'], name='notification_group_unique'),
+        ]
+        indexes = [
+            # Backs reading a user's stream, latest activity first
+            models.Index(fields=['recipient', '-updated_at', '-id'], name='notification_recipient_idx'),
+            # Backs clearing the notifications of a deleted post
+            models.Index(fields=['post_id'], name='notification_post_idx'),
+        ]
+
+class AppliedKey(models.Model):
+    # Job key of an event a counting task has applied, on the database holding
+    # its effect; see api/idempotency.py
+    key = models.CharField(max_length=200, primary_key=True)
+    applied_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Backs forgetting the expired keys
+            models.Index(fields=['applied_at'], name='appliedkey_applied_at_idx'),
+        ]
@@ -0,0 +1,120 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import idempotency
+from .models import Notification, Post, User
+
+# Activity stream telling users about likes on and comments to their posts and
+# about new followers, in the api_notification table.
+#
+# Events are coalesced when they are written rather than when they are read:
+# time is cut into NOTIFICATION_WINDOW long buckets, and every event of a kind
+# about the same post (or, for follows, the same recipient) within one bucket
+# adds to a single row, which counts the users behind them and keeps the
+# latest one. A post liked by 251 users in an afternoon is one row reading "X
+# and 250 others liked your post", not 251 rows. record() merges the events it
+# is given, then upserts one row per group in a single statement; the write
+# endpoints reach it through the batch task 'notify', so a burst is merged in
+# the worker first.
+
+# Groups written per statement by record()
+RECORD_BATCH_SIZE = 500
+
+VERBS = {
+    Notification.LIKE: 'liked your post',
+    Notification.COMMENT: 'commented on your post',
+    Notification.FOLLOW: 'started following you',
+}
+
+
+def current_bucket(now):
+    return int(now // settings.NOTIFICATION_WINDOW * settings.NOTIFICATION_WINDOW)
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def _column(field):
+    return _quote(Notification._meta.get_field(field).column)
+
+
+def _upsert(rows):
+    # rows are (recipient id, kind, post id, bucket, actor id, count, at); a row
+    # whose group already exists adds its count and becomes the latest activity.
+    # A single actor who already is the group's latest is not counted again.
+    table = _quote(Notification._meta.db_table)
+    columns = ['recipient', 'kind', 'post_id', 'bucket', 'actor', 'count', 'created_at', 'updated_at']
+    count, actor, updated_at = _column('count'), _column('actor'), _column('updated_at')
+    placeholders = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(rows))
+    sql = (
+        f'INSERT INTO {table} ({", ".join(_column(field) for field in columns)}) VALUES {placeholders} '
+        f'ON CONFLICT ({", ".join(_column(field) for field in columns[:4])}) DO UPDATE SET '
+        f'{count} = {table}.{count} + CASE WHEN EXCLUDED.{count} = 1 AND EXCLUDED.{actor} = {table}.{actor} THEN 0 ELSE EXCLUDED.{count} END, '
+        f'{actor} = EXCLUDED.{actor}, {updated_at} = EXCLUDED.{updated_at}'
+    )
+    params = []
+    for *row, at in rows:
+        at = connection.ops.adapt_datetimefield_value(at)
+        params.extend([*row, at, at])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def record(events, now=None):
+    # events is a list of (kind, recipient id, actor id, post id, key), the
+    # post id being 0 for follows and the key applying the event only once (see
+    # api/idempotency.py), or None. Events users cause themselves, and those of
+    # users deleted since, are dropped.
+    now = now or timezone.now()
+    idempotency.apply_once(events, lambda events: _record(events, now))
+
+
+def _record(events, now):
+    # Each group counts its distinct actors, the latest last: a user who likes,
+    # unlikes and likes a post again is one more liker, not two
+    groups = defaultdict(dict)
+    for kind, recipient_id, actor_id, post_id, _ in events:
+        if recipient_id != actor_id:
+            actors = groups[recipient_id, kind, post_id]
+            actors.pop(actor_id, None)
+            actors[actor_id] = True
+    if not groups:
+        return
+    user_ids = {recipient_id for recipient_id, _, _ in groups} | {actor_id for actors in groups.values() for actor_id in actors}
+    existing = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    bucket = current_bucket(now.timestamp())
+    rows = []
+    for (recipient_id, kind, post_id), actors in groups.items():
+        if recipient_id in existing:
+            actor_id = next(reversed(actors))
+            rows.append((recipient_id, kind, post_id, bucket, actor_id if actor_id in existing else None, len(actors), now))
+    for start in range(0, len(rows), RECORD_BATCH_SIZE):
+        _upsert(rows[start:start + RECORD_BATCH_SIZE])
+
+
+def describe(notification):
+    # "alice liked your post", "alice and 250 others liked your post"
+    actor = notification.actor.username if notification.actor is not None else 'Someone'
+    others = notification.count - 1
+    if others:
+        actor += f' and {others} other{"s" if others > 1 else ""}'
+    return f'{actor} {VERBS[notification.kind]}'
+
+
+def stream(user_id):
+    # The user's notifications, for keyset_paginate on updated_at
+    return Notification.objects.filter(recipient_id=user_id).select_related('actor').only(
+        'id', 'kind', 'post_id', 'count', 'created_at', 'updated_at', 'actor__id', 'actor__username',
+    )
+
+
+@receiver(post_delete, sender=Post)
+def remove_deleted_post(sender, instance, **kwargs):
+    # Notifications only hold the post id, on 'default', whatever the post's shard
+    Notification.objects.filter(post_id=instance.id, kind__in=[Notification.LIKE, Notification.COMMENT]).delete()
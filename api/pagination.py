@@ -0,0 +1,108 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+def pack_cursor(values):
+    # Opaque cursor holding a list of JSON values
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def unpack_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidPage('Invalid cursor')
+
+
+def encode_cursor(created_at, id):
+    return pack_cursor([created_at.isoformat(), id])
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, id = unpack_cursor(cursor)
+        created_at = parse_datetime(created_at)
+    except (ValueError, TypeError):
+        raise InvalidPage('Invalid cursor')
+    if created_at is None or not isinstance(id, int):
+        raise InvalidPage('Invalid cursor')
+    return created_at, id
+
+
+def get_page_size(request):
+    limit = request.GET.get('limit')
+    if limit is None:
+        return settings.API_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise InvalidPage('Invalid limit')
+    if limit < 1:
+        raise InvalidPage('Invalid limit')
+    return min(limit, settings.API_MAX_PAGE_SIZE)
+
+
+def seek(queryset, position, descending=True, time_field='created_at', id_field='id'):
+    # Seek past a (time, id) position rather than using OFFSET, so every page is
+    # a bounded index range scan no matter how deep it is
+    if position is not None:
+        created_at, last_id = position
+        op = 'lt' if descending else 'gt'
+        queryset = queryset.filter(
+            Q(**{f'{time_field}__{op}': created_at})
+            | Q(**{time_field: created_at, f'{id_field}__{op}': last_id})
+        )
+    prefix = '-' if descending else ''
+    return queryset.order_by(prefix + time_field, prefix + id_field)
+
+
+def get_position(request):
+    cursor = request.GET.get('cursor')
+    return decode_cursor(cursor) if cursor else None
+
+
+def _finish_page(page, limit, time_field, id_field):
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_cursor = encode_cursor(getattr(last, time_field), getattr(last, id_field))
+    return page, next_cursor
+
+
+def keyset_paginate(queryset, request, descending=True, time_field='created_at', id_field='id'):
+    limit = get_page_size(request)
+    queryset = seek(queryset, get_position(request), descending, time_field, id_field)
+    return _finish_page(list(queryset[:limit + 1]), limit, time_field, id_field)
+
+
+async def akeyset_paginate(queryset, request, descending=True, time_field='created_at', id_field='id'):
+    limit = get_page_size(request)
+    queryset = seek(queryset, get_position(request), descending, time_field, id_field)
+    return _finish_page([row async for row in queryset[:limit + 1]], limit, time_field, id_field)
+
+
+def id_ranges(queryset, batch_size):
+    # Yields (start, end] primary key ranges holding batch_size rows each, for
+    # jobs that walk a whole table. Ranges follow the ids that exist, so sparse
+    # ids (such as the sharded ids of api/sharding.py) cost no empty ranges.
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    start = 0
+    while True:
+        end = ids.filter(id__gt=start)[batch_size - 1:batch_size].first()
+        if end is None:
+            end = ids.filter(id__gt=start).order_by('-id').first()
+            if end is not None:
+                yield start, end
+            return
+        yield start, end
+        start = end
@@ -0,0 +1,153 @@
+from django.db import connection, connections, transaction
+from django.db.models import Exists, OuterRef
+
+from . import sharding
+from .models import User, Post
+
+Follow = User.followers.through
+Like = Post.likes.through
+
+
+class RelationshipsError(ValueError):
+    pass
+
+
+# Identifiers are quoted with the 'default' connection; every shard runs on the
+# same database vendor
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _column(model, field):
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def _exist(guards):
+    # WHERE condition that every (model, id) of guards exists, with its parameters
+    conditions = [f'EXISTS (SELECT 1 FROM {_table(model)} WHERE {_column(model, "id")} = %s)' for model, _ in guards]
+    return ' AND '.join(conditions), [id for _, id in guards]
+
+
+def _insert_link(through, source_field, source_id, target_field, target_id, guards, using='default'):
+    # INSERT ... ON CONFLICT DO NOTHING guarded by the existence of every
+    # (model, id) of guards, so a missing row neither raises nor leaves a
+    # dangling link. Returns whether a row was inserted.
+    condition, params = _exist(guards)
+    sql = (
+        f'INSERT INTO {_table(through)} ({_column(through, source_field)}, {_column(through, target_field)}) '
+        f'SELECT %s, %s WHERE {condition} '
+        f'ON CONFLICT DO NOTHING RETURNING {_column(through, "id")}'
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [source_id, target_id, *params])
+        return cursor.fetchone() is not None
+
+
+def insert_links(through, source_field, target_field, pairs, guards=(), using='default'):
+    # Many-row INSERT ... ON CONFLICT DO NOTHING of (source id, target id)
+    # pairs, inserting nothing unless every (model, id) of guards exists.
+    # Returns the pairs actually inserted: a pair another request wrote first is
+    # left out, so counters can be adjusted by exactly the rows written.
+    if not pairs:
+        return set()
+    source, target = _column(through, source_field), _column(through, target_field)
+    condition, params = _exist(guards) if guards else ('1 = 1', [])
+    sql = (
+        f'INSERT INTO {_table(through)} ({source}, {target}) '
+        f'SELECT * FROM (VALUES {", ".join(["(%s, %s)"] * len(pairs))}) links WHERE {condition} '
+        f'ON CONFLICT DO NOTHING RETURNING {source}, {target}'
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [*[id for pair in pairs for id in pair], *params])
+        return set(cursor.fetchall())
+
+
+def _delete_link(through, source_field, source_id, target_field, target_id, using='default'):
+    sql = (
+        f'DELETE FROM {_table(through)} WHERE {_column(through, source_field)} = %s AND {_column(through, target_field)} = %s '
+        f'RETURNING {_column(through, "id")}'
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [source_id, target_id])
+        return cursor.fetchone() is not None
+
+
+def _bump_likes(post_id, delta, using):
+    posts = Post.objects.db_manager(using).raw(
+        f'UPDATE {_table(Post)} SET {_column(Post, "likes_count")} = {_column(Post, "likes_count")} + %s '
+        f'WHERE {_column(Post, "id")} = %s RETURNING {_column(Post, "id")}, {_column(Post, "title")}, {_column(Post, "author")}, {_column(Post, "created_at")}',
+        [delta, post_id],
+    )
+    return list(posts)[0]
+
+
+def _bump_follows(follower_id, following_id, delta):
+    # Adjust both users' counters in one statement and return the followed user
+    followers_count = _column(User, 'followers_count')
+    following_count = _column(User, 'following_count')
+    id = _column(User, 'id')
+    users = User.objects.raw(
+        f'UPDATE {_table(User)} SET '
+        f'{followers_count} = {followers_count} + CASE WHEN {id} = %s THEN %s ELSE 0 END, '
+        f'{following_count} = {following_count} + CASE WHEN {id} = %s THEN %s ELSE 0 END '
+        f'WHERE {id} IN (%s, %s) RETURNING {id}, {_column(User, "username")}',
+        [following_id, delta, follower_id, delta, following_id, follower_id],
+    )
+    return next(user for user in users if user.id == following_id)
+
+
+# Each toggle is one write against the through table plus one counter update,
+# in a single transaction on the database holding the post (or the users). The
+# through table's unique constraint decides the outcome, so concurrent requests
+# cannot both succeed. They return the updated row, or None when the link
+# already existed (or did not exist, for removals) or the target row does not
+# exist.
+
+def like(post_id, user_id):
+    using = sharding.for_post(post_id)
+    with transaction.atomic(using=using):
+        if not _insert_link(Like, 'post', post_id, 'user', user_id, [(Post, post_id)], using):
+            return None
+        return _bump_likes(post_id, 1, using)
+
+
+def unlike(post_id, user_id):
+    using = sharding.for_post(post_id)
+    with transaction.atomic(using=using):
+        if not _delete_link(Like, 'post', post_id, 'user', user_id, using):
+            return None
+        return _bump_likes(post_id, -1, using)
+
+
+def follow(follower_id, following_id):
+    with transaction.atomic():
+        if not _insert_link(Follow, 'from_user', following_id, 'to_user', follower_id, [(User, following_id), (User, follower_id)]):
+            return None
+        return _bump_follows(follower_id, following_id, 1)
+
+
+def unfollow(follower_id, following_id):
+    with transaction.atomic():
+        if not _delete_link(Follow, 'from_user', following_id, 'to_user', follower_id):
+            return None
+        return _bump_follows(follower_id, following_id, -1)
+
+
+def parse_ids(data, max_ids):
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        raise RelationshipsError('Please provide a list of user ids')
+    if len(ids) > max_ids:
+        raise RelationshipsError(f'At most {max_ids} users can be looked up at once')
+    return list(dict.fromkeys(ids))
+
+
+def relationships(user_id, ids):
+    # The users among ids, annotated with whether user_id follows them and
+    # whether they follow user_id. One query: each user costs two EXISTS probes,
+    # one into the through table's unique constraint and one into its covering index.
+    return User.objects.filter(id__in=ids).annotate(
+        is_following=Exists(Follow.objects.filter(from_user_id=OuterRef('id'), to_user_id=user_id)),
+        is_followed_by=Exists(Follow.objects.filter(from_user_id=user_id, to_user_id=OuterRef('id'))),
+    ).only('id', 'username', 'followers_count', 'following_count')
@@ -0,0 +1,71 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoders for API response bodies. Every view renders through get_renderer(),
+# which is chosen by the API_RENDERER setting: orjson when it is installed,
+# the standard library otherwise. Both produce the same output by default.
+
+
+class StdlibRenderer:
+    def __init__(self):
+        self.encoder = DjangoJSONEncoder()
+
+    def render(self, data):
+        return self.encoder.encode(data).encode()
+
+
+class ORJSONRenderer:
+    # orjson encodes in C and returns bytes. Datetimes are passed back to
+    # DjangoJSONEncoder, which truncates them to milliseconds, so responses
+    # match the stdlib renderer; with API_JSON_NATIVE_DATETIMES orjson encodes
+    # them itself, keeping the microseconds.
+
+    def __init__(self, native_datetimes=None):
+        if orjson is None:
+            raise ImportError('ORJSONRenderer requires the orjson package')
+        if native_datetimes is None:
+            native_datetimes = settings.API_JSON_NATIVE_DATETIMES
+        self.default = DjangoJSONEncoder().default
+        if native_datetimes:
+            self.option = orjson.OPT_UTC_Z
+        else:
+            self.option = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def render(self, data):
+        return orjson.dumps(data, default=self.default, option=self.option)
+
+
+@lru_cache(maxsize=None)
+def get_renderer():
+    path = settings.API_RENDERER
+    if path is None:
+        return ORJSONRenderer() if orjson is not None else StdlibRenderer()
+    return import_string(path)()
+
+
+@receiver(setting_changed)
+def reset_renderer(setting, **kwargs):
+    if setting in ('API_RENDERER', 'API_JSON_NATIVE_DATETIMES'):
+        get_renderer.cache_clear()
+
+
+def render(data):
+    return get_renderer().render(data)
+
+
+class JsonResponse(HttpResponse):
+    # Drop-in for django.http.JsonResponse that encodes with the API renderer
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=render(data), **kwargs)
@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+
+from . import sharding
+from .models import Comment, Post, PostLike, TrendingScore
+
+# Read-replica routing. Reads go to one of the DATABASE_REPLICAS aliases only
+# while a read-only request is being handled (see ReplicaRoutingMiddleware in
+# api/middleware.py): a GET or HEAD from a client that has not written in the
+# last REPLICA_PIN_SECONDS. Everything else, including writes, reads in the
+# same request after a write, management commands and background threads, uses
+# the primary. A user whose request wrote is pinned to the primary for that
+# window, so their next reads see their own writes even on a lagging replica.
+# Pins are kept in the REPLICA_PIN_CACHE_ALIAS cache, shared by every worker
+# when it is Redis.
+
+
+class RouteState:
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+# The routing state of the request being handled. sync_to_async copies the
+# context to the threads async views run their queries on, and the state is
+# shared with them, so a write in one is seen by the next read.
+current_route = ContextVar('api_db_route', default=None)
+
+
+def _pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def is_pinned(user_id):
+    return caches[settings.REPLICA_PIN_CACHE_ALIAS].get(_pin_key(user_id)) is not None
+
+
+def pin(user_id):
+    caches[settings.REPLICA_PIN_CACHE_ALIAS].set(_pin_key(user_id), 1, settings.REPLICA_PIN_SECONDS)
+
+
+def check_replica(alias):
+    # Whether the replica answers, and on Postgres, whether it has replayed
+    # everything it received or is at most REPLICA_MAX_LAG seconds behind
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                )
+                return cursor.fetchone()[0] <= settings.REPLICA_MAX_LAG
+            cursor.execute('SELECT 1')
+            return True
+    except DatabaseError:
+        connection.close()
+        return False
+
+
+class ReplicaHealth:
+    # Result of the last check of each replica, redone after
+    # REPLICA_HEALTH_INTERVAL seconds by whichever request reads it next.
+    # Concurrent requests may both redo a check; no request waits for another.
+
+    def __init__(self):
+        self.checks = {}
+        self.lock = threading.Lock()
+
+    def healthy(self, aliases, now=None):
+        now = time.monotonic() if now is None else now
+        result = []
+        for alias in aliases:
+            checked_at, healthy = self.checks.get(alias, (None, False))
+            if checked_at is None or now - checked_at >= settings.REPLICA_HEALTH_INTERVAL:
+                healthy = check_replica(alias)
+                with self.lock:
+                    self.checks[alias] = (now, healthy)
+            if healthy:
+                result.append(alias)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.checks.clear()
+
+
+health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model in SHARDED_MODELS and sharding.is_sharded():
+            # Replicas only copy 'default'; see ShardRouter
+            return None
+        state = current_route.get()
+        if state is None or not state.use_replica:
+            return None
+        replicas = health.healthy(settings.DATABASE_REPLICAS)
+        if not replicas:
+            # Every replica is down or lagging; read from the primary
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = current_route.get()
+        if state is not None:
+            state.use_replica = False
+            state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+# Models whose rows live on the shard of their post; see api/sharding.py
+SHARDED_MODELS = {Post, Comment, PostLike, TrendingScore}
+
+
+class ShardRouter:
+    # Routes the rows of sharded models by the instance Django passes as a
+    # hint: saving or deleting one, or following a relation from one. Queries
+    # without an instance go to 'default' unless they name their shard with
+    # sharding.using(). Users reached from a sharded row are read from
+    # 'default', not from the row's shard.
+
+    def _route(self, model, instance):
+        if instance is None or not sharding.is_sharded():
+            return None
+        if model in SHARDED_MODELS:
+            if type(instance) not in SHARDED_MODELS:
+                return None
+            if instance._state.db is not None:
+                return instance._state.db
+            if isinstance(instance, Post):
+                return sharding.for_user(instance.author_id)
+            return sharding.for_post(instance.post_id)
+        if type(instance) in SHARDED_MODELS:
+            return 'default'
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
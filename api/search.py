@@ -0,0 +1,228 @@
+import heapq
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import sharding
+from .models import Post
+from .pagination import InvalidPage, get_page_size, id_ranges, pack_cursor, unpack_cursor
+
+# Full-text index over post titles, contents and comments, in the
+# api_post_search table created by migration 0002. On Postgres each row holds
+# a weighted tsvector behind a GIN index; on SQLite the table is an FTS5
+# virtual table keyed by the post id. The index is kept current by the write
+# paths (create_post, add_comment and batch comments) rather than rebuilt.
+# Each shard indexes its own posts, and a search ranks every shard's matches
+# and merges them.
+
+TABLE = 'api_post_search'
+
+# Words beyond this many are ignored, so one request cannot build a huge query
+MAX_TERMS = 10
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def get_terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+class Backend:
+    def renumber(self, cursor, ids):
+        # ids is a list of (old post id, new post id); see manage.py reshard
+        cursor.executemany(f'UPDATE {TABLE} SET {self.KEY} = %s WHERE {self.KEY} = %s', [(new, old) for old, new in ids])
+
+    @staticmethod
+    def _after(position):
+        # Keyset condition on the ranked rows, past the last (score, post id) seen
+        if position is None:
+            return '', []
+        score, post_id = position
+        return 'WHERE score < %s OR (score = %s AND post_id < %s)', [score, score, post_id]
+
+
+class PostgresBackend(Backend):
+    # Title, content and comments are weighted A, B and C for ts_rank_cd. Rows
+    # are removed by the ON DELETE CASCADE of the foreign key to api_post.
+    CONFIG = 'english'
+    KEY = 'post_id'
+
+    def index_post(self, cursor, post_id, title, content):
+        cursor.execute(
+            f'INSERT INTO {TABLE} (post_id, document) '
+            f"SELECT %s, setweight(to_tsvector('{self.CONFIG}', %s), 'A') || setweight(to_tsvector('{self.CONFIG}', %s), 'B') "
+            f'ON CONFLICT (post_id) DO NOTHING',
+            [post_id, title, content],
+        )
+
+    def index_comments(self, cursor, comments):
+        cursor.executemany(
+            f"UPDATE {TABLE} SET document = document || setweight(to_tsvector('{self.CONFIG}', %s), 'C') WHERE post_id = %s",
+            [(content, post_id) for post_id, content in comments],
+        )
+
+    def remove(self, cursor, post_id):
+        pass
+
+    def copy(self, source, target, post_ids):
+        # Copy the rows of post_ids from the source cursor's database to the target's
+        source.execute(f'SELECT post_id, document::text FROM {TABLE} WHERE post_id = ANY(%s)', [list(post_ids)])
+        target.executemany(
+            f'INSERT INTO {TABLE} (post_id, document) VALUES (%s, %s::tsvector) ON CONFLICT (post_id) DO NOTHING',
+            source.fetchall(),
+        )
+
+    def rebuild(self, cursor, start, end):
+        cursor.execute(
+            f'INSERT INTO {TABLE} (post_id, document) '
+            f"SELECT p.id, setweight(to_tsvector('{self.CONFIG}', p.title), 'A') || setweight(to_tsvector('{self.CONFIG}', p.content), 'B') "
+            f"|| setweight(to_tsvector('{self.CONFIG}', coalesce((SELECT string_agg(c.content, ' ') FROM api_comment c WHERE c.post_id = p.id), '')), 'C') "
+            f'FROM api_post p WHERE p.id > %s AND p.id <= %s '
+            f'ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document',
+            [start, end],
+        )
+
+    def search(self, cursor, terms, position, limit):
+        after, params = self._after(position)
+        cursor.execute(
+            f'SELECT post_id, score FROM ('
+            f'SELECT post_id, ts_rank_cd(document, query) AS score '
+            f"FROM {TABLE}, plainto_tsquery('{self.CONFIG}', %s) query WHERE document @@ query"
+            f') ranked {after} ORDER BY score DESC, post_id DESC LIMIT %s',
+            [' '.join(terms), *params, limit],
+        )
+        return cursor.fetchall()
+
+
+class SQLiteBackend(Backend):
+    # FTS5 ranks with bm25, where lower is better; it is negated so both
+    # backends order by descending score. Columns are weighted 10, 5 and 1.
+    KEY = 'rowid'
+
+    def index_post(self, cursor, post_id, title, content):
+        cursor.execute(f"INSERT INTO {TABLE} (rowid, title, content, comments) VALUES (%s, %s, %s, '')", [post_id, title, content])
+
+    def index_comments(self, cursor, comments):
+        cursor.executemany(
+            f"UPDATE {TABLE} SET comments = comments || ' ' || %s WHERE rowid = %s",
+            [(content, post_id) for post_id, content in comments],
+        )
+
+    def remove(self, cursor, post_id):
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [post_id])
+
+    def copy(self, source, target, post_ids):
+        # Copy the rows of post_ids from the source cursor's database to the
+        # target's, replacing any copied there before
+        placeholders = ', '.join(['%s'] * len(post_ids))
+        source.execute(f'SELECT rowid, title, content, comments FROM {TABLE} WHERE rowid IN ({placeholders})', list(post_ids))
+        rows = source.fetchall()
+        target.execute(f'DELETE FROM {TABLE} WHERE rowid IN ({placeholders})', list(post_ids))
+        target.executemany(f'INSERT INTO {TABLE} (rowid, title, content, comments) VALUES (%s, %s, %s, %s)', rows)
+
+    def rebuild(self, cursor, start, end):
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid > %s AND rowid <= %s', [start, end])
+        cursor.execute(
+            f'INSERT INTO {TABLE} (rowid, title, content, comments) '
+            f"SELECT p.id, p.title, p.content, coalesce((SELECT group_concat(c.content, ' ') FROM api_comment c WHERE c.post_id = p.id), '') "
+            f'FROM api_post p WHERE p.id > %s AND p.id <= %s',
+            [start, end],
+        )
+
+    def search(self, cursor, terms, position, limit):
+        after, params = self._after(position)
+        cursor.execute(
+            f'SELECT post_id, score FROM ('
+            f'SELECT rowid AS post_id, -bm25({TABLE}, 10.0, 5.0, 1.0) AS score FROM {TABLE} WHERE {TABLE} MATCH %s'
+            f') {after} ORDER BY score DESC, post_id DESC LIMIT %s',
+            [' '.join(f'"{term}"' for term in terms), *params, limit],
+        )
+        return cursor.fetchall()
+
+
+BACKENDS = {'postgresql': PostgresBackend(), 'sqlite': SQLiteBackend()}
+
+
+def get_backend():
+    return BACKENDS.get(connection.vendor)
+
+
+def index_post(post):
+    backend = get_backend()
+    if backend is not None:
+        with connections[sharding.for_post(post.id)].cursor() as cursor:
+            backend.index_post(cursor, post.id, post.title, post.content)
+
+
+def index_comments(comments):
+    # comments is a list of (post_id, content)
+    backend = get_backend()
+    if backend is None or not comments:
+        return
+    for alias, post_ids in sharding.group_by_shard({post_id for post_id, _ in comments}).items():
+        post_ids = set(post_ids)
+        with connections[alias].cursor() as cursor:
+            backend.index_comments(cursor, [comment for comment in comments if comment[0] in post_ids])
+
+
+@receiver(post_delete, sender=Post)
+def remove_deleted_post(sender, instance, using, **kwargs):
+    backend = get_backend()
+    if backend is not None:
+        with connections[using].cursor() as cursor:
+            backend.remove(cursor, instance.id)
+
+
+def rebuild(batch_size=10000, shards=None):
+    # Reindex every post of each shard, one primary key range per statement
+    backend = get_backend()
+    if backend is None:
+        raise SearchUnavailable(connection.vendor)
+    for alias in shards or settings.SHARDS:
+        with connections[alias].cursor() as cursor:
+            for start, end in id_ranges(Post.objects.using(alias), batch_size):
+                backend.rebuild(cursor, start, end)
+
+
+def _decode_position(cursor):
+    position = unpack_cursor(cursor)
+    if not isinstance(position, list) or len(position) != 2:
+        raise InvalidPage('Invalid cursor')
+    score, post_id = position
+    if not isinstance(score, (int, float)) or not isinstance(post_id, int):
+        raise InvalidPage('Invalid cursor')
+    return score, post_id
+
+
+def search(query, request):
+    # One page of the posts matching every word of the query, best match first,
+    # as (posts, next_cursor). The cursor holds the last (score, post id) seen.
+    backend = get_backend()
+    if backend is None:
+        raise SearchUnavailable(connection.vendor)
+    limit = get_page_size(request)
+    cursor = request.GET.get('cursor')
+    position = _decode_position(cursor) if cursor else None
+
+    # Every shard returns its best rows past the cursor in the same order, so
+    # the page is the best of their merge
+    terms = get_terms(query)
+    ranked = []
+    for alias in settings.SHARDS:
+        with connections[alias].cursor() as db:
+            ranked.append(backend.search(db, terms, position, limit + 1))
+    rows = list(heapq.merge(*ranked, key=lambda row: (-row[1], -row[0])))[:limit + 1] if len(ranked) > 1 else ranked[0]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        post_id, score = rows[-1]
+        next_cursor = pack_cursor([score, post_id])
+    posts = {}
+    for alias, post_ids in sharding.group_by_shard(post_id for post_id, _ in rows).items():
+        posts.update(sharding.with_authors(sharding.using(Post.objects, alias), alias).in_bulk(post_ids))
+    return [posts[post_id] for post_id, _ in rows if post_id in posts], next_cursor
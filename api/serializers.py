@@ -0,0 +1,72 @@
+from django.db.models import Prefetch
+
+from .models import User, Comment, PostLike
+from .notifications import describe
+from .sharding import with_authors
+
+
+def prefetch_posts(posts, alias='default'):
+    # Load comments (with their authors) and likers for a whole page of posts
+    # in a fixed number of queries instead of a few queries per post. Comments
+    # are ordered by post first so the read follows comment_post_created_idx
+    # instead of sorting. alias is the shard of the posts; on any but 'default'
+    # the users are read from 'default' with two more queries.
+    comments = with_authors(Comment.objects.order_by('post', 'created_at', 'id'), alias)
+    if alias == 'default':
+        likes = PostLike.objects.select_related('user').only('post', 'user__id', 'user__username')
+    else:
+        likes = PostLike.objects.prefetch_related(Prefetch('user', queryset=User.objects.only('id', 'username')))
+    return posts.prefetch_related(Prefetch('comments', queryset=comments), Prefetch('like_rows', queryset=likes))
+
+
+def serialize_post(post):
+    # Expects a post loaded through prefetch_posts, so no queries are issued here
+    return {
+        'id': post.id,
+        'title': post.title,
+        'description': post.content,
+        'created_at': post.created_at,
+        'comments': [serialize_comment(comment) for comment in post.comments.all()],
+        'likes': [{'id': like.user.id, 'username': like.user.username} for like in post.like_rows.all()],
+    }
+
+
+def serialize_feed_post(post):
+    # Expects a post loaded with select_related('author')
+    return {
+        'id': post.id,
+        'title': post.title,
+        'description': post.content,
+        'author': post.author.username,
+        'created_at': post.created_at,
+    }
+
+
+def serialize_relationship(user):
+    # Expects a user from relations.relationships()
+    return {
+        'id': user.id,
+        'username': user.username,
+        'following': user.is_following,
+        'followed_by': user.is_followed_by,
+        'followers_count': user.followers_count,
+        'following_count': user.following_count,
+    }
+
+
+def serialize_comment(comment):
+    return {'id': comment.id, 'author': comment.author.username, 'content': comment.content, 'created_at': comment.created_at}
+
+
+def serialize_notification(notification):
+    # Expects a notification from notifications.stream()
+    return {
+        'id': notification.id,
+        'kind': notification.kind,
+        'post_id': notification.post_id or None,
+        'actor': notification.actor.username if notification.actor is not None else None,
+        'count': notification.count,
+        'message': describe(notification),
+        'created_at': notification.created_at,
+        'updated_at': notification.updated_at,
+    }
@@ -0,0 +1,185 @@
+import itertools
+import random
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Comment, Post, PostLike, User
+
+# Horizontal sharding of the post store: posts, their comments, likes and
+# trending scores and their search index rows live on one of the SHARDS
+# database aliases, chosen by the author. Users, follows and timelines stay on
+# 'default'.
+#
+# Every author maps to one of LOGICAL_SHARDS logical shards (author id modulo
+# LOGICAL_SHARDS), and the logical shards are spread over SHARDS in contiguous
+# ranges. Post and comment ids encode the logical shard of the post's author:
+#
+#     milliseconds since ID_EPOCH_MS (41 bits) | logical shard (10) | sequence (12)
+#
+# so any post or comment id names its database without a lookup, and ids still
+# grow with time. Changing SHARDS moves whole logical shards between aliases
+# and never changes an id; manage.py reshard copies the rows over.
+#
+# With SHARDS = ['default'] nothing is routed and ids are plain auto-increments:
+# every query runs where it did before, including on the read replicas of
+# api/routers.py. The first reshard renumbers the posts and comments whose id
+# does not carry their author's logical shard before anything moves.
+#
+# Ids have no process component: two processes drawing an id for the same
+# logical shard in the same millisecond collide once in 4096 times. Posts and
+# comments are therefore written through save_new() and bulk_create_new(),
+# which retry the insert with new ids when it hits a taken one.
+
+LOGICAL_SHARDS = 1024
+SHARD_BITS = 10
+SEQUENCE_BITS = 12
+ID_EPOCH_MS = 1672531200000  # 2023-01-01T00:00:00Z
+
+# Attempts at inserting new posts or comments before an id collision is raised
+ID_ATTEMPTS = 3
+
+_sequence = itertools.count(random.randrange(1 << SEQUENCE_BITS))
+
+
+def is_sharded():
+    return settings.SHARDS != ['default']
+
+
+def logical_shard_of_user(user_id):
+    return user_id % LOGICAL_SHARDS
+
+
+def logical_shard_of_id(id):
+    return (id >> SEQUENCE_BITS) & (LOGICAL_SHARDS - 1)
+
+
+def alias_of_logical_shard(logical, shards=None):
+    shards = settings.SHARDS if shards is None else shards
+    return shards[logical * len(shards) // LOGICAL_SHARDS]
+
+
+def for_user(user_id, shards=None):
+    # Database holding the posts of an author
+    return alias_of_logical_shard(logical_shard_of_user(user_id), shards)
+
+
+def for_post(post_id, shards=None):
+    # Database holding a post, its comments, likes, trending score and search row
+    shards = settings.SHARDS if shards is None else shards
+    if len(shards) == 1:
+        return shards[0]
+    return alias_of_logical_shard(logical_shard_of_id(post_id), shards)
+
+
+def make_id(logical, ms=None, sequence=None):
+    if ms is None:
+        ms = int(time.time() * 1000)
+    if sequence is None:
+        sequence = next(_sequence)
+    return ((ms - ID_EPOCH_MS) << (SHARD_BITS + SEQUENCE_BITS)) | (logical << SEQUENCE_BITS) | (sequence & ((1 << SEQUENCE_BITS) - 1))
+
+
+def new_post_id(author_id):
+    return make_id(logical_shard_of_user(author_id))
+
+
+def new_comment_id(post_id):
+    # Comments take the logical shard of their post, so they move with it
+    return make_id(logical_shard_of_id(post_id))
+
+
+def _new_id(instance):
+    if isinstance(instance, Post):
+        return new_post_id(instance.author_id)
+    return new_comment_id(instance.post_id)
+
+
+def _insert_retrying(instances, alias, insert):
+    # Draws ids for instances and runs insert() in a savepoint, again with new
+    # ids if another process took one of them first. Posts and comments have
+    # no other unique constraint, so an IntegrityError here is a taken id.
+    for attempt in range(ID_ATTEMPTS):
+        for instance in instances:
+            instance.id = _new_id(instance)
+        try:
+            with transaction.atomic(using=alias):
+                return insert()
+        except IntegrityError:
+            if attempt == ID_ATTEMPTS - 1:
+                raise
+
+
+def save_new(instance, alias):
+    # INSERT a new post or comment on its shard
+    if not is_sharded():
+        instance.save(force_insert=True)
+    else:
+        _insert_retrying([instance], alias, lambda: instance.save(force_insert=True, using=alias))
+
+
+def bulk_create_new(model, instances, alias):
+    # bulk_create new posts or comments, all on the alias shard
+    if not is_sharded():
+        model.objects.bulk_create(instances)
+    elif instances:
+        _insert_retrying(instances, alias, lambda: model.objects.using(alias).bulk_create(instances))
+
+
+def group_by_shard(post_ids):
+    # {alias: [post ids]} for the shards holding any of post_ids
+    groups = defaultdict(list)
+    for post_id in post_ids:
+        groups[for_post(post_id)].append(post_id)
+    return groups
+
+
+def using(queryset, alias):
+    # Points a queryset at a shard. Unsharded, queries are left to the routers
+    # so that reads can still go to the replicas.
+    return queryset.using(alias) if is_sharded() else queryset
+
+
+def with_authors(queryset, alias, field='author'):
+    # Loads each row's author along with it: joined in, where the shard is the
+    # database that holds the users, and otherwise fetched from it with one
+    # more query
+    if alias == 'default':
+        return queryset.select_related(field)
+    return queryset.prefetch_related(field)
+
+
+@receiver(pre_save, sender=Post)
+def assign_post_id(sender, instance, **kwargs):
+    if instance.id is None and is_sharded():
+        instance.id = new_post_id(instance.author_id)
+
+
+@receiver(pre_save, sender=Comment)
+def assign_comment_id(sender, instance, **kwargs):
+    if instance.id is None and is_sharded():
+        instance.id = new_comment_id(instance.post_id)
+
+
+@receiver(post_delete, sender=User)
+def remove_deleted_user(sender, instance, **kwargs):
+    # The delete cascade only reaches the rows on 'default', which holds the
+    # user. The other shards lose the user's posts here, and the user's
+    # comments and likes on other posts, whose counters are adjusted.
+    for alias in settings.SHARDS:
+        if alias != 'default':
+            with transaction.atomic(using=alias):
+                Post.objects.using(alias).filter(author_id=instance.id).delete()
+                for model, field, counter in ((Comment, 'author', 'comments_count'), (PostLike, 'user', 'likes_count')):
+                    rows = model.objects.using(alias).filter(**{field: instance.id})
+                    posts_by_count = defaultdict(list)
+                    for post_id, count in Counter(rows.values_list('post_id', flat=True)).items():
+                        posts_by_count[count].append(post_id)
+                    rows.delete()
+                    for count, post_ids in posts_by_count.items():
+                        Post.objects.using(alias).filter(id__in=post_ids).update(**{counter: F(counter) - count})
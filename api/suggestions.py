@@ -0,0 +1,189 @@
+import bisect
+import heapq
+import threading
+import time
+from array import array
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+from .auth import LRUCache
+from .models import Follow
+
+# "Who to follow" suggestions: the accounts followed by the most accounts the
+# user follows. They are computed from an in-memory copy of the follow graph
+# rather than with friends-of-friends joins over the through table.
+#
+# Each process loads the graph on first use and reloads it in a background
+# thread once it is SUGGESTIONS_GRAPH_MAX_AGE seconds old, to pick up the
+# follows made through other processes. Follows made through this process are
+# applied to the loaded graph as they happen. Rankings are cached per user for
+# SUGGESTIONS_CACHE_TTL seconds.
+
+# Rows read per round trip while loading the graph
+LOAD_CHUNK_SIZE = 10000
+
+
+class FollowGraph:
+    # Who each user follows, in compressed sparse row form: owners is the
+    # sorted array of users that follow anyone, and the accounts followed by
+    # owners[i] are targets[offsets[i]:offsets[i + 1]], sorted. Follows and
+    # unfollows made after loading are kept in per-user overlays.
+
+    def __init__(self, owners, offsets, targets):
+        self.owners = owners
+        self.offsets = offsets
+        self.targets = targets
+        self.added = {}
+        self.removed = {}
+
+    @classmethod
+    def load(cls):
+        # One pass over the through table in (follower, followed) order, which
+        # is the order of follow_to_from_idx
+        follows = Follow.objects.order_by('to_user_id', 'from_user_id').values_list('to_user_id', 'from_user_id')
+        sql, params = follows.query.sql_with_params()
+        owners, offsets, targets = array('q'), array('q'), array('q')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(LOAD_CHUNK_SIZE)
+                if not rows:
+                    break
+                for follower_id, followed_id in rows:
+                    if not owners or owners[-1] != follower_id:
+                        owners.append(follower_id)
+                        offsets.append(len(targets))
+                    targets.append(followed_id)
+        offsets.append(len(targets))
+        return cls(owners, offsets, targets)
+
+    @property
+    def edges(self):
+        return len(self.targets) + sum(map(len, self.added.values())) - sum(map(len, self.removed.values()))
+
+    def _row(self, user_id):
+        i = bisect.bisect_left(self.owners, user_id)
+        if i < len(self.owners) and self.owners[i] == user_id:
+            return self.targets[self.offsets[i]:self.offsets[i + 1]]
+        return array('q')
+
+    def following(self, user_id):
+        row = self._row(user_id)
+        if user_id in self.added or user_id in self.removed:
+            return (set(row) - self.removed.get(user_id, set())) | self.added.get(user_id, set())
+        return row
+
+    def _loaded(self, user_id, followed_id):
+        row = self._row(user_id)
+        i = bisect.bisect_left(row, followed_id)
+        return i < len(row) and row[i] == followed_id
+
+    def add(self, user_id, followed_id):
+        # Idempotent, so follows can be replayed onto a graph that may already contain them
+        self.removed.get(user_id, set()).discard(followed_id)
+        if not self._loaded(user_id, followed_id):
+            self.added.setdefault(user_id, set()).add(followed_id)
+
+    def remove(self, user_id, followed_id):
+        self.added.get(user_id, set()).discard(followed_id)
+        if self._loaded(user_id, followed_id):
+            self.removed.setdefault(user_id, set()).add(followed_id)
+
+    def suggest(self, user_id, n):
+        # The n best (user id, mutual count) pairs: accounts not yet followed,
+        # ranked by how many of the user's followed accounts follow them, older
+        # accounts first among equal counts
+        following = self.following(user_id)
+        counts = Counter()
+        for followed_id in following:
+            counts.update(self.following(followed_id))
+        counts.pop(user_id, None)
+        for followed_id in following:
+            counts.pop(followed_id, None)
+        return heapq.nlargest(n, counts.items(), key=lambda item: (item[1], -item[0]))
+
+
+class GraphStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.cache = LRUCache(settings.SUGGESTIONS_CACHE_SIZE)
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.graph = None
+            self.loaded_at = None
+            # Changes made while a load is running, replayed onto its result
+            self.pending = None
+        self.cache.clear()
+
+    def _load(self):
+        # Callers hold load_lock
+        with self.lock:
+            self.pending = []
+        try:
+            loaded_at = time.time()
+            graph = FollowGraph.load()
+        except BaseException:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            for change, user_id, followed_id in self.pending:
+                getattr(graph, change)(user_id, followed_id)
+            self.graph, self.loaded_at, self.pending = graph, loaded_at, None
+
+    def reload(self):
+        with self.load_lock:
+            self._load()
+
+    def _reload_in_background(self):
+        if not self.load_lock.acquire(blocking=False):
+            return
+        try:
+            self._load()
+        finally:
+            self.load_lock.release()
+            connection.close()
+
+    def get_graph(self):
+        if self.graph is None:
+            with self.load_lock:
+                if self.graph is None:
+                    self._load()
+        elif time.time() - self.loaded_at >= settings.SUGGESTIONS_GRAPH_MAX_AGE and not self.load_lock.locked():
+            threading.Thread(target=self._reload_in_background, daemon=True).start()
+        return self.graph
+
+    def change(self, change, user_id, followed_id):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((change, user_id, followed_id))
+            if self.graph is not None:
+                getattr(self.graph, change)(user_id, followed_id)
+        self.cache.pop(user_id)
+
+
+store = GraphStore()
+
+
+def follow(user_id, followed_ids):
+    for followed_id in followed_ids:
+        store.change('add', user_id, followed_id)
+
+
+def unfollow(user_id, followed_id):
+    store.change('remove', user_id, followed_id)
+
+
+def suggest(user_id, n):
+    # The n best suggestions for the user as a list of (user id, mutual count)
+    now = time.time()
+    ranking = store.cache.get(user_id, now)
+    if ranking is None:
+        ranking = store.get_graph().suggest(user_id, settings.SUGGESTIONS_SIZE)
+        store.cache.set(user_id, ranking, now + settings.SUGGESTIONS_CACHE_TTL)
+    return ranking[:n]
@@ -0,0 +1,343 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .auth import LRUCache
+from .models import Job, Post, User
+from . import feed, notifications, search, sharding, trending
+
+# Deferred side effects of the write endpoints: timeline fan-out, search
+# indexing, trending scores and notifications. A view enqueues a job and
+# returns; the TASK_BACKEND runs it:
+#
+# - ImmediateBackend runs it inline, before the response, as if it were not
+#   deferred. The default, and what the tests use.
+# - LocalBackend runs it after the request's transaction commits on a pool of
+#   TASK_WORKERS threads in the same process. Jobs are lost if the process
+#   exits first.
+# - DatabaseBackend stores it in the api_job table, where manage.py run_tasks
+#   workers claim it. A claimed job is leased for TASK_LEASE_SECONDS, so a job
+#   whose worker died is run again: jobs run at least once.
+#
+# Workers take up to TASK_BATCH_SIZE jobs at a time, and tasks registered with
+# batch=True get every job of the batch in one call: a burst of likes becomes a
+# single trending update and a single notification upsert. A failed job is
+# retried after TASK_RETRY_DELAY seconds, doubled on each attempt, up to
+# TASK_MAX_ATTEMPTS attempts. Both drop a job enqueued with a key when a job
+# with the same key was queued within the last TASK_KEY_TTL seconds.
+#
+# Tasks registered with once=True add to counters, so a job of theirs that runs
+# again must not count twice. Their jobs always have a key, a new one unless
+# the view gives one, and get it as their last argument to record with their
+# effect; see api/idempotency.py.
+
+logger = logging.getLogger('api.tasks')
+
+
+class Task:
+    def __init__(self, fn, batch, once):
+        self.fn = fn
+        self.batch = batch
+        self.once = once
+
+    def run(self, payloads):
+        # Runs one job per payload; returns the exception of each, or None
+        if self.batch:
+            try:
+                self.fn(payloads)
+            except Exception as e:
+                return [e] * len(payloads)
+            return [None] * len(payloads)
+        errors = []
+        for args in payloads:
+            try:
+                self.fn(*args)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+
+registry = {}
+
+
+def task(name, batch=False, once=False):
+    # Registers fn as the task `name`. A batch task is called with the list of
+    # the argument lists of its jobs; other tasks with the arguments of one job.
+    def decorator(fn):
+        registry[name] = Task(fn, batch, once)
+        return fn
+    return decorator
+
+
+def run_jobs(jobs):
+    # Runs (name, args) jobs, grouped by task; returns the exception of each, or None
+    groups = defaultdict(list)
+    for index, (name, args) in enumerate(jobs):
+        groups[name].append(index)
+    errors = [None] * len(jobs)
+    for name, indexes in groups.items():
+        for index, error in zip(indexes, registry[name].run([jobs[i][1] for i in indexes])):
+            errors[index] = error
+    return errors
+
+
+def retry_delay(attempts):
+    return settings.TASK_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+class ImmediateBackend:
+    # Runs each job when it is enqueued, so keys are ignored and a failure
+    # raises in the view, as if the work had not been deferred. A job never
+    # runs twice, so once-tasks are not given its key to record.
+
+    def enqueue(self, name, args, key=None):
+        self.enqueue_many([(name, args, key)])
+
+    def enqueue_many(self, jobs):
+        for error in run_jobs([(name, [*args[:-1], None] if registry[name].once else args) for name, args, _ in jobs]):
+            if error is not None:
+                raise error
+
+    def close(self):
+        pass
+
+
+class LocalBackend:
+    def __init__(self):
+        self.keys = LRUCache(settings.TASK_KEY_CACHE_SIZE)
+        self.queue = queue.SimpleQueue()
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self.work, name=f'api-task-{i}', daemon=True)
+            for i in range(settings.TASK_WORKERS)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def seen(self, key):
+        # Whether key was enqueued within TASK_KEY_TTL seconds; records it if not
+        if key is None:
+            return False
+        now = time.time()
+        if self.keys.get(key, now) is not None:
+            return True
+        self.keys.set(key, True, now + settings.TASK_KEY_TTL)
+        return False
+
+    def enqueue(self, name, args, key=None):
+        self.enqueue_many([(name, args, key)])
+
+    def enqueue_many(self, jobs):
+        jobs = [(name, args, 0) for name, args, key in jobs if not self.seen(key)]
+        if jobs:
+            transaction.on_commit(lambda: self.put(jobs))
+
+    def put(self, jobs):
+        with self.idle:
+            self.pending += len(jobs)
+        for job in jobs:
+            self.queue.put(job)
+
+    def work(self):
+        while True:
+            jobs = [self.queue.get()]
+            if jobs[0] is None:
+                return
+            while len(jobs) < settings.TASK_BATCH_SIZE:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+            try:
+                errors = run_jobs([(name, args) for name, args, _ in jobs])
+                for (name, args, attempts), error in zip(jobs, errors):
+                    if error is not None:
+                        self.retry(name, args, attempts + 1, error)
+            finally:
+                close_old_connections()
+                with self.idle:
+                    self.pending -= len(jobs)
+                    self.idle.notify_all()
+
+    def retry(self, name, args, attempts, error):
+        if attempts >= settings.TASK_MAX_ATTEMPTS:
+            logger.error('Task %s%r failed after %d attempts', name, args, attempts, exc_info=error)
+            return
+        logger.warning('Task %s%r failed, retrying: %r', name, args, error)
+        with self.idle:
+            self.pending += 1
+        timer = threading.Timer(retry_delay(attempts), self._requeue, [(name, args, attempts)])
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job):
+        # The job was counted as pending when its retry was scheduled
+        self.queue.put(job)
+
+    def join(self, timeout=None):
+        # Waits until every job put so far, and its retries, has run. Returns
+        # whether that happened within timeout seconds.
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+
+
+class DatabaseBackend:
+    def enqueue(self, name, args, key=None):
+        self.enqueue_many([(name, args, key)])
+
+    def enqueue_many(self, jobs):
+        now = timezone.now()
+        Job.objects.bulk_create(
+            [Job(name=name, args=args, key=key, run_at=now) for name, args, key in jobs],
+            ignore_conflicts=any(key is not None for _, _, key in jobs),
+        )
+
+    def claim(self, batch_size, now):
+        # Leases up to batch_size due jobs, oldest first. Workers on Postgres
+        # skip the rows another worker is claiming instead of waiting for it.
+        with transaction.atomic():
+            jobs = list(
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(status=Job.QUEUED, run_at__lte=now)
+                .order_by('run_at')[:batch_size]
+            )
+            if jobs:
+                Job.objects.filter(id__in=[job.id for job in jobs]).update(
+                    run_at=now + timedelta(seconds=settings.TASK_LEASE_SECONDS), attempts=F('attempts') + 1,
+                )
+        return jobs
+
+    def run_batch(self, batch_size=None):
+        # Claims and runs one batch; returns the number of jobs run
+        now = timezone.now()
+        jobs = self.claim(batch_size or settings.TASK_BATCH_SIZE, now)
+        if not jobs:
+            return 0
+        errors = run_jobs([(job.name, job.args) for job in jobs])
+        now = timezone.now()
+        done = [job.id for job, error in zip(jobs, errors) if error is None]
+        Job.objects.filter(id__in=done).update(status=Job.DONE, run_at=now, error='')
+        for job, error in zip(jobs, errors):
+            if error is None:
+                continue
+            attempts = job.attempts + 1
+            if attempts >= settings.TASK_MAX_ATTEMPTS:
+                logger.error('Task %s%r failed after %d attempts', job.name, job.args, attempts, exc_info=error)
+                Job.objects.filter(id=job.id).update(status=Job.FAILED, error=repr(error))
+            else:
+                logger.warning('Task %s%r failed, retrying: %r', job.name, job.args, error)
+                Job.objects.filter(id=job.id).update(run_at=now + timedelta(seconds=retry_delay(attempts)), error=repr(error))
+        return len(jobs)
+
+    def run_pending(self, batch_size=None):
+        # Runs batches until no job is due; returns the number of jobs run
+        total = 0
+        while True:
+            count = self.run_batch(batch_size)
+            if not count:
+                return total
+            total += count
+
+    def prune(self):
+        # Deletes the jobs done more than TASK_KEY_TTL seconds ago, which frees
+        # their keys. Failed jobs are kept for inspection.
+        cutoff = timezone.now() - timedelta(seconds=settings.TASK_KEY_TTL)
+        return Job.objects.filter(status=Job.DONE, run_at__lt=cutoff).delete()[0]
+
+    def close(self):
+        pass
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return import_string(settings.TASK_BACKEND)()
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting in ('TASK_BACKEND', 'TASK_WORKERS'):
+        if get_backend.cache_info().currsize:
+            get_backend().close()
+        get_backend.cache_clear()
+
+
+def _job(name, args, key):
+    if registry[name].once:
+        key = key or uuid.uuid4().hex
+        return name, [*args, key], key
+    return name, list(args), key
+
+
+def enqueue(name, *args, key=None):
+    get_backend().enqueue(*_job(name, args, key))
+
+
+def enqueue_many(jobs):
+    # jobs is a list of (name, args, key), queued together: the database
+    # backend writes them in one INSERT and the immediate one runs them as one
+    # batch, as a worker would
+    if jobs:
+        get_backend().enqueue_many([_job(name, args, key) for name, args, key in jobs])
+
+
+# The deferred work of the write endpoints
+
+@task('fan_out_post')
+def fan_out_post(post_id):
+    # Into the followers' timelines and the search index
+    post = sharding.using(Post.objects, sharding.for_post(post_id)).filter(id=post_id).first()
+    if post is not None:
+        feed.fan_out_post(post)
+        search.index_post(post)
+
+
+@task('backfill')
+def backfill(owner_id, author_ids):
+    # Skips the authors unfollowed again before the job ran
+    following = list(
+        User.followers.through.objects.filter(to_user_id=owner_id, from_user_id__in=author_ids)
+        .values_list('from_user_id', flat=True)
+    )
+    if following:
+        feed.backfill(owner_id, following)
+
+
+@task('trending', batch=True, once=True)
+def record_trending(payloads):
+    # Each payload is [post id, weight, key]
+    trending.record([tuple(payload) for payload in payloads])
+
+
+@task('index_comments', batch=True)
+def index_comments(payloads):
+    # Each payload is [post id, comment content]
+    search.index_comments([tuple(payload) for payload in payloads])
+
+
+@task('notify', batch=True, once=True)
+def notify(payloads):
+    # Each payload is [kind, recipient id, actor id, post id, key]
+    notifications.record([tuple(payload) for payload in payloads])
@@ -1,9 +1,24 @@
-from django.test import TestCase, Client
-from django.urls import reverse
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import LiveServerTestCase, TestCase, Client, RequestFactory, override_settings
+from django.urls import resolve, reverse
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-import json, jwt
+import json, jwt, random, re, threading, time
+from contextlib import ExitStack
+from io import StringIO
+from django.core.management import call_command
+from importlib import import_module
+from django.core.cache import cache as default_cache
+from unittest import mock, skipIf, skipUnless
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
 from datetime import datetime, timedelta
-from .models import User, Post, Comment
+from .models import User, Post, PostLike, Comment, AppliedKey, Job, Notification, TimelineEntry, TrendingScore
+from . import auth, cache, feed, login, notifications, pagination, relations, renderers, routers, sharding, suggestions, tasks, throttling, trending
+from .metrics import registry
+from .middleware import ReplicaRoutingMiddleware
+from .urls import urlpatterns
 class AuthenticationTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -84,6 +99,76 @@ class AllPostsTestCase(TestCase):
         # assert that response status code is 401
         self.assertEqual(response.status_code, 401)
 
+    def test_all_posts_query_count_is_constant(self):
+        other = User.objects.create_user(username='otheruser', password='otherpass', email='other1@test.com')
+        url = reverse('all_posts')
+
+        def seed(n):
+            for i in range(n):
+                post = Post.objects.create(title=f'Post {i}', content='content', author=self.user)
+                post.likes.add(self.user, other)
+                Comment.objects.create(post=post, author=other, content='first')
+                Comment.objects.create(post=post, author=self.user, content='second')
+
+        # one query each for posts, comments with their authors, and likers
+        seed(1)
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(len(response.json().get('posts')), 1)
+
+        seed(10)
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        posts = response.json().get('posts')
+        self.assertEqual(len(posts), 11)
+        self.assertEqual([c['author'] for c in posts[0]['comments']], ['otheruser', 'testuser'])
+        self.assertEqual(len(posts[0]['likes']), 2)
+
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='page1@test.com')
+        self.token = jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+
+    def test_all_posts_pages_follow_cursor(self):
+        posts = [Post.objects.create(title=f'Post {i}', content='content', author=self.user) for i in range(5)]
+        # give two posts the same timestamp so the id tie-breaker is exercised
+        Post.objects.filter(id=posts[2].id).update(created_at=posts[3].created_at)
+
+        url = reverse('all_posts')
+        seen = []
+        cursor = ''
+        while True:
+            response = self.client.get(url, {'limit': 2, 'cursor': cursor}, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, 201)
+            self.assertLessEqual(len(response.json()['posts']), 2)
+            seen += [post['id'] for post in response.json()['posts']]
+            cursor = response.json()['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [post.id for post in reversed(posts)])
+
+    def test_all_posts_invalid_cursor(self):
+        response = self.client.get(reverse('all_posts'), {'cursor': 'garbage'}, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, 400)
+
+    def test_post_comments_paginated(self):
+        post = Post.objects.create(title='Post', content='content', author=self.user)
+        comments = [Comment.objects.create(post=post, author=self.user, content=f'Comment {i}') for i in range(3)]
+
+        url = reverse('post_comments', args=[post.id])
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['id'] for c in response.json()['comments']], [comments[0].id, comments[1].id])
+
+        response = self.client.get(url, {'limit': 2, 'cursor': response.json()['next_cursor']})
+        self.assertEqual([c['id'] for c in response.json()['comments']], [comments[2].id])
+        self.assertIsNone(response.json()['next_cursor'])
+
+    def test_post_comments_nonexistent_post(self):
+        response = self.client.get(reverse('post_comments', args=[9999]))
+        self.assertEqual(response.status_code, 404)
 
 
 class AddCommentViewTestCase(TestCase):
@@ -126,6 +211,20 @@ class AddCommentViewTestCase(TestCase):
         self.assertEqual(response.status_code, 401)
         self.assertFalse(Comment.objects.filter(content='This is a test comment.').exists())
 
+    def test_add_comment_missing(self):
+        # Submit a request without a comment field
+        response = self.client.post(reverse('add_comment', kwargs={'id': self.post.id}), {}, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_comment_nonexistent_post(self):
+        # Comment on a post that does not exist
+        comment_data = {'comment': 'This is a test comment.'}
+        response = self.client.post(reverse('add_comment', kwargs={'id': 9999}), comment_data, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+        # Check that nothing was written and the response is a 404
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Comment.objects.exists())
+
 
 
 
@@ -341,4 +440,1644 @@ class FollowUserTestCase(TestCase):
 
     def test_follow_nonexistent_user(self):
         response = self.client.post(reverse('follow_user',args=[9999]), HTTP_AUTHORIZATION=f'Bearer {self.token}')
-        self.assertEqual(response.status_code, 404)
\ No newline at end of file
+        self.assertEqual(response.status_code, 404)
+
+    def test_follow_by_deleted_user(self):
+        token = jwt.encode({'user_id': 9999}, 'secret_key', algorithm='HS256')
+        response = self.client.post(reverse('follow_user',args=[self.user2.id]), HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(self.user2.followers.exists())
+        self.assertEqual(relations.insert_links(User.followers.through, 'from_user', 'to_user', [(self.user2.id, 9999)], guards=[(User, 9999)]), set())
+
+
+class HomeFeedTestCase(TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user(username='reader', password='testpass', email='reader@test.com')
+        self.author = User.objects.create_user(username='author', password='testpass', email='author@test.com')
+        self.celebrity = User.objects.create_user(username='celebrity', password='testpass', email='celebrity@test.com')
+        self.reader_token = jwt.encode({'user_id': self.reader.id}, 'secret_key', algorithm='HS256')
+
+    def create_post(self, user, title):
+        token = jwt.encode({'user_id': user.id}, 'secret_key', algorithm='HS256')
+        response = self.client.post(reverse('create_post'), data=json.dumps({'title': title, 'description': 'content'}), content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return response.json()['id']
+
+    def follow(self, user):
+        return self.client.post(reverse('follow_user', args=[user.id]), HTTP_AUTHORIZATION=f'Bearer {self.reader_token}')
+
+    def read_feed(self, **params):
+        return self.client.get(reverse('home_feed'), params, HTTP_AUTHORIZATION=f'Bearer {self.reader_token}')
+
+    def test_follow_backfills_and_create_post_fans_out(self):
+        old_post = self.create_post(self.author, 'Before follow')
+        self.follow(self.author)
+        new_post = self.create_post(self.author, 'After follow')
+
+        self.assertEqual(TimelineEntry.objects.filter(owner=self.reader).count(), 2)
+        response = self.read_feed()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['id'] for post in response.json()['posts']], [new_post, old_post])
+        self.assertEqual(response.json()['posts'][0]['author'], 'author')
+
+    def test_unfollow_removes_posts(self):
+        self.follow(self.author)
+        self.create_post(self.author, 'Post')
+        self.client.post(reverse('unfollow_user', args=[self.author.id]), HTTP_AUTHORIZATION=f'Bearer {self.reader_token}')
+        self.assertEqual(self.read_feed().json()['posts'], [])
+
+    def test_celebrity_posts_are_merged_on_read(self):
+        self.follow(self.author)
+        self.follow(self.celebrity)
+        fan = User.objects.create_user(username='fan', password='testpass', email='fan@test.com')
+        fan_token = jwt.encode({'user_id': fan.id}, 'secret_key', algorithm='HS256')
+        self.client.post(reverse('follow_user', args=[self.celebrity.id]), HTTP_AUTHORIZATION=f'Bearer {fan_token}')
+        with self.settings(FEED_FANOUT_THRESHOLD=1):
+            posts = [self.create_post(self.author, 'Author 1'), self.create_post(self.celebrity, 'Celebrity 1'),
+                     self.create_post(self.author, 'Author 2'), self.create_post(self.celebrity, 'Celebrity 2')]
+            self.assertTrue(TimelineEntry.objects.filter(owner=self.reader, post_id=posts[2]).exists())
+            self.assertFalse(TimelineEntry.objects.filter(owner=self.reader, post_id=posts[3]).exists())
+
+            first = self.read_feed(limit=3).json()
+            second = self.read_feed(limit=3, cursor=first['next_cursor']).json()
+        self.assertEqual([post['id'] for post in first['posts'] + second['posts']], list(reversed(posts)))
+        self.assertIsNone(second['next_cursor'])
+
+    def test_feed_unauthorized(self):
+        response = self.client.get(reverse('home_feed'))
+        self.assertEqual(response.status_code, 401)
+
+
+
+class CountersTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='testuser1', password='testpass', email='count1@test.com')
+        self.user2 = User.objects.create_user(username='testuser2', password='testpass', email='count2@test.com')
+        self.post = Post.objects.create(author=self.user2, title='Test Post', content='This is a test post.')
+        self.token = jwt.encode({'user_id': self.user1.id}, 'secret_key', algorithm='HS256')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {self.token}'}
+
+    def test_counters_follow_writes(self):
+        self.client.post(reverse('follow_user', args=[self.user2.id]), **self.auth)
+        self.client.post(reverse('like_post', args=[self.post.id]), **self.auth)
+        self.client.post(reverse('add_comment', args=[self.post.id]), {'comment': 'Nice'}, **self.auth)
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((self.user1.following_count, self.user2.followers_count), (1, 1))
+        self.assertEqual((self.post.likes_count, self.post.comments_count), (1, 1))
+
+        self.client.post(reverse('unfollow_user', args=[self.user2.id]), **self.auth)
+        self.client.post(reverse('unlike_post', args=[self.post.id]), **self.auth)
+        self.user2.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((self.user2.followers_count, self.post.likes_count), (0, 0))
+
+    def test_profile_and_post_detail_read_counters(self):
+        self.client.post(reverse('follow_user', args=[self.user2.id]), **self.auth)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('user'), **self.auth)
+        self.assertEqual(response.json(), {'username': 'testuser1', 'followers_count': 0, 'following_count': 1})
+
+        default_cache.clear()
+        self.client.post(reverse('like_post', args=[self.post.id]), **self.auth)
+        response = self.client.get(reverse('delete_post', args=[self.post.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['likes_count'], 1)
+
+    def test_recount_counters_fixes_drift(self):
+        self.user1.following.add(self.user2)
+        self.post.likes.add(self.user1)
+        Comment.objects.create(post=self.post, author=self.user1, content='Nice')
+        Post.objects.filter(id=self.post.id).update(comments_count=5)
+
+        out = StringIO()
+        call_command('recount_counters', batch_size=1, stdout=out)
+        self.assertIn('User.followers_count: fixed 1 rows', out.getvalue())
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((self.user1.followers_count, self.user1.following_count), (0, 1))
+        self.assertEqual((self.user2.followers_count, self.user2.following_count), (1, 0))
+        self.assertEqual((self.post.likes_count, self.post.comments_count), (1, 1))
+
+
+
+class JWTRequiredTestCase(TestCase):
+    def setUp(self):
+        auth.token_cache.clear()
+        auth.user_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='jwt1@test.com')
+        self.post = Post.objects.create(author=self.user, title='Test Post', content='This is a test post.')
+
+    def test_verified_token_is_cached(self):
+        token = jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+        with mock.patch('api.auth.jwt.decode', wraps=jwt.decode) as decode:
+            for _ in range(3):
+                response = self.client.get(reverse('all_posts'), HTTP_AUTHORIZATION=f'Bearer {token}')
+                self.assertEqual(response.status_code, 201)
+        self.assertEqual(decode.call_count, 1)
+
+    def test_cached_token_expires(self):
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.utcnow() + timedelta(minutes=5)}, 'secret_key', algorithm='HS256')
+        self.assertEqual(auth.decode_token(token), self.user.id)
+        now = time.time()
+        self.assertEqual(auth.token_cache.get(token, now), self.user.id)
+        # the cached verification is dropped once the token's exp has passed
+        self.assertIsNone(auth.token_cache.get(token, now + 600))
+
+    def test_user_rows_are_cached_until_saved(self):
+        token = jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+        url = reverse('like_post', args=[self.post.id])
+        self.client.post(url, HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertIsNotNone(auth.user_cache.get(self.user.id))
+
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertIsNone(auth.user_cache.get(self.user.id))
+        self.assertEqual(auth.get_user(self.user.id).username, 'renamed')
+
+    def test_deleted_user(self):
+        token = jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+        self.user.delete()
+        response = self.client.post(reverse('like_post', args=[1]), HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 404)
+
+    def test_token_without_user_id(self):
+        token = jwt.encode({'username': 'testuser'}, 'secret_key', algorithm='HS256')
+        response = self.client.get(reverse('all_posts'), HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {'error': 'Invalid token'})
+
+
+
+class ToggleWritesTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='testuser1', password='testpass', email='toggle1@test.com')
+        self.user2 = User.objects.create_user(username='testuser2', password='testpass', email='toggle2@test.com')
+        self.post = Post.objects.create(author=self.user2, title='Test Post', content='This is a test post.')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user1.id}, 'secret_key', algorithm='HS256')}
+
+    def writes(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, **self.auth)
+        statements = [q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+        return response, statements
+
+    def test_like_is_one_insert_and_one_update(self):
+        auth.get_user(self.user1.id)
+        response, statements = self.writes(reverse('like_post', args=[self.post.id]))
+        self.assertEqual(response.status_code, 200)
+        # plus the post's trending score and the author's notification
+        self.assertEqual(len(statements), 5)
+        self.assertIn('api_trendingscore', statements[2])
+        self.assertIn('api_notification', statements[4])
+        self.assertEqual(response.json()['title'], 'Test Post')
+        self.assertEqual(response.json()['message'], 'testuser1 liked this post!')
+
+        updated_at = Post.objects.get(id=self.post.id).updated_at
+        self.assertEqual(updated_at, self.post.updated_at)
+
+    def test_like_and_unlike_missing_post(self):
+        for name in ('like_post', 'unlike_post'):
+            response, _ = self.writes(reverse(name, args=[9999]))
+            self.assertEqual(response.status_code, 404)
+
+    def test_follow_and_unfollow_are_single_statements(self):
+        response, statements = self.writes(reverse('follow_user', args=[self.user2.id]))
+        self.assertEqual(response.json(), {'success': 'You are now following testuser2!'})
+        self.assertEqual(len([sql for sql in statements if 'api_timelineentry' not in sql and not sql.startswith('SELECT')]), 3)
+        self.assertIn('api_notification', statements[-1])
+        self.assertEqual(User.objects.get(id=self.user1.id).following_count, 1)
+        self.assertEqual(User.objects.get(id=self.user2.id).followers_count, 1)
+
+        response, statements = self.writes(reverse('unfollow_user', args=[self.user2.id]))
+        self.assertEqual(response.json(), {'success': 'You have unfollowed testuser2!'})
+        self.assertEqual(User.objects.get(id=self.user2.id).followers_count, 0)
+
+        response, _ = self.writes(reverse('unfollow_user', args=[9999]))
+        self.assertEqual(response.status_code, 404)
+
+
+
+class BatchActionsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='batch1@test.com')
+        self.other = User.objects.create_user(username='otheruser', password='testpass', email='batch2@test.com')
+        self.post = Post.objects.create(author=self.other, title='Test Post', content='This is a test post.')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+
+    def send(self, actions):
+        return self.client.post(reverse('batch_actions'), data=json.dumps({'actions': actions}), content_type='application/json', **self.auth)
+
+    def test_batch_mixed_actions(self):
+        response = self.send([
+            {'action': 'like', 'id': self.post.id},
+            {'action': 'like', 'id': self.post.id},
+            {'action': 'follow', 'id': self.other.id},
+            {'action': 'comment', 'id': self.post.id, 'comment': 'Nice post'},
+            {'action': 'comment', 'id': self.post.id, 'comment': ' '},
+            {'action': 'like', 'id': 9999},
+            {'action': 'dance', 'id': self.post.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], [200, 400, 200, 200, 400, 404, 400])
+        self.assertEqual(Comment.objects.get(id=results[3]['comment_id']).content, 'Nice post')
+
+        self.post.refresh_from_db()
+        self.other.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual((self.post.likes_count, self.post.comments_count), (1, 1))
+        self.assertEqual((self.other.followers_count, self.user.following_count), (1, 1))
+        self.assertTrue(self.post.likes.filter(id=self.user.id).exists())
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.user, post=self.post).exists())
+
+    def test_batch_query_count_is_constant(self):
+        posts = [Post.objects.create(author=self.other, title=f'Post {i}', content='content') for i in range(20)]
+
+        def queries(actions):
+            auth.user_cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.send(actions).status_code, 200)
+            return len(captured)
+
+        small = queries([{'action': 'like', 'id': posts[0].id}, {'action': 'comment', 'id': posts[0].id, 'comment': 'Hi'}])
+        large = queries([{'action': 'like', 'id': post.id} for post in posts[1:]] + [{'action': 'comment', 'id': post.id, 'comment': 'Hi'} for post in posts[1:]])
+        self.assertEqual(small, large)
+
+    def test_batch_counts_only_links_it_wrote(self):
+        # A like and a follow made by another request between the checks and the insert
+        insert_links = relations.insert_links
+
+        def racing_insert_links(through, *args, **kwargs):
+            if through is relations.Like:
+                relations.like(self.post.id, self.user.id)
+            else:
+                relations.follow(self.user.id, self.other.id)
+            return insert_links(through, *args, **kwargs)
+
+        with mock.patch.object(relations, 'insert_links', racing_insert_links):
+            response = self.send([{'action': 'like', 'id': self.post.id}, {'action': 'follow', 'id': self.other.id}])
+        self.assertEqual([r['status'] for r in response.json()['results']], [400, 400])
+        self.post.refresh_from_db()
+        self.other.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual((self.post.likes_count, self.other.followers_count, self.user.following_count), (1, 1, 1))
+
+    def test_batch_too_large(self):
+        with self.settings(BATCH_MAX_ACTIONS=1):
+            response = self.send([{'action': 'like', 'id': self.post.id}] * 2)
+        self.assertEqual(response.status_code, 400)
+
+
+
+class PostDetailCacheTestCase(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='cache1@test.com')
+        self.post = Post.objects.create(author=self.user, title='Test Post', content='This is a test post.')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+        self.url = reverse('delete_post', args=[self.post.id])
+
+    def test_detail_is_cached(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'Test Post')
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_if_none_match(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        for header in ('*', f'"other", W/{etag}'):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=header).status_code, 304)
+        # A header merely containing the tag is not a match
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"stale{etag}"').status_code, 200)
+
+    def test_writes_invalidate(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.post(reverse('like_post', args=[self.post.id]), **self.auth)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['likes_count'], 1)
+
+        self.client.post(reverse('add_comment', args=[self.post.id]), {'comment': 'Nice'}, **self.auth)
+        self.assertEqual(len(self.client.get(self.url).json()['comments']), 1)
+
+        self.client.post(reverse('unlike_post', args=[self.post.id]), **self.auth)
+        self.assertEqual(self.client.get(self.url).json()['likes_count'], 0)
+
+        self.client.delete(self.url, **self.auth)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_stale_build_is_not_served(self):
+        # a body built from data read before an invalidation must not be cached as current
+        def build():
+            cache.invalidate_post(self.post.id)
+            return b'{"stale": true}'
+        cache.get_post_response(self.post.id, build)
+        self.assertEqual(self.client.get(self.url).json()['title'], 'Test Post')
+
+
+
+class BenchmarkCommandTestCase(TestCase):
+    def test_endpoints_suite_reports_every_route(self):
+        out = StringIO()
+        rates = {scope: {'user': (1, 60), 'ip': (1, 60)} for scope in settings.THROTTLE_RATES}
+        with override_settings(THROTTLE_RATES=rates):
+            call_command('benchmark', 'endpoints', users=8, avg_posts=2, requests=3, concurrency=1, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        named = {pattern.name for pattern in urlpatterns if pattern.name}
+        self.assertEqual(set(report['routes']), named)
+        for name, route in report['routes'].items():
+            self.assertEqual(route['requests'], 3, name)
+            self.assertNotIn('429', route['status_codes'], name)
+            self.assertIn('p99_ms', route)
+            self.assertIn('queries_per_request', route)
+        self.assertLessEqual(report['routes']['all_posts']['queries_per_request'], 3)
+
+
+
+class RequestMetricsTestCase(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='metrics1@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('api.metrics', level='INFO') as logs:
+            response = self.client.get(reverse('user'), **self.auth)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['view'], record['status'], record['db_queries']), ('user', 200, 1))
+
+    @override_settings(API_METRICS_TOKEN='scrape-token')
+    def test_histogram_endpoint(self):
+        self.client.get(reverse('user'), **self.auth)
+        self.client.get(reverse('user'), **self.auth)
+        response = self.client.get(reverse('request_metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('api_request_duration_seconds_count{view="user"} 2', body)
+        self.assertIn('api_request_db_queries_bucket{view="user",le="1"} 2', body)
+
+    def test_histogram_endpoint_is_private(self):
+        url = reverse('request_metrics')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.settings(API_METRICS_TOKEN='scrape-token'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        with self.settings(API_METRICS_ALLOWED_IPS=['127.0.0.1']):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_repeated_queries_are_reported(self):
+        from .middleware import RequestMetricsMiddleware
+
+        def view(request):
+            for _ in range(settings.API_METRICS_DUPLICATE_THRESHOLD):
+                list(User.objects.filter(id=self.user.id))
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        with self.assertLogs('api.metrics', level='WARNING') as logs:
+            RequestMetricsMiddleware(view)(request)
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['duplicates'][0]['count'], settings.API_METRICS_DUPLICATE_THRESHOLD)
+
+
+
+@override_settings(ROOT_URLCONF='reunion.asgi_urls')
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        auth.user_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='async1@test.com')
+        self.other = User.objects.create_user(username='otheruser', password='testpass', email='async2@test.com')
+        self.headers = {'authorization': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+
+    async def test_views_are_async(self):
+        from .async_views import user_profile
+        match = await sync_to_async(resolve)(reverse('user'))
+        self.assertIs(match.func, user_profile)
+
+    async def test_profile_and_follow(self):
+        response = await self.async_client.post(reverse('follow_user', args=[self.other.id]), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.post(reverse('follow_user', args=[self.other.id]), headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.post(reverse('follow_user', args=[9999]), headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get(reverse('user'), headers=self.headers)
+        self.assertEqual(response.json()['following_count'], 1)
+
+    async def test_posts_likes_and_comments(self):
+        response = await self.async_client.post(reverse('create_post'), {'title': 'Async', 'description': 'Post'}, content_type='application/json', headers=self.headers)
+        post_id = response.json()['id']
+        response = await self.async_client.post(reverse('like_post', args=[post_id]), headers=self.headers)
+        self.assertEqual(response.json()['message'], 'testuser liked this post!')
+        response = await self.async_client.post(reverse('add_comment', args=[post_id]), {'comment': 'Nice'}, headers=self.headers)
+        self.assertIn('comment_id', response.json())
+
+        response = await self.async_client.get(reverse('all_posts'), headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        post = response.json()['posts'][0]
+        self.assertEqual((len(post['likes']), len(post['comments'])), (1, 1))
+
+        response = await self.async_client.get(reverse('delete_post', args=[post_id]))
+        self.assertEqual(response.json()['comments_count'], 1)
+        response = await self.async_client.get(reverse('post_comments', args=[post_id]))
+        self.assertEqual(response.json()['comments'][0]['content'], 'Nice')
+
+        response = await self.async_client.post(reverse('unlike_post', args=[post_id]), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.delete(reverse('delete_post', args=[post_id]), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_feed_and_errors(self):
+        await sync_to_async(Post.objects.create)(title='Hello', content='World', author=self.other)
+        await self.async_client.post(reverse('follow_user', args=[self.other.id]), headers=self.headers)
+        response = await self.async_client.get(reverse('home_feed'), headers=self.headers)
+        self.assertEqual([post['title'] for post in response.json()['posts']], ['Hello'])
+
+        response = await self.async_client.get(reverse('home_feed'))
+        self.assertEqual((response.status_code, response.json()['error']), (401, 'Unauthorized'))
+        response = await self.async_client.get(reverse('create_post'), headers=self.headers)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_like_by_deleted_user_writes_nothing(self):
+        post = await sync_to_async(Post.objects.create)(title='Hello', content='World', author=self.other)
+        headers = {'authorization': 'Bearer ' + jwt.encode({'user_id': 9999}, 'secret_key', algorithm='HS256')}
+        response = await self.async_client.post(reverse('like_post', args=[post.id]), headers=headers)
+        self.assertEqual(response.status_code, 404)
+        await sync_to_async(post.refresh_from_db)()
+        self.assertEqual(post.likes_count, 0)
+
+    async def test_queries_are_recorded(self):
+        response = await self.async_client.get(reverse('user'), headers=self.headers)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+
+
+class ProductionProfileTestCase(TestCase):
+    def setUp(self):
+        self.production = import_module('reunion.settings_production')
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='prod1@test.com')
+        self.other = User.objects.create_user(username='otheruser', password='testpass', email='prod2@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+
+    def test_profile(self):
+        self.assertFalse(self.production.DEBUG)
+        self.assertGreater(self.production.DATABASES['default']['CONN_MAX_AGE'], 0)
+        self.assertTrue(self.production.DATABASES['default']['CONN_HEALTH_CHECKS'])
+        self.assertNotIn('django.contrib.sessions.middleware.SessionMiddleware', self.production.MIDDLEWARE)
+        self.assertNotIn('django.middleware.csrf.CsrfViewMiddleware', self.production.MIDDLEWARE)
+
+    def test_api_under_lean_middleware(self):
+        with self.settings(MIDDLEWARE=self.production.MIDDLEWARE):
+            client = Client(enforce_csrf_checks=True)
+            response = client.post(reverse('authenticate_user'), json.dumps({'username': 'testuser', 'password': 'testpass'}), content_type='application/json')
+            self.assertIn('token', response.json())
+            response = client.post(reverse('follow_user', args=[self.other.id]), **self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(client.get(reverse('user'), **self.auth).json()['following_count'], 1)
+
+
+class ServingBenchmarkTestCase(LiveServerTestCase):
+    def test_compares_profiles(self):
+        out = StringIO()
+        call_command(
+            'benchmark', 'serving', users=8, avg_posts=2, requests=4, concurrency=2, routes=['user', 'all_posts'],
+            url=[f'dev={self.live_server_url}', f'production={self.live_server_url}'], stdout=out, stderr=StringIO(),
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['profiles']), {'dev', 'production'})
+        self.assertEqual(report['profiles']['production']['all_posts']['status_codes'], {'201': 4})
+        self.assertIn('user', report['speedup']['production'])
+
+
+
+class QueryPlanTestCase(TestCase):
+    # Runs EXPLAIN on every statement the endpoints issue against a seeded graph
+    # and fails on full table scans and sort steps. On Postgres the planner is
+    # told to avoid both, so any that remain have no index to use instead.
+    STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+    # Search results are ordered by a score computed per query, so the matches
+    # always have to be sorted; the full-text index keeps that set small
+    SORTED_ROUTES = {'search_posts'}
+    # Suggestions load the follow graph in one pass over the through table's
+    # covering index, once per process
+    FULL_INDEX_ROUTES = {'suggested_users'}
+
+    def setUp(self):
+        from .benchmarks import seed
+        from .benchmarks.endpoints import Context
+
+        default_cache.clear()
+        suggestions.store.clear()
+        user_ids, post_ids = seed.seed_graph(30, 5, 3, 3, 2, prefix='plan_', seed=1, stdout=StringIO())
+        self.ctx = Context(user_ids, post_ids)
+
+    def explain(self, sql, params, sorted_route=False, full_index_route=False):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('SET LOCAL enable_sort = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                pattern = r'Seq Scan' if sorted_route else r'Seq Scan|\bSort\b'
+                return [row[0] for row in cursor.fetchall() if re.search(pattern, row[0])]
+            # SQLite also says SCAN for reading constant rows and subquery results,
+            # and for FTS5 lookups, which show up as a MATCH (:M) on a virtual table
+            tables = set(connection.introspection.table_names(cursor))
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [
+                detail for *_, detail in cursor.fetchall()
+                if (detail.startswith('USE TEMP B-TREE') and not sorted_route)
+                or (detail.startswith('SCAN ') and detail.split()[1] in tables and not re.search(r'VIRTUAL TABLE INDEX \d+:M', detail)
+                    and not (full_index_route and 'USING COVERING INDEX' in detail))
+            ]
+
+    def request(self, user_id, method, path, body='', content_type=None):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            if not many and sql.lstrip().upper().startswith(self.STATEMENTS):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        extra = {'HTTP_AUTHORIZATION': f'Bearer {self.ctx.tokens[user_id]}'}
+        if content_type:
+            extra['content_type'] = content_type
+        with connection.execute_wrapper(record):
+            response = Client(SERVER_NAME='localhost').generic(method, path, body, **extra)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        route = resolve(path.split('?')[0]).url_name
+        for sql, params in statements:
+            explained = self.explain(sql, params, route in self.SORTED_ROUTES, route in self.FULL_INDEX_ROUTES)
+            self.assertEqual(explained, [], f'{method} {path}: {sql}')
+        return response
+
+    @override_settings(FEED_FANOUT_THRESHOLD=2)
+    def test_no_scans_or_sorts(self):
+        from .benchmarks.endpoints import SCENARIOS
+
+        rng = random.Random(0)
+        for name, scenario in SCENARIOS.items():
+            for _ in range(3):
+                user_id = rng.choice(self.ctx.user_ids)
+                self.request(user_id, *scenario(self.ctx, rng, user_id))
+
+        # second pages of the paginated endpoints
+        user_id = self.ctx.user_ids[0]
+        for path in [reverse('all_posts'), reverse('home_feed'), reverse('post_comments', args=[self.ctx.post_ids[0]])]:
+            cursor = self.request(user_id, 'GET', f'{path}?limit=1').json()['next_cursor']
+            if cursor:
+                self.request(user_id, 'GET', f'{path}?limit=1&cursor={cursor}')
+
+
+
+class ExportPostsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='export1@test.com')
+        self.other = User.objects.create_user(username='otheruser', password='testpass', email='export2@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+        self.posts = [Post.objects.create(title=f'Post {i}', content='content', author=self.user) for i in range(5)]
+        Post.objects.create(title='Other', content='content', author=self.other)
+        Comment.objects.create(post=self.posts[0], author=self.other, content='Nice')
+        self.posts[1].likes.add(self.other)
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_posts'), params, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_streams_every_post_oldest_first(self):
+        rows = self.export()
+        self.assertEqual([row['id'] for row in rows], [post.id for post in self.posts])
+        self.assertEqual(rows[0]['comments'][0]['content'], 'Nice')
+        self.assertEqual(rows[1]['likes'], [{'id': self.other.id, 'username': 'otheruser'}])
+
+    def test_resume_after(self):
+        rows = self.export(after=self.posts[2].id)
+        self.assertEqual([row['id'] for row in rows], [post.id for post in self.posts[3:]])
+
+    def test_invalid_after(self):
+        other_post = Post.objects.get(author=self.other)
+        for after in ['abc', 9999, other_post.id]:
+            response = self.client.get(reverse('export_posts'), {'after': after}, **self.auth)
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_prefetches_per_chunk(self):
+        response = self.client.get(reverse('export_posts'), **self.auth)
+        # one read of the posts, plus comments and likes for each of the 3 chunks
+        with self.assertNumQueries(7):
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 5)
+
+    def test_requires_token(self):
+        response = self.client.get(reverse('export_posts'))
+        self.assertEqual(response.status_code, 401)
+
+
+
+class RenderersTestCase(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='render1@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+        self.post = Post.objects.create(title='Post', content='content', author=self.user)
+        Comment.objects.create(post=self.post, author=self.user, content='Nice')
+
+    def responses(self):
+        return [
+            self.client.get(reverse('all_posts'), **self.auth).json(),
+            self.client.get(reverse('delete_post', args=[self.post.id])).json(),
+        ]
+
+    @skipIf(renderers.orjson is None, 'orjson is not installed')
+    def test_renderers_agree(self):
+        with self.settings(API_RENDERER='api.renderers.ORJSONRenderer'):
+            self.assertIsInstance(renderers.get_renderer(), renderers.ORJSONRenderer)
+            fast = self.responses()
+        default_cache.clear()
+        with self.settings(API_RENDERER='api.renderers.StdlibRenderer'):
+            self.assertIsInstance(renderers.get_renderer(), renderers.StdlibRenderer)
+            self.assertEqual(self.responses(), fast)
+
+    @skipIf(renderers.orjson is None, 'orjson is not installed')
+    def test_native_datetimes(self):
+        with self.settings(API_RENDERER='api.renderers.ORJSONRenderer', API_JSON_NATIVE_DATETIMES=True):
+            response = self.client.get(reverse('all_posts'), **self.auth)
+        created_at = self.post.created_at.isoformat().replace('+00:00', 'Z')
+        self.assertEqual(response.json()['posts'][0]['created_at'], created_at)
+
+    def test_encoders_benchmark(self):
+        out = StringIO()
+        call_command('benchmark', 'encoders', posts=[5], repeat=2, stdout=out, stderr=StringIO())
+        results = json.loads(out.getvalue())['pages']['5']
+        self.assertIn('stdlib', results)
+        for name, result in results.items():
+            self.assertGreater(result['bytes'], 0)
+            self.assertTrue(result.get('same_as_stdlib', True) or name == 'orjson_native_datetimes', name)
+
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='search1@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+
+    def create_post(self, title, description):
+        response = self.client.post(reverse('create_post'), data=json.dumps({'title': title, 'description': description}),
+                                    content_type='application/json', **self.auth)
+        return response.json()['id']
+
+    def search(self, q, **params):
+        response = self.client.get(reverse('search_posts'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_title_matches_rank_first(self):
+        in_content = self.create_post('Weekend', 'We went hiking in the mountains')
+        in_title = self.create_post('Hiking trip', 'Photos from the weekend')
+        self.create_post('Cooking', 'A new recipe')
+        posts = self.search('hiking')['posts']
+        self.assertEqual([post['id'] for post in posts], [in_title, in_content])
+        self.assertEqual(posts[0]['author'], 'testuser')
+
+    def test_every_word_must_match(self):
+        both = self.create_post('Hiking trip', 'In the mountains')
+        self.create_post('Hiking trip', 'By the sea')
+        self.assertEqual([post['id'] for post in self.search('HIKING, mountains!')['posts']], [both])
+
+    def test_comments_are_indexed(self):
+        post_id = self.create_post('Weekend', 'Photos')
+        other_id = self.create_post('Holiday', 'Photos')
+        self.client.post(reverse('add_comment', args=[post_id]), {'comment': 'Lovely sunset'}, **self.auth)
+        self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [
+            {'action': 'comment', 'id': other_id, 'comment': 'What a sunset'},
+        ]}), content_type='application/json', **self.auth)
+        self.assertEqual({post['id'] for post in self.search('sunset')['posts']}, {post_id, other_id})
+
+    def test_deleted_posts_are_removed(self):
+        post_id = self.create_post('Hiking trip', 'In the mountains')
+        self.client.delete(reverse('delete_post', args=[post_id]), **self.auth)
+        self.assertEqual(self.search('hiking')['posts'], [])
+
+    def test_cursor_pagination(self):
+        ids = {self.create_post(f'Hiking trip {i}', 'In the mountains') for i in range(5)}
+        seen, cursor = [], None
+        while True:
+            page = self.search('hiking', limit=2, **({'cursor': cursor} if cursor else {}))
+            seen += [post['id'] for post in page['posts']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(set(seen), ids)
+
+    def test_bad_requests(self):
+        for params in [{}, {'q': ' ?! '}, {'q': 'hiking', 'cursor': 'abc'}, {'q': 'hiking', 'cursor': pagination.pack_cursor([1])}]:
+            response = self.client.get(reverse('search_posts'), params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_rebuild_command(self):
+        post = Post.objects.create(title='Hiking trip', content='In the mountains', author=self.user)
+        Comment.objects.create(post=post, author=self.user, content='Lovely sunset')
+        self.assertEqual(self.search('sunset')['posts'], [])
+        call_command('rebuild_search_index', batch_size=1, stdout=StringIO())
+        self.assertEqual([p['id'] for p in self.search('sunset')['posts']], [post.id])
+
+    def test_search_benchmark(self):
+        out = StringIO()
+        call_command('benchmark', 'search', posts=200, vocabulary=2000, queries=3, scan_queries=1, cleanup=True, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['posts'], 200)
+        self.assertEqual(set(report['queries']), {'common', 'mid', 'rare', 'two_terms'})
+        self.assertFalse(User.objects.filter(username__startswith='search_bench_').exists())
+
+
+
+class TrendingTestCase(TestCase):
+    HOUR = 60 * 60
+
+    def setUp(self):
+        trending.leaderboard.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='trend1@test.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+        self.likers = [User.objects.create_user(username=f'liker{i}', password='testpass', email=f'trend_liker{i}@test.com') for i in range(3)]
+        self.posts = [Post.objects.create(title=f'Post {i}', content='content', author=self.user) for i in range(3)]
+        # the middle of an epoch
+        self.now = trending.current_epoch(time.time()) + 12 * self.HOUR
+
+    def at(self, offset):
+        return mock.patch('api.trending.time', mock.Mock(time=lambda: self.now + offset))
+
+    def like(self, post, liker):
+        token = jwt.encode({'user_id': liker.id}, 'secret_key', algorithm='HS256')
+        self.client.post(reverse('like_post', args=[post.id]), HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def get_trending(self, **params):
+        response = self.client.get(reverse('trending_posts'), params)
+        self.assertEqual(response.status_code, 200)
+        return [(post['id'], post['score']) for post in response.json()['posts']]
+
+    @override_settings(TRENDING_HALF_LIFE=6 * 60 * 60)
+    def test_recent_engagement_ranks_first(self):
+        with self.at(-12 * self.HOUR):
+            for liker in self.likers:
+                self.like(self.posts[0], liker)
+        with self.at(0):
+            self.like(self.posts[1], self.likers[0])
+            self.client.post(reverse('add_comment', args=[self.posts[2].id]), {'comment': 'Nice'}, **self.auth)
+            self.assertEqual(self.get_trending(), [(self.posts[2].id, 2.0), (self.posts[1].id, 1.0), (self.posts[0].id, 0.75)])
+            self.assertEqual(self.get_trending(limit=1), [(self.posts[2].id, 2.0)])
+            self.client.post(reverse('unlike_post', args=[self.posts[1].id]), HTTP_AUTHORIZATION=f'Bearer {jwt.encode({"user_id": self.likers[0].id}, "secret_key", algorithm="HS256")}')
+            self.posts[2].delete()
+            self.assertEqual(self.get_trending(), [(self.posts[0].id, 0.75)])
+
+    @override_settings(TRENDING_HALF_LIFE=6 * 60 * 60, TRENDING_WINDOW=24 * 60 * 60)
+    def test_scores_carry_over_one_window(self):
+        with self.at(0):
+            self.like(self.posts[0], self.likers[0])
+            self.like(self.posts[1], self.likers[0])
+        with self.at(24 * self.HOUR):
+            self.like(self.posts[1], self.likers[1])
+            self.assertEqual(self.get_trending(), [(self.posts[1].id, 1.0625), (self.posts[0].id, 0.0625)])
+            trending.leaderboard.clear()
+            self.assertEqual(self.get_trending(), [(self.posts[1].id, 1.0625), (self.posts[0].id, 0.0625)])
+        with self.at(48 * self.HOUR):
+            self.like(self.posts[1], self.likers[2])
+            trending.leaderboard.clear()
+            self.assertEqual(self.get_trending(), [(self.posts[1].id, 1.066406)])
+            # the first post's row was older than the window and has been pruned
+            self.assertEqual(TrendingScore.objects.filter(post=self.posts[0]).count(), 0)
+
+    def test_batch_actions_are_recorded(self):
+        with self.at(0):
+            self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [
+                {'action': 'like', 'id': self.posts[0].id},
+                {'action': 'comment', 'id': self.posts[0].id, 'comment': 'Nice'},
+                {'action': 'comment', 'id': self.posts[1].id, 'comment': 'Nice'},
+            ]}), content_type='application/json', **self.auth)
+            self.assertEqual(self.get_trending(), [(self.posts[0].id, 3.0), (self.posts[1].id, 2.0)])
+
+    @override_settings(TRENDING_REFRESH=60)
+    def test_served_from_memory_between_refreshes(self):
+        with self.at(0):
+            self.like(self.posts[0], self.likers[0])
+            self.get_trending()
+            # a like made by another process
+            trending._add({self.posts[1].id: 5.0}, self.now)
+            with self.assertNumQueries(1):
+                self.assertEqual(self.get_trending(), [(self.posts[0].id, 1.0)])
+        with self.at(60):
+            self.assertEqual(self.get_trending()[0][0], self.posts[1].id)
+
+    def test_invalid_limit(self):
+        response = self.client.get(reverse('trending_posts'), {'limit': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+
+class SuggestionsTestCase(TestCase):
+    def setUp(self):
+        suggestions.store.clear()
+        self.users = {name: User.objects.create_user(username=name, password='testpass', email=f'{name}@suggest.test') for name in 'abcdef'}
+        for follower, followed in ['ab', 'ac', 'bd', 'be', 'cd', 'ce', 'cf', 'db']:
+            relations.follow(self.users[follower].id, self.users[followed].id)
+
+    def token(self, name):
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.users[name].id}, 'secret_key', algorithm='HS256')}
+
+    def get_suggestions(self, name, **params):
+        response = self.client.get(reverse('suggested_users'), params, **self.token(name))
+        self.assertEqual(response.status_code, 200)
+        return [(user['username'], user['mutual_count']) for user in response.json()['users']]
+
+    def test_ranked_by_mutual_follows(self):
+        self.assertEqual(self.get_suggestions('a'), [('d', 2), ('e', 2), ('f', 1)])
+        self.assertEqual(self.get_suggestions('a', limit=1), [('d', 2)])
+        # b is followed by d, but a already follows b
+        self.assertEqual(self.get_suggestions('c'), [('b', 1)])
+        self.assertEqual(self.get_suggestions('f'), [])
+
+    def test_follows_update_the_loaded_graph(self):
+        self.get_suggestions('a')
+        with self.assertNumQueries(0):
+            suggestions.suggest(self.users['a'].id, 10)
+        self.client.post(reverse('follow_user', args=[self.users['d'].id]), **self.token('a'))
+        self.client.post(reverse('unfollow_user', args=[self.users['c'].id]), **self.token('a'))
+        # a now follows b and d, which follow d, e and b
+        self.assertEqual(self.get_suggestions('a'), [('e', 1)])
+        self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [{'action': 'follow', 'id': self.users['e'].id}]}),
+                         content_type='application/json', **self.token('a'))
+        self.assertEqual(self.get_suggestions('a'), [])
+
+    def test_follows_made_during_a_load_are_kept(self):
+        load = suggestions.FollowGraph.load
+
+        def load_then_follow():
+            graph = load()
+            suggestions.follow(self.users['a'].id, [self.users['f'].id])
+            return graph
+
+        with mock.patch.object(suggestions.FollowGraph, 'load', side_effect=load_then_follow):
+            suggestions.store.reload()
+        self.assertEqual(suggestions.store.graph.following(self.users['a'].id), {self.users[name].id for name in 'bcf'})
+
+    def test_cache_expires(self):
+        self.assertEqual(self.get_suggestions('b'), [])
+        relations.follow(self.users['d'].id, self.users['f'].id)
+        suggestions.store.reload()
+        self.assertEqual(self.get_suggestions('b'), [])
+        with mock.patch('api.suggestions.time.time', return_value=time.time() + settings.SUGGESTIONS_CACHE_TTL):
+            self.assertEqual(self.get_suggestions('b'), [('f', 1)])
+
+    def test_matches_the_orm_aggregate(self):
+        from .benchmarks.graph import orm_suggest
+
+        graph = suggestions.FollowGraph.load()
+        for user in self.users.values():
+            expected = [(row['from_user_id'], row['mutual']) for row in orm_suggest(user.id, 10)]
+            self.assertEqual(graph.suggest(user.id, 10), expected, user.username)
+
+    def test_requires_token(self):
+        self.assertEqual(self.client.get(reverse('suggested_users')).status_code, 401)
+
+    def test_suggestions_benchmark(self):
+        out = StringIO()
+        call_command('benchmark', 'suggestions', users=40, avg_following=4, queries=5, orm_queries=2, cleanup=True, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertGreater(report['graph']['edges'], 0)
+        self.assertEqual(report['in_memory']['requests'], 5)
+        self.assertEqual(report['orm_aggregate']['requests'], 2)
+        self.assertFalse(User.objects.filter(username__startswith='graph_bench_').exists())
+
+
+
+class RelationshipsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='rel0@test.com')
+        self.others = [User.objects.create_user(username=f'other{i}', password='testpass', email=f'rel{i + 1}@test.com') for i in range(4)]
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': self.user.id}, 'secret_key', algorithm='HS256')}
+        # the user follows others 0 and 1; others 1 and 2 follow the user
+        relations.follow(self.user.id, self.others[0].id)
+        relations.follow(self.user.id, self.others[1].id)
+        relations.follow(self.others[1].id, self.user.id)
+        relations.follow(self.others[2].id, self.user.id)
+
+    def lookup(self, ids):
+        return self.client.post(reverse('user_relationships'), data=json.dumps({'ids': ids}), content_type='application/json', **self.auth)
+
+    def test_follow_state_and_counters(self):
+        response = self.lookup([other.id for other in self.others] + [9999, self.others[0].id])
+        self.assertEqual(response.status_code, 200)
+        rows = response.json()['relationships']
+        self.assertEqual([row['id'] for row in rows], [other.id for other in self.others])
+        self.assertEqual([(row['following'], row['followed_by']) for row in rows], [(True, False), (True, True), (False, True), (False, False)])
+        self.assertEqual([(row['followers_count'], row['following_count']) for row in rows], [(1, 0), (1, 1), (0, 1), (0, 0)])
+        self.assertEqual(response.json()['not_found'], [9999])
+
+    def test_one_query(self):
+        ids = [other.id for other in self.others] + list(range(10000, 10300))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lookup(ids).status_code, 200)
+
+    @override_settings(RELATIONSHIPS_MAX_IDS=3)
+    def test_bad_requests(self):
+        self.assertEqual(self.lookup([other.id for other in self.others]).status_code, 400)
+        for body in ['{', json.dumps({'ids': 'abc'}), json.dumps({'ids': [1, 'a']}), json.dumps([1])]:
+            response = self.client.post(reverse('user_relationships'), data=body, content_type='application/json', **self.auth)
+            self.assertEqual(response.status_code, 400, body)
+        response = self.client.post(reverse('user_relationships'), data=json.dumps({'ids': [1]}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(ROOT_URLCONF='reunion.asgi_urls')
+    async def test_async_view(self):
+        token = await sync_to_async(jwt.encode)({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+        response = await self.async_client.post(reverse('user_relationships'), {'ids': [self.others[1].id]}, content_type='application/json',
+                                                headers={'authorization': f'Bearer {token}'})
+        self.assertEqual(response.json()['relationships'][0]['followed_by'], True)
+
+
+
+@override_settings(THROTTLE_RATES={'like': {'user': (3, 60), 'ip': (5, 60)}}, THROTTLE_BACKEND='api.throttling.LocalBackend')
+class ThrottlingTestCase(TestCase):
+    def setUp(self):
+        throttling.get_backend().clear()
+        self.users = [User.objects.create_user(username=f'user{i}', password='testpass', email=f'throttle{i}@test.com') for i in range(2)]
+        self.post = Post.objects.create(author=self.users[0], title='Post', content='content')
+
+    def like(self, user, **extra):
+        token = jwt.encode({'user_id': user.id}, 'secret_key', algorithm='HS256')
+        return self.client.post(reverse('like_post', args=[self.post.id]), HTTP_AUTHORIZATION=f'Bearer {token}', **extra)
+
+    def test_user_limit(self):
+        self.assertEqual([self.like(self.users[0]).status_code for _ in range(3)], [200, 400, 400])
+        with self.assertNumQueries(0):
+            response = self.like(self.users[0])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '20')
+        # another user behind the same address still has tokens
+        self.assertEqual(self.like(self.users[1]).status_code, 200)
+
+    def test_ip_limit(self):
+        for user, count in zip(self.users, (3, 2)):
+            for _ in range(count):
+                self.like(user)
+        # users[1] has a token left, but the address has used all five
+        self.assertEqual(self.like(self.users[1]).status_code, 429)
+        other = User.objects.create_user(username='other', password='testpass', email='other@test.com')
+        self.assertEqual(self.like(other, REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    def test_batch_costs_its_likes(self):
+        token = jwt.encode({'user_id': self.users[0].id}, 'secret_key', algorithm='HS256')
+
+        def send(count):
+            actions = [{'action': 'like', 'id': self.post.id}] * count + [{'action': 'follow', 'id': self.users[1].id}]
+            return self.client.post(reverse('batch_actions'), data=json.dumps({'actions': actions}), content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(send(4).status_code, 429)
+        self.assertEqual(send(3).status_code, 200)
+        self.assertEqual(self.like(self.users[0]).status_code, 429)
+
+    def test_bucket_refills_and_is_swept(self):
+        backend = throttling.LocalBackend()
+        self.assertEqual([backend.take('key', 2, 10, now=0) for _ in range(3)], [0, 0, 5])
+        self.assertEqual(backend.take('key', 2, 10, now=5), 0)
+        self.assertEqual(backend.take('key', 2, 10, cost=2, now=5), 10)
+        backend.sweep(15)
+        self.assertEqual(backend.buckets, {})
+
+    @override_settings(THROTTLE_BACKEND='api.throttling.CacheBackend')
+    def test_cache_backend(self):
+        default_cache.clear()
+        self.assertIsInstance(throttling.get_backend(), throttling.CacheBackend)
+        self.assertEqual([self.like(self.users[0]).status_code for _ in range(4)], [200, 400, 400, 429])
+
+    @override_settings(ROOT_URLCONF='reunion.asgi_urls')
+    async def test_async_views(self):
+        token = await sync_to_async(jwt.encode)({'user_id': self.users[0].id}, 'secret_key', algorithm='HS256')
+        statuses = []
+        for _ in range(4):
+            response = await self.async_client.post(reverse('like_post', args=[self.post.id]), headers={'authorization': f'Bearer {token}'})
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [200, 400, 400, 429])
+
+    def test_throttle_benchmark(self):
+        out = StringIO()
+        with override_settings(THROTTLE_RATES=settings.THROTTLE_RATES):
+            call_command('benchmark', 'throttle', keys=10, checks=100, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['microseconds_per_take']), {'local', 'cache'})
+        self.assertGreater(report['microseconds_per_check'], 0)
+
+
+class LoginTestCase(TestCase):
+    def setUp(self):
+        login.verified.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='login@test.com')
+
+    def authenticate(self, password='testpass'):
+        return self.client.post(reverse('authenticate_user'), json.dumps({'username': 'testuser', 'password': password}), content_type='application/json')
+
+    def test_tokens(self):
+        data = self.authenticate().json()
+        self.assertEqual(data['expires_in'], settings.JWT_ACCESS_TOKEN_LIFETIME)
+        payload = jwt.decode(data['token'], 'secret_key', algorithms=['HS256'])
+        self.assertAlmostEqual(payload['exp'], time.time() + settings.JWT_ACCESS_TOKEN_LIFETIME, delta=5)
+        self.assertEqual(self.client.get(reverse('user'), HTTP_AUTHORIZATION=f'Bearer {data["token"]}').status_code, 200)
+        # a refresh token is not an access token
+        self.assertEqual(self.client.get(reverse('user'), HTTP_AUTHORIZATION=f'Bearer {data["refresh"]}').status_code, 400)
+
+    def test_refresh(self):
+        data = self.authenticate().json()
+        refresh = lambda token: self.client.post(reverse('refresh_token'), json.dumps({'refresh': token}), content_type='application/json')
+        with self.assertNumQueries(1):
+            response = refresh(data['refresh'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('user'), HTTP_AUTHORIZATION=f'Bearer {response.json()["token"]}').status_code, 200)
+        self.assertEqual(refresh(data['token']).json(), {'error': 'Invalid refresh token'})
+        self.assertEqual(refresh(None).status_code, 400)
+        expired = jwt.encode({'user_id': self.user.id, 'type': 'refresh', 'exp': datetime.utcnow() - timedelta(minutes=1)}, 'secret_key', algorithm='HS256')
+        self.assertEqual(refresh(expired).json(), {'error': 'Refresh token has expired'})
+        # changing the password revokes the refresh tokens issued before
+        self.user.set_password('newpass')
+        self.user.save()
+        self.assertEqual(refresh(data['refresh']).status_code, 401)
+
+    def test_rehash_on_login(self):
+        with override_settings(PASSWORD_HASHERS=['api.hashers.PBKDF2PasswordHasher'], PASSWORD_PBKDF2_ITERATIONS=1000):
+            self.user.set_password('testpass')
+            self.user.save()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1000$'))
+        self.assertEqual(self.authenticate().status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('scrypt$16384$'))
+        # so does a change of cost
+        login.verified.clear()
+        with override_settings(PASSWORD_SCRYPT_WORK_FACTOR=2 ** 12):
+            self.assertEqual(self.authenticate().status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('scrypt$4096$'))
+        self.assertTrue(self.user.check_password('testpass'))
+
+    def test_repeated_login_skips_hash(self):
+        self.assertEqual(self.authenticate().status_code, 200)
+        with mock.patch('api.login._check', side_effect=AssertionError), self.assertNumQueries(1):
+            self.assertEqual(self.authenticate().status_code, 200)
+        self.assertEqual(self.authenticate('wrongpass').status_code, 401)
+        self.user.set_password('newpass')
+        self.user.save()
+        self.assertEqual(self.authenticate().status_code, 401)
+        self.assertEqual(self.authenticate('newpass').status_code, 200)
+
+    def test_inactive_and_unknown_users(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.authenticate().status_code, 401)
+        response = self.client.post(reverse('authenticate_user'), json.dumps({'username': 'nobody', 'password': 'testpass'}), content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE=0)
+    def test_busy_pool(self):
+        release = threading.Event()
+        busy = login.get_pool().submit(release.wait)
+        try:
+            response = self.authenticate()
+        finally:
+            release.set()
+            busy.result()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.authenticate().status_code, 200)
+
+    @override_settings(ROOT_URLCONF='reunion.asgi_urls')
+    async def test_async_view(self):
+        from .async_views import authenticate_user
+        self.assertIs(resolve(reverse('authenticate_user')).func, authenticate_user)
+        response = await self.async_client.post(reverse('authenticate_user'), {'username': 'testuser', 'password': 'testpass'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('refresh', response.json())
+        response = await self.async_client.post(reverse('authenticate_user'), {'username': 'testuser', 'password': 'wrong'}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_login_benchmark(self):
+        out = StringIO()
+        with override_settings(PASSWORD_PBKDF2_ITERATIONS=1000):
+            call_command('benchmark', 'login', hashers=['scrypt', 'pbkdf2'], logins=1, cached_logins=2, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertGreater(report['hashers']['scrypt']['cached']['logins_per_sec_per_core'], 0)
+        self.assertFalse(User.objects.filter(username='login_bench').exists())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        routers.health.clear()
+        patcher = mock.patch('api.routers.check_replica', return_value=True)
+        self.check_replica = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='testuser', password='testpass', email='replica1@test.com')
+        self.other = User.objects.create_user(username='otheruser', password='testpass', email='replica2@test.com')
+        self.factory = RequestFactory()
+
+    def request(self, method='get', user=None, write=False, status=200):
+        # Runs a request through the middleware and returns the aliases its reads
+        # would use, before and after an optional write
+        aliases = []
+
+        def view(request):
+            aliases.append(Post.objects.all().db)
+            if write:
+                Post.objects.filter(id=0).update(title='x')
+                aliases.append(Post.objects.all().db)
+            return HttpResponse(status=status)
+
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {jwt.encode({"user_id": user.id}, "secret_key", algorithm="HS256")}'} if user else {}
+        ReplicaRoutingMiddleware(view)(getattr(self.factory, method)('/', **headers))
+        return aliases
+
+    def test_reads_of_get_requests(self):
+        self.assertEqual(self.request(), ['replica'])
+        self.assertEqual(self.request(user=self.user), ['replica'])
+        self.assertEqual(self.request('post', user=self.user, status=400), ['default'])
+        self.assertEqual(self.request(user=self.user), ['replica'])
+        # outside a request, e.g. in management commands
+        self.assertEqual(Post.objects.all().db, 'default')
+
+    def test_writer_is_pinned(self):
+        self.assertEqual(self.request(user=self.user, write=True), ['replica', 'default'])
+        self.assertEqual(self.request(user=self.user), ['default'])
+        self.assertEqual(self.request(user=self.other), ['replica'])
+        self.assertEqual(self.request('post', user=self.other), ['default'])
+        self.assertEqual(self.request(user=self.other), ['default'])
+        default_cache.clear()
+        self.assertEqual(self.request(user=self.user), ['replica'])
+
+    def test_unhealthy_replica(self):
+        self.check_replica.return_value = False
+        self.assertEqual(self.request(), ['default'])
+        self.check_replica.return_value = True
+        self.assertEqual(self.request(), ['default'])
+        self.assertEqual(routers.health.healthy(['replica'], now=time.monotonic() + settings.REPLICA_HEALTH_INTERVAL), ['replica'])
+        self.assertEqual(self.request(), ['replica'])
+        self.assertEqual(self.check_replica.call_count, 2)
+
+    def test_check_replica(self):
+        mock.patch.stopall()
+        self.assertTrue(routers.check_replica('default'))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertEqual(self.request(), ['default'])
+        self.check_replica.assert_not_called()
+
+    def test_migrations_skip_replicas(self):
+        router = routers.ReplicaRouter()
+        self.assertIs(router.allow_migrate('replica', 'api'), False)
+        self.assertIsNone(router.allow_migrate('default', 'api'))
+
+    async def test_async_requests(self):
+        aliases = []
+
+        async def view(request):
+            aliases.append(await sync_to_async(lambda: Post.objects.all().db)())
+            await sync_to_async(Post.objects.filter(id=0).update)(title='x')
+            aliases.append(Post.objects.all().db)
+            return HttpResponse()
+
+        token = await sync_to_async(jwt.encode)({'user_id': self.user.id}, 'secret_key', algorithm='HS256')
+        await ReplicaRoutingMiddleware(view)(self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+        self.assertEqual(aliases, ['replica', 'default'])
+        self.assertTrue(routers.is_pinned(self.user.id))
+
+
+SHARDS = ['default', 'shard1', 'shard2']
+
+
+@skipUnless(set(SHARDS) <= set(settings.DATABASES), 'shard1 and shard2 are configured by reunion.settings_local')
+@override_settings(SHARDS=SHARDS)
+class ShardingTestCase(TestCase):
+    databases = set(SHARDS) & set(settings.DATABASES)
+
+    def setUp(self):
+        default_cache.clear()
+        auth.user_cache.clear()
+        trending.leaderboard.clear()
+        # With three shards, logical shards 0-341 are on 'default', 342-682 on
+        # 'shard1' and 683-1023 on 'shard2'
+        self.on_default = User.objects.create(id=1, username='ondefault', email='shard0@test.com')
+        self.on_shard1 = User.objects.create(id=400, username='onshard1', email='shard1@test.com')
+        self.on_shard2 = User.objects.create(id=800, username='onshard2', email='shard2@test.com')
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': user.id}, 'secret_key', algorithm='HS256')}
+
+    def create_post(self, user, title='Hiking trip', description='In the mountains'):
+        response = self.client.post(reverse('create_post'), data=json.dumps({'title': title, 'description': description}),
+                                    content_type='application/json', **self.auth(user))
+        return response.json()['id']
+
+    def queries(self):
+        # One CaptureQueriesContext per shard, entered together
+        contexts = {alias: CaptureQueriesContext(connections[alias]) for alias in SHARDS}
+        stack = ExitStack()
+        for context in contexts.values():
+            stack.enter_context(context)
+        self.addCleanup(stack.close)
+        return stack, contexts
+
+    def test_taken_ids_are_drawn_again(self):
+        # Another process took the first id drawn for the post, and for a comment
+        taken = self.create_post(self.on_shard1)
+        fresh = sharding.new_post_id(self.on_shard1.id)
+        with mock.patch.object(sharding, 'new_post_id', side_effect=[taken, fresh]):
+            self.assertEqual(self.create_post(self.on_shard1), fresh)
+
+        comment = Comment.objects.using('shard1').create(post_id=taken, author=self.on_default, content='First')
+        fresh = sharding.new_comment_id(taken)
+        with mock.patch.object(sharding, 'new_comment_id', side_effect=[comment.id, fresh]):
+            response = self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [{'action': 'comment', 'id': taken, 'comment': 'Second'}]}),
+                                        content_type='application/json', **self.auth(self.on_default))
+        self.assertEqual(response.json()['results'], [{'status': 200, 'comment_id': fresh}])
+        self.assertEqual(Post.objects.using('shard1').get(id=taken).comments_count, 1)
+
+    def test_deleted_users_leave_nothing_behind(self):
+        own = self.create_post(self.on_shard1)
+        other = self.create_post(self.on_shard2)
+        self.client.post(reverse('like_post', args=[other]), **self.auth(self.on_shard1))
+        self.client.post(reverse('add_comment', args=[other]), {'comment': 'Nice'}, **self.auth(self.on_shard1))
+        self.client.post(reverse('like_post', args=[own]), **self.auth(self.on_shard2))
+        self.client.get(reverse('trending_posts'))
+        auth = self.auth(self.on_shard1)
+        self.on_shard1.delete()
+
+        self.assertFalse(Post.objects.using('shard1').filter(id=own).exists())
+        post = Post.objects.using('shard2').get(id=other)
+        self.assertEqual((post.likes_count, post.comments_count), (0, 0))
+        self.assertFalse(Comment.objects.using('shard2').exists())
+        self.assertEqual(self.client.get(reverse('delete_post', args=[other])).status_code, 200)
+        self.assertEqual([p['id'] for p in self.client.get(reverse('trending_posts')).json()['posts']], [other])
+
+        # The token outlives the user, but writes nothing
+        response = self.client.post(reverse('add_comment', args=[other]), {'comment': 'Nice'}, **auth)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [{'action': 'like', 'id': other}]}),
+                                    content_type='application/json', **auth)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(PostLike.objects.using('shard2').exists())
+
+    def test_benchmark_counts_queries_on_every_alias(self):
+        from .benchmarks import endpoints
+        post_id = self.create_post(self.on_shard1)
+        ctx = mock.Mock(user_ids=[self.on_default.id], post_ids=[post_id], tokens={self.on_default.id: 'unused'})
+        report = endpoints.drive(ctx, 'post_comments', 1, 1, 0)
+        # The post's existence check and its comments, both on 'shard1'
+        self.assertEqual((report['status_codes'], report['queries_per_request']), ({'200': 1}, 2))
+
+    def test_ids(self):
+        id = sharding.make_id(500, ms=sharding.ID_EPOCH_MS + 1234, sequence=7)
+        self.assertEqual(sharding.logical_shard_of_id(id), 500)
+        self.assertEqual(id >> 22, 1234)
+        self.assertEqual(sharding.logical_shard_of_id(sharding.new_comment_id(id)), 500)
+        self.assertEqual([sharding.alias_of_logical_shard(n) for n in (0, 341, 342, 682, 683, 1023)],
+                         ['default', 'default', 'shard1', 'shard1', 'shard2', 'shard2'])
+        self.assertEqual(sharding.for_post(sharding.new_post_id(self.on_shard2.id)), 'shard2')
+        self.assertEqual(sharding.for_post(id, ['default']), 'default')
+
+    def test_posts_live_on_author_shard(self):
+        post_id = self.create_post(self.on_shard1)
+        self.assertEqual(sharding.logical_shard_of_id(post_id), 400)
+        self.assertTrue(Post.objects.using('shard1').filter(id=post_id).exists())
+        self.assertFalse(Post.objects.using('default').filter(id=post_id).exists())
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.on_shard1, post_id=post_id).exists())
+
+        self.client.post(reverse('like_post', args=[post_id]), **self.auth(self.on_shard2))
+        response = self.client.post(reverse('add_comment', args=[post_id]), {'comment': 'Nice'}, **self.auth(self.on_default))
+        comment_id = response.json()['comment_id']
+        self.assertTrue(Comment.objects.using('shard1').filter(id=comment_id, post_id=post_id).exists())
+        post = Post.objects.using('shard1').get(id=post_id)
+        self.assertEqual((post.likes_count, post.comments_count), (1, 1))
+
+        response = self.client.get(reverse('delete_post', args=[post_id]))
+        self.assertEqual(response.json()['author'], 'onshard1')
+        self.assertEqual(response.json()['comments'][0]['author__username'], 'ondefault')
+        response = self.client.get(reverse('post_comments', args=[post_id]))
+        self.assertEqual([c['id'] for c in response.json()['comments']], [comment_id])
+
+        self.client.delete(reverse('delete_post', args=[post_id]), **self.auth(self.on_shard1))
+        self.assertFalse(Post.objects.using('shard1').filter(id=post_id).exists())
+        self.assertFalse(TimelineEntry.objects.filter(post_id=post_id).exists())
+
+    def test_author_reads_touch_one_shard(self):
+        post_id = self.create_post(self.on_shard2)
+        self.client.post(reverse('like_post', args=[post_id]), **self.auth(self.on_shard1))
+        stack, queries = self.queries()
+        with stack:
+            response = self.client.get(reverse('all_posts'), **self.auth(self.on_shard2))
+        self.assertEqual(response.json()['posts'][0]['likes'], [{'id': 400, 'username': 'onshard1'}])
+        self.assertEqual(len(queries['shard1']), 0)
+        self.assertGreater(len(queries['shard2']), 0)
+
+    def test_batch_actions(self):
+        first, second = self.create_post(self.on_shard1), self.create_post(self.on_shard2)
+        response = self.client.post(reverse('batch_actions'), data=json.dumps({'actions': [
+            {'action': 'like', 'id': first},
+            {'action': 'like', 'id': second},
+            {'action': 'comment', 'id': second, 'comment': 'Nice'},
+        ]}), content_type='application/json', **self.auth(self.on_default))
+        self.assertEqual([r['status'] for r in response.json()['results']], [200, 200, 200])
+        self.assertEqual(Post.objects.using('shard1').get(id=first).likes_count, 1)
+        self.assertEqual(Post.objects.using('shard2').get(id=second).comments_count, 1)
+        self.assertEqual(sharding.for_post(response.json()['results'][2]['comment_id']), 'shard2')
+
+    def test_feed_search_and_trending_span_shards(self):
+        ids = [self.create_post(user, title=f'Hiking {user.username}') for user in (self.on_default, self.on_shard1, self.on_shard2)]
+        for author in (self.on_default, self.on_shard1, self.on_shard2):
+            self.client.post(reverse('follow_user', args=[author.id]), **self.auth(self.on_default))
+        for post_id in ids:
+            self.client.post(reverse('like_post', args=[post_id]), **self.auth(self.on_default))
+
+        response = self.client.get(reverse('home_feed'), **self.auth(self.on_default))
+        self.assertEqual([post['id'] for post in response.json()['posts']], ids[::-1])
+        response = self.client.get(reverse('search_posts'), {'q': 'hiking'})
+        self.assertEqual({post['id'] for post in response.json()['posts']}, set(ids))
+        response = self.client.get(reverse('trending_posts'))
+        self.assertEqual({post['id'] for post in response.json()['posts']}, set(ids))
+
+    def test_reshard(self):
+        with override_settings(SHARDS=['default']):
+            posts = {user.id: Post.objects.create(title='Hiking trip', content='In the mountains', author=user)
+                     for user in (self.on_default, self.on_shard1, self.on_shard2)}
+            post = posts[self.on_shard2.id]
+            Comment.objects.create(post=post, author=self.on_default, content='Lovely sunset')
+            relations.like(post.id, self.on_shard1.id)
+            trending.record([(post.id, settings.TRENDING_LIKE_WEIGHT, None)])
+            TimelineEntry.objects.create(owner=self.on_default, post=post, post_created_at=post.created_at)
+            notifications.record([(Notification.LIKE, self.on_shard2.id, self.on_shard1.id, post.id, None)])
+            call_command('rebuild_search_index', stdout=StringIO())
+            out = StringIO()
+            call_command('reshard', *SHARDS, batch_size=2, stdout=out)
+        self.assertIn(f'Set SHARDS = {SHARDS!r}', out.getvalue())
+
+        for user_id, alias in [(self.on_default.id, 'default'), (self.on_shard1.id, 'shard1'), (self.on_shard2.id, 'shard2')]:
+            self.assertEqual(list(Post.objects.using(alias).values_list('author_id', flat=True)), [user_id])
+        post_id = Post.objects.using('shard2').get().id
+        self.assertEqual(sharding.logical_shard_of_id(post_id), 800)
+        self.assertEqual(Comment.objects.using('shard2').get().post_id, post_id)
+        self.assertEqual(TimelineEntry.objects.get().post_id, post_id)
+        self.assertEqual(Notification.objects.get().post_id, post_id)
+        self.assertEqual(TrendingScore.objects.using('shard2').get().post_id, post_id)
+        self.assertFalse(Comment.objects.using('default').exists())
+
+        response = self.client.get(reverse('delete_post', args=[post_id]))
+        self.assertEqual((response.json()['likes_count'], len(response.json()['comments'])), (1, 1))
+        response = self.client.get(reverse('search_posts'), {'q': 'sunset'})
+        self.assertEqual([p['id'] for p in response.json()['posts']], [post_id])
+
+
+@override_settings(TASK_RETRY_DELAY=0)
+class TasksTestCase(TestCase):
+    def setUp(self):
+        trending.leaderboard.clear()
+        self.author = User.objects.create_user(username='author', password='testpass', email='tasks1@test.com')
+        self.reader = User.objects.create_user(username='reader', password='testpass', email='tasks2@test.com')
+        self.calls, self.failures = [], []
+        patcher = mock.patch.dict(tasks.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tasks.task('test.single')(lambda n: self.calls.append(n))
+        tasks.task('test.batch', batch=True)(lambda payloads: self.calls.append([n for n, in payloads]))
+        tasks.task('test.failing')(self.fail_once)
+
+    def fail_once(self, n):
+        if n not in self.failures:
+            self.failures.append(n)
+            raise ValueError(n)
+        self.calls.append(n)
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': user.id}, 'secret_key', algorithm='HS256')}
+
+    @override_settings(TASK_BACKEND='api.tasks.DatabaseBackend')
+    def test_database_backend_defers_side_effects(self):
+        self.client.post(reverse('follow_user', args=[self.author.id]), **self.auth(self.reader))
+        response = self.client.post(reverse('create_post'), data=json.dumps({'title': 'Hiking trip', 'description': 'In the mountains'}),
+                                    content_type='application/json', **self.auth(self.author))
+        post_id = response.json()['id']
+        self.client.post(reverse('like_post', args=[post_id]), **self.auth(self.reader))
+        self.client.post(reverse('add_comment', args=[post_id]), {'comment': 'Lovely sunset'}, **self.auth(self.reader))
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEqual(sorted(Job.objects.values_list('name', flat=True)),
+                         ['backfill', 'fan_out_post', 'index_comments', 'notify', 'notify', 'notify', 'trending', 'trending'])
+
+        with mock.patch.object(trending, 'record', wraps=trending.record) as record:
+            out = StringIO()
+            call_command('run_tasks', once=True, stdout=out)
+        self.assertIn('Ran 8 jobs', out.getvalue())
+        # The like and the comment are scored together
+        record.assert_called_once()
+        self.assertEqual(set(Job.objects.values_list('status', flat=True)), {Job.DONE})
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.reader, post_id=post_id).exists())
+        self.assertEqual([p['id'] for p in self.client.get(reverse('search_posts'), {'q': 'sunset'}).json()['posts']], [post_id])
+        self.assertEqual([p['id'] for p in self.client.get(reverse('trending_posts')).json()['posts']], [post_id])
+
+    @override_settings(TASK_BACKEND='api.tasks.DatabaseBackend')
+    def test_batch_actions_are_deferred(self):
+        self.client.post(reverse('create_post'), data=json.dumps({'title': 'Hiking trip', 'description': 'In the mountains'}),
+                         content_type='application/json', **self.auth(self.author))
+        post = Post.objects.get()
+        actions = [
+            {'action': 'like', 'id': post.id},
+            {'action': 'comment', 'id': post.id, 'comment': 'Lovely sunset'},
+            {'action': 'follow', 'id': self.author.id},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('batch_actions'), data=json.dumps({'actions': actions}),
+                                        content_type='application/json', **self.auth(self.reader))
+        self.assertEqual([r['status'] for r in response.json()['results']], [200, 200, 200])
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT') and '"api_job"' in q['sql']]), 1)
+        self.assertEqual(sorted(Job.objects.values_list('name', flat=True)),
+                         ['backfill', 'fan_out_post', 'index_comments', 'notify', 'notify', 'notify', 'trending'])
+        self.assertFalse(Notification.objects.exists())
+
+        call_command('run_tasks', once=True, stdout=StringIO())
+        self.assertEqual(Notification.objects.filter(recipient=self.author).count(), 3)
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.reader, post=post).exists())
+        self.assertEqual([p['id'] for p in self.client.get(reverse('search_posts'), {'q': 'sunset'}).json()['posts']], [post.id])
+
+    @override_settings(TASK_BACKEND='api.tasks.DatabaseBackend')
+    def test_counting_jobs_that_run_again_count_once(self):
+        post_id = self.client.post(reverse('create_post'), data=json.dumps({'title': 'Hiking trip', 'description': 'In the mountains'}),
+                                   content_type='application/json', **self.auth(self.author)).json()['id']
+        self.client.post(reverse('like_post', args=[post_id]), **self.auth(self.reader))
+        call_command('run_tasks', once=True, stdout=StringIO())
+        score = TrendingScore.objects.get(post_id=post_id).score
+        # A worker died before marking the jobs done: their lease runs out
+        Job.objects.filter(name__in=['trending', 'notify']).update(status=Job.QUEUED)
+        call_command('run_tasks', once=True, stdout=StringIO())
+        self.assertEqual(TrendingScore.objects.get(post_id=post_id).score, score)
+        self.assertEqual(Notification.objects.get(recipient=self.author).count, 1)
+        self.assertEqual(AppliedKey.objects.count(), 2)
+
+    @override_settings(TASK_KEY_TTL=0)
+    def test_database_idempotency_keys(self):
+        backend = tasks.DatabaseBackend()
+        backend.enqueue('test.single', [1], key='one')
+        backend.enqueue('test.single', [1], key='one')
+        backend.enqueue('test.single', [2])
+        backend.enqueue('test.single', [2])
+        self.assertEqual(backend.run_pending(), 3)
+        self.assertEqual(self.calls, [1, 2, 2])
+        self.assertEqual(backend.prune(), 3)
+        backend.enqueue('test.single', [1], key='one')
+        self.assertEqual(backend.run_pending(), 1)
+
+    @override_settings(TASK_MAX_ATTEMPTS=2)
+    def test_database_retries(self):
+        backend = tasks.DatabaseBackend()
+        backend.enqueue('test.failing', [1])
+        backend.enqueue('test.batch', [2])
+        backend.enqueue('test.batch', [3])
+        with self.assertLogs('api.tasks', 'WARNING'):
+            self.assertEqual(backend.run_pending(batch_size=10), 4)
+        self.assertEqual(self.calls, [[2, 3], 1])
+        self.assertEqual(Job.objects.get(name='test.failing').attempts, 2)
+
+        tasks.task('test.failing')(lambda n: 1 / 0)
+        backend.enqueue('test.failing', [4])
+        with self.assertLogs('api.tasks', 'WARNING') as logs:
+            backend.run_pending()
+        self.assertEqual(len(logs.records), 2)
+        job = Job.objects.get(args=[4])
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn('ZeroDivisionError', job.error)
+
+    @override_settings(TASK_BACKEND='api.tasks.LocalBackend', TASK_WORKERS=1, TASK_BATCH_SIZE=10)
+    def test_local_backend(self):
+        backend = tasks.get_backend()
+        with self.assertLogs('api.tasks', 'WARNING'):
+            # A job is handed to the workers when the transaction commits
+            with self.captureOnCommitCallbacks(execute=True):
+                for n in range(3):
+                    tasks.enqueue('test.batch', n)
+                tasks.enqueue('test.single', 3, key='three')
+                tasks.enqueue('test.single', 3, key='three')
+                tasks.enqueue('test.failing', 4)
+                self.assertEqual(self.calls, [])
+            self.assertTrue(backend.join(timeout=5))
+        # How the batch jobs are grouped depends on when the worker wakes up
+        ran = [n for call in self.calls for n in (call if isinstance(call, list) else [call])]
+        self.assertEqual(sorted(ran), [0, 1, 2, 3, 4])
+        self.assertEqual(self.failures, [4])
+
+    def test_immediate_backend(self):
+        tasks.enqueue('test.single', 1, key='one')
+        tasks.enqueue('test.single', 1, key='one')
+        self.assertEqual(self.calls, [1, 1])
+        with self.assertRaises(ValueError):
+            tasks.enqueue('test.failing', 2)
+
+    def test_fan_out_after_author_deleted(self):
+        # The job can run after the author is gone, with the post left on another shard
+        feed.fan_out_post(Post(id=1, author_id=9999, title='Orphan', content='Post', created_at=datetime.now()))
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark', 'tasks', jobs=20, backends=['database'], batch_sizes=[1, 10], stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['backends']['database']), {
+            'single_batch_size_1', 'batch_batch_size_1', 'single_batch_size_10', 'batch_batch_size_10',
+        })
+        self.assertFalse(Job.objects.exists())
+
+
+class NotificationsTestCase(TestCase):
+    def setUp(self):
+        throttling.get_backend().clear()
+        self.author = User.objects.create_user(username='author', password='testpass', email='notify0@test.com')
+        self.fans = [
+            User.objects.create_user(username=f'fan{i}', password='testpass', email=f'notify{i + 1}@test.com')
+            for i in range(4)
+        ]
+        self.post = Post.objects.create(author=self.author, title='Test Post', content='This is a test post.')
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': 'Bearer ' + jwt.encode({'user_id': user.id}, 'secret_key', algorithm='HS256')}
+
+    def stream(self, user, **params):
+        response = self.client.get(reverse('notifications'), params, **self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_likes_are_coalesced(self):
+        for fan in self.fans:
+            self.client.post(reverse('like_post', args=[self.post.id]), **self.auth(fan))
+        # Liking one's own post notifies nobody
+        self.client.post(reverse('like_post', args=[self.post.id]), **self.auth(self.author))
+
+        self.assertEqual(Notification.objects.count(), 1)
+        entry, = self.stream(self.author)['notifications']
+        self.assertEqual((entry['kind'], entry['post_id'], entry['actor'], entry['count']), ('like', self.post.id, 'fan3', 4))
+        self.assertEqual(entry['message'], 'fan3 and 3 others liked your post')
+        self.assertEqual(self.stream(self.fans[0])['notifications'], [])
+
+    def test_comments_and_follows(self):
+        self.client.post(reverse('add_comment', args=[self.post.id]), {'comment': 'Nice'}, **self.auth(self.fans[0]))
+        self.client.post(reverse('follow_user', args=[self.author.id]), **self.auth(self.fans[1]))
+        self.client.post(reverse('follow_user', args=[self.author.id]), **self.auth(self.fans[2]))
+
+        entries = self.stream(self.author)['notifications']
+        self.assertEqual([(e['kind'], e['post_id'], e['count']) for e in entries], [('follow', None, 2), ('comment', self.post.id, 1)])
+        self.assertEqual(entries[0]['message'], 'fan2 and 1 other started following you')
+        self.assertEqual(entries[1]['message'], 'fan0 commented on your post')
+
+    def test_record_merges_events_into_one_upsert_per_window(self):
+        now = datetime.fromisoformat('2024-01-01T12:00:00+00:00')
+        events = [(Notification.LIKE, self.author.id, fan.id, self.post.id, None) for fan in self.fans]
+        with CaptureQueriesContext(connection) as queries:
+            notifications.record(events, now)
+        self.assertEqual(len(queries), 2)
+        notifications.record(events[:1], now + timedelta(seconds=1))
+        notifications.record(events[:1], now + timedelta(seconds=settings.NOTIFICATION_WINDOW))
+        self.assertEqual(sorted(Notification.objects.values_list('count', flat=True)), [1, 5])
+
+    def test_record_counts_distinct_actors(self):
+        now = datetime.fromisoformat('2024-01-01T12:00:00+00:00')
+
+        def like(fan):
+            return (Notification.LIKE, self.author.id, fan.id, self.post.id, None)
+
+        notifications.record([like(self.fans[0]), like(self.fans[1]), like(self.fans[0])], now)
+        notification = Notification.objects.get()
+        self.assertEqual((notification.count, notification.actor_id), (2, self.fans[0].id))
+        # Liking again after an unlike, in a later batch
+        notifications.record([like(self.fans[0])], now + timedelta(seconds=1))
+        self.assertEqual(Notification.objects.get().count, 2)
+
+    def test_pagination_and_deleted_posts(self):
+        other = Post.objects.create(author=self.author, title='Other', content='Another post.')
+        for post in (self.post, other):
+            self.client.post(reverse('like_post', args=[post.id]), **self.auth(self.fans[0]))
+        self.client.post(reverse('follow_user', args=[self.author.id]), **self.auth(self.fans[0]))
+
+        first = self.stream(self.author, limit=2)
+        second = self.stream(self.author, limit=2, cursor=first['next_cursor'])
+        self.assertEqual([e['kind'] for e in first['notifications'] + second['notifications']], ['follow', 'like', 'like'])
+        self.assertIsNone(second['next_cursor'])
+
+        other.delete()
+        self.assertEqual([e['post_id'] for e in self.stream(self.author)['notifications']], [None, self.post.id])
+        response = self.client.get(reverse('notifications'))
+        self.assertEqual(response.status_code, 401)
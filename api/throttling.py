@@ -0,0 +1,149 @@
+import math
+import time
+from functools import lru_cache, wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .auth import TokenError, get_request_user_id
+from .renderers import JsonResponse
+
+# Token-bucket throttling of the write endpoints, per user and per client IP.
+#
+# A bucket of THROTTLE_RATES[scope][kind] = (requests, seconds) holds up to
+# `requests` tokens and gains one every seconds / requests. It is tracked as a
+# single timestamp, the time at which it will be full again (the "theoretical
+# arrival time" of GCRA): taking a token pushes it one interval later, and a
+# take that would push it more than a full bucket past now is refused. A key
+# whose timestamp has passed is a full bucket, so it can simply be forgotten.
+#
+# The check runs before the view authenticates the user, so a throttled request
+# costs no database work. The user id comes from the bearer token, whose
+# verification is cached by api/auth.py.
+
+
+class LocalBackend:
+    # Buckets of this process in a dict. Takes do not lock: two concurrent
+    # requests for the same key can both get its last token, which at worst
+    # lets through one extra request per thread. Buckets that have refilled
+    # are swept every SWEEP_INTERVAL seconds.
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.buckets = {}
+        self.swept_at = time.monotonic()
+
+    def take(self, key, requests, period, cost=1, now=None):
+        # Returns 0 when the tokens were taken, or the seconds to wait otherwise
+        now = time.monotonic() if now is None else now
+        if now - self.swept_at >= self.SWEEP_INTERVAL:
+            self.sweep(now)
+        interval = period / requests
+        full_at = max(self.buckets.get(key, now), now) + interval * cost
+        wait = full_at - now - period
+        if wait > 0:
+            return wait
+        self.buckets[key] = full_at
+        return 0
+
+    def sweep(self, now):
+        self.swept_at = now
+        for key, full_at in list(self.buckets.items()):
+            if full_at <= now:
+                self.buckets.pop(key, None)
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class CacheBackend:
+    # Buckets in the THROTTLE_CACHE_ALIAS cache, shared by every worker when it
+    # is Redis or Memcached; the local-memory cache stands in for them on a
+    # single process. Entries expire when the bucket is full again. The read
+    # and the write are separate round trips, so concurrent requests for one
+    # key may overshoot by about one request each.
+
+    def __init__(self):
+        self.cache = caches[settings.THROTTLE_CACHE_ALIAS]
+
+    def take(self, key, requests, period, cost=1, now=None):
+        now = time.time() if now is None else now
+        key = f'throttle:{key}'
+        interval = period / requests
+        full_at = max(self.cache.get(key, now), now) + interval * cost
+        wait = full_at - now - period
+        if wait > 0:
+            return wait
+        self.cache.set(key, full_at, timeout=math.ceil(full_at - now))
+        return 0
+
+    def clear(self):
+        pass
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return import_string(settings.THROTTLE_BACKEND)()
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting in ('THROTTLE_BACKEND', 'THROTTLE_CACHE_ALIAS'):
+        get_backend.cache_clear()
+
+
+def check(request, scope, cost=1):
+    # Takes cost tokens from the user's and the client IP's buckets for scope.
+    # Returns the seconds to wait when either is empty, or 0. The user's bucket
+    # is taken from first, so one user over their rate never drains the tokens
+    # of others sharing their address.
+    rates = settings.THROTTLE_RATES.get(scope)
+    if not rates or cost <= 0:
+        return 0
+    backend = get_backend()
+    keys = []
+    if 'user' in rates:
+        try:
+            keys.append(('user', f'{scope}:user:{get_request_user_id(request)}'))
+        except TokenError:
+            pass
+    if 'ip' in rates:
+        keys.append(('ip', f'{scope}:ip:{request.META.get("REMOTE_ADDR")}'))
+    for kind, key in keys:
+        wait = backend.take(key, *rates[kind], cost=cost)
+        if wait:
+            return wait
+    return 0
+
+
+def too_many_requests(wait):
+    response = JsonResponse({'error': 'Too many requests'}, status=429)
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+def throttle(scope):
+    # Answers 429 with Retry-After when the request is over the scope's rates.
+    # Works on both sync and async views.
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                wait = check(request, scope)
+                if wait:
+                    return too_many_requests(wait)
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            wait = check(request, scope)
+            if wait:
+                return too_many_requests(wait)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,218 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import idempotency, sharding
+from .models import Post, TrendingScore
+
+# Trending posts ranked by time-decayed engagement. Every like and comment adds
+# a weight that halves every TRENDING_HALF_LIFE seconds.
+#
+# Scores are stored with forward decay: time is cut into TRENDING_WINDOW long
+# epochs, and an event adds weight * 2^((t - epoch start) / half life) to its
+# post's row in api_trendingscore. Older events never have to be revisited, and
+# within an epoch rows compare by their stored score alone, so the top posts are
+# an index scan on (epoch, score). A row still holding a score from the previous
+# epoch is scaled down on its next write; anything older than that has fallen
+# out of the window and is dropped.
+#
+# Each process keeps the TRENDING_SIZE best posts in a sorted list. It is loaded
+# from the table on first use, updated in place by the writes the process
+# makes, and reloaded every TRENDING_REFRESH seconds to pick up the writes of
+# other processes. Each shard scores its own posts; the leaderboard is loaded
+# from the best rows of every shard.
+
+# Posts written per statement by record()
+RECORD_BATCH_SIZE = 500
+
+
+def current_epoch(now):
+    return int(now // settings.TRENDING_WINDOW * settings.TRENDING_WINDOW)
+
+
+def _scale(epoch, now):
+    # Factor taking a score stored against epoch to its value at now
+    return 2 ** (-(now - epoch) / settings.TRENDING_HALF_LIFE)
+
+
+def _table(field=None):
+    if field is None:
+        return connection.ops.quote_name(TrendingScore._meta.db_table)
+    return connection.ops.quote_name(TrendingScore._meta.get_field(field).column)
+
+
+def _case(column, values):
+    # CASE column WHEN key THEN value ... END, with its parameters
+    sql = 'CASE ' + column + ' WHEN %s THEN %s' * len(values) + ' END'
+    return sql, [param for item in values.items() for param in item]
+
+
+def _add(weights, now, using='default'):
+    # Adds weights[post id] to each post's stored score in one statement,
+    # rebasing a score from the previous epoch, dropping an older one and never
+    # going below zero. Returns the new stored scores of the posts that exist.
+    # The posts must all be on the using shard.
+    epoch = current_epoch(now)
+    increments = {post_id: weight / _scale(epoch, now) for post_id, weight in weights.items()}
+    table, post, epoch_column, score = _table(), _table('post'), _table('epoch'), _table('score')
+    post_table = connection.ops.quote_name(Post._meta.db_table)
+    initial, initial_params = _case(f'{post_table}.id', {post_id: max(increment, 0) for post_id, increment in increments.items()})
+    increment, increment_params = _case(f'{table}.{post}', increments)
+    kept = (
+        f'CASE WHEN {table}.{epoch_column} = %s THEN {table}.{score} '
+        f'WHEN {table}.{epoch_column} = %s THEN {table}.{score} * %s ELSE 0 END + {increment}'
+    )
+    kept_params = [
+        epoch, epoch - settings.TRENDING_WINDOW, 2 ** (-settings.TRENDING_WINDOW / settings.TRENDING_HALF_LIFE),
+        *increment_params,
+    ]
+    sql = (
+        f'INSERT INTO {table} ({post}, {epoch_column}, {score}) '
+        f'SELECT {post_table}.id, %s, {initial} FROM {post_table} WHERE {post_table}.id IN ({", ".join(["%s"] * len(increments))}) '
+        f'ON CONFLICT ({post}) DO UPDATE SET {score} = CASE WHEN {kept} > 0 THEN {kept} ELSE 0 END, {epoch_column} = %s '
+        f'RETURNING {post}, {score}'
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [epoch, *initial_params, *increments, *kept_params, *kept_params, epoch])
+        return dict(cursor.fetchall())
+
+
+class Leaderboard:
+    # The best posts as a list of (-stored score, -post id) in ascending order,
+    # so the first n entries are the top n, newest post first among equal scores
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+            self.scores = {}
+            self.epoch = None
+            self.loaded_at = None
+            self.pruned_epoch = None
+
+    def _rebase(self, epoch):
+        # Periodic decay: carry the stored scores over to a new epoch
+        if self.epoch is not None and self.epoch != epoch:
+            factor = _scale(self.epoch, epoch)
+            self.scores = {
+                post_id: score * factor
+                for post_id, score in self.scores.items()
+                if epoch - self.epoch <= settings.TRENDING_WINDOW
+            }
+            self.entries = sorted((-score, -post_id) for post_id, score in self.scores.items())
+        self.epoch = epoch
+
+    def _remove(self, post_id):
+        score = self.scores.pop(post_id, None)
+        if score is not None:
+            index = bisect.bisect_left(self.entries, (-score, -post_id))
+            del self.entries[index]
+
+    def update(self, post_id, score, epoch):
+        # Record the stored score a write returned, keeping at most TRENDING_SIZE posts
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            self._rebase(epoch)
+            self._remove(post_id)
+            if score > 0:
+                self.scores[post_id] = score
+                bisect.insort(self.entries, (-score, -post_id))
+            while len(self.entries) > settings.TRENDING_SIZE:
+                _, post_id = self.entries.pop()
+                del self.scores[-post_id]
+
+    def remove(self, post_id):
+        with self.lock:
+            self._remove(post_id)
+
+    def load(self, now):
+        # Read the best rows of the current and the previous epoch, two index
+        # scans of at most TRENDING_SIZE rows each per shard. The first load of
+        # an epoch also deletes the rows that have fallen out of the window.
+        epoch = current_epoch(now)
+        previous = epoch - settings.TRENDING_WINDOW
+        prune = self.pruned_epoch != epoch
+        scores = {}
+        for alias in settings.SHARDS:
+            rows = sharding.using(TrendingScore.objects, alias)
+            if prune:
+                rows.filter(epoch__lt=previous).delete()
+            for row_epoch in (epoch, previous):
+                factor = _scale(row_epoch, epoch)
+                best = (
+                    rows.filter(epoch=row_epoch, score__gt=0)
+                    .order_by('-score', '-post_id')
+                    .values_list('post_id', 'score')[:settings.TRENDING_SIZE]
+                )
+                for post_id, score in best:
+                    scores[post_id] = score * factor
+        self.pruned_epoch = epoch
+        entries = sorted((-score, -post_id) for post_id, score in scores.items())[:settings.TRENDING_SIZE]
+        with self.lock:
+            self.entries = entries
+            self.scores = {-post_id: -score for score, post_id in entries}
+            self.epoch = epoch
+            self.loaded_at = now
+
+    def top(self, n, now):
+        # The n best posts as a list of (post id, decayed score at now)
+        if self.loaded_at is None or now - self.loaded_at >= settings.TRENDING_REFRESH:
+            self.load(now)
+        epoch = current_epoch(now)
+        with self.lock:
+            self._rebase(epoch)
+            factor = _scale(epoch, now)
+            return [(-post_id, -score * factor) for score, post_id in self.entries[:n]]
+
+
+leaderboard = Leaderboard()
+
+
+def record(events):
+    # events is a list of (post id, weight, key): the weight of new likes and
+    # comments, negative for removals, and the key applying it only once (see
+    # api/idempotency.py), or None
+    now = time.time()
+    shards = defaultdict(list)
+    for post_id, weight, key in events:
+        if weight:
+            shards[sharding.for_post(post_id)].append((post_id, weight, key))
+    for alias, shard_events in shards.items():
+        scores = idempotency.apply_once(shard_events, lambda events: _record(events, now, alias), alias)
+        for post_id, score in scores.items():
+            leaderboard.update(post_id, score, current_epoch(now))
+
+
+def _record(events, now, using):
+    weights = defaultdict(float)
+    for post_id, weight, _ in events:
+        weights[post_id] += weight
+    post_ids = [post_id for post_id, weight in weights.items() if weight]
+    scores = {}
+    for start in range(0, len(post_ids), RECORD_BATCH_SIZE):
+        scores.update(_add({post_id: weights[post_id] for post_id in post_ids[start:start + RECORD_BATCH_SIZE]}, now, using))
+    return scores
+
+
+def top(n):
+    # The n trending posts, best first, as a list of (post, score)
+    ranking = leaderboard.top(n, time.time())
+    posts = {}
+    for alias, post_ids in sharding.group_by_shard(post_id for post_id, _ in ranking).items():
+        posts.update(sharding.with_authors(sharding.using(Post.objects, alias), alias).in_bulk(post_ids))
+    return [(posts[post_id], round(score, 6)) for post_id, score in ranking if post_id in posts]
+
+
+@receiver(post_delete, sender=Post)
+def remove_deleted_post(sender, instance, **kwargs):
+    # The row itself goes with the post through the foreign key's cascade
+    leaderboard.remove(instance.id)
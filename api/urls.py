@@ -1,16 +1,28 @@
 from django.urls import path
-from .views import index, authenticate_user, user_profile,follow_user, unfollow_user,\
-    create_post,delete_post,like_post,unlike_post,add_comment,all_posts
+from .views import index, authenticate_user, refresh_token, user_profile,follow_user, unfollow_user,user_relationships,\
+    create_post,delete_post,like_post,unlike_post,add_comment,all_posts,export_posts,post_comments,search_posts,trending_posts,suggested_users,home_feed,notifications_list,\
+    batch_actions,request_metrics
 urlpatterns = [
     path('index/',index),
     path('authenticate/', authenticate_user, name='authenticate_user'),
+    path('token/refresh/', refresh_token, name='refresh_token'),
     path('user/', user_profile, name='user'),
     path('follow/<int:id>', follow_user, name='follow_user'),
     path('unfollow/<int:id>', unfollow_user, name='unfollow_user'),
+    path('relationships/', user_relationships, name='user_relationships'),
     path('posts/', create_post, name='create_post'),
     path('posts/<int:id>', delete_post, name='delete_post'),
+    path('posts/<int:id>/comments', post_comments, name='post_comments'),
     path('like/<int:id>', like_post, name='like_post'),
     path('unlike/<int:id>', unlike_post, name='unlike_post'),
     path('comment/<int:id>', add_comment, name='add_comment'),
-    path('all_posts/', all_posts, name='all_posts')
+    path('all_posts/', all_posts, name='all_posts'),
+    path('export/', export_posts, name='export_posts'),
+    path('search/', search_posts, name='search_posts'),
+    path('trending/', trending_posts, name='trending_posts'),
+    path('suggestions/', suggested_users, name='suggested_users'),
+    path('feed/', home_feed, name='home_feed'),
+    path('notifications/', notifications_list, name='notifications'),
+    path('batch/', batch_actions, name='batch_actions'),
+    path('metrics/', request_metrics, name='request_metrics'),
 ]
\ No newline at end of file
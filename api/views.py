@@ -1,13 +1,24 @@
-from django.shortcuts import render, get_object_or_404
-from django.db.models import Count
-from django.http import JsonResponse
-import jwt
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponse, StreamingHttpResponse
+from collections import Counter
+import hmac
 import json
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.contrib.auth import authenticate
 
-from .models import User,Post,Comment
+from .models import User,Post,Comment,Notification
+from .serializers import prefetch_posts, serialize_post, serialize_comment, serialize_feed_post, serialize_relationship, serialize_notification
+from .pagination import InvalidPage, get_page_size, keyset_paginate
+from .auth import TokenError, get_user, jwt_required, issue_tokens, refresh_user
+from .renderers import JsonResponse, render
+from .metrics import registry
+from . import batch, cache, export, feed, login, notifications, relations, search, sharding, suggestions, tasks, throttling, trending
+
+# Error messages used by the endpoints that answer 401 with a specific reason
+BEARER_ERRORS = {'missing': 'Unauthorized', 'expired': 'Token has expired', 'invalid': 'Invalid token'}
 
 @csrf_exempt
 @require_http_methods(['POST'])
@@ -17,104 +28,109 @@ def authenticate_user(request):
     password = data.get('password')
     if username is None or password is None:
         return JsonResponse({'error': 'Please provide both username and password'}, status=400)
-    user = authenticate(username=username, password=password)
+    try:
+        user = login.authenticate(username, password)
+    except login.LoginBusy:
+        return _login_busy()
     if user is None:
         return JsonResponse({'error': 'Invalid email or password'}, status=401)
-    token = jwt.encode({'user_id':user.id, 'username': username}, 'secret_key', algorithm='HS256')
-    return JsonResponse({'token': token})
+    return JsonResponse(issue_tokens(user))
+
+def _login_busy():
+    response = JsonResponse({'error': 'Too many logins in progress, please retry'}, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def refresh_token(request):
+    # Exchange a refresh token for a new access token and refresh token
+    try:
+        token = json.loads(request.body).get('refresh')
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(token, str):
+        return JsonResponse({'error': 'Please provide a refresh token'}, status=400)
+    try:
+        user = refresh_user(token)
+    except TokenError as e:
+        return JsonResponse({'error': 'Refresh token has expired' if e.reason == 'expired' else 'Invalid refresh token'}, status=401)
+    return JsonResponse(issue_tokens(user))
 
 @csrf_exempt
 @require_http_methods(['GET'])
+@jwt_required(load_user=False)
 def user_profile(request):
-    
+    # Read the user row directly so the counters are always current
     try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-    user_id = decoded_token['user_id']
-    user = User.objects.get(id=user_id)
-    followers_count = user.followers.count()
-    following_count = user.following.count()
+        user = User.objects.get(id=request.api_user_id)
+    except User.DoesNotExist:
+        return JsonResponse({'error': 'User does not exist'}, status=404)
     return JsonResponse({
         'username': user.username,
-        'followers_count': followers_count,
-        'following_count': following_count
+        'followers_count': user.followers_count,
+        'following_count': user.following_count
     })
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@throttling.throttle('follow')
+@jwt_required(load_user=False)
 def follow_user(request, id):
-    # Retrieve the JWT token from the request headers
-   
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-    user_id = decoded_token['user_id']
-
-
-    try:
-        follower = User.objects.get(id=user_id)
-        following = User.objects.get(id=id)
-    except:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
-    if follower == None or following == None:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
-    # Check if the follower is already following the user
-    if follower.following.filter(id=id).exists():
+    # Follow the user and update both counters; nothing is written if the
+    # follower is already following the user
+    following = relations.follow(request.api_user_id, id)
+    if following is None:
+        # Either user may be missing: the follower's token can outlive them
+        if User.objects.filter(id__in=[id, request.api_user_id]).count() < len({id, request.api_user_id}):
+            return JsonResponse({'error': 'User does not exist'}, status=404)
         return JsonResponse({'error': 'Already following this user'}, status=400)
 
-    # Follow the user and save the follower object
-    follower.following.add(following)
-    follower.save()
+    # Copy the followed user's recent posts into the follower's timeline
+    tasks.enqueue('backfill', request.api_user_id, [following.id])
+    suggestions.follow(request.api_user_id, [following.id])
+    tasks.enqueue('notify', Notification.FOLLOW, following.id, request.api_user_id, 0)
 
     return JsonResponse({'success': f'You are now following {following.username}!'})
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@throttling.throttle('follow')
+@jwt_required(load_user=False)
 def unfollow_user(request, id):
-    # Retrieve the JWT token from the request headers
-   
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-    user_id = decoded_token['user_id']
-
-    # Retrieve the user who is unfollowing and the user who is being unfollowed
-    unfollower = User.objects.get(id=user_id)
-    unfollowing = User.objects.get(id=id)
-
-    # Check if the unfollower is not following the user
-    if not unfollower.following.filter(id=id).exists():
+    # Unfollow the user and update both counters
+    unfollowing = relations.unfollow(request.api_user_id, id)
+    if unfollowing is None:
+        if not User.objects.filter(id=id).exists():
+            return JsonResponse({'error': 'User does not exist'}, status=404)
         return JsonResponse({'error': 'You are not following this user'}, status=400)
-
-    # Unfollow the user and save the unfollower object
-    unfollower.following.remove(unfollowing)
-    unfollower.save()
+    feed.remove_author(request.api_user_id, unfollowing.id)
+    suggestions.unfollow(request.api_user_id, unfollowing.id)
 
     return JsonResponse({'success': f'You have unfollowed {unfollowing.username}!'})
 
+
 @csrf_exempt
 @require_http_methods(['POST'])
-def create_post(request):
-    # Retrieve the JWT token from the request headers
-    
+@jwt_required(load_user=False)
+def user_relationships(request):
+    # Follow state between the user and each of up to RELATIONSHIPS_MAX_IDS users
     try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-    user_id = decoded_token['user_id']
+        ids = relations.parse_ids(json.loads(request.body), settings.RELATIONSHIPS_MAX_IDS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e) if isinstance(e, relations.RelationshipsError) else 'Invalid JSON'}, status=400)
 
-    # Retrieve the authenticated user
-    try:
-        author = User.objects.get(id=user_id)
-    except:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
+    users = {user.id: user for user in relations.relationships(request.api_user_id, ids)}
+    return JsonResponse({
+        'relationships': [serialize_relationship(users[id]) for id in ids if id in users],
+        'not_found': [id for id in ids if id not in users],
+    })
+
+@csrf_exempt
+@require_http_methods(['POST'])
+@jwt_required()
+def create_post(request):
+    author = request.api_user
 
     # Retrieve the post data from the request body
     data = json.loads(request.body)
@@ -122,8 +138,12 @@ def create_post(request):
     content = data.get('description')
     if title is None or content is None:
         return JsonResponse({'error': 'Please provide both title and description'}, status=400)
-    # Create the post and save it
-    post = Post.objects.create(title=title, content=content, author=author)
+    # Create the post and save it on its author's shard
+    post = Post(title=title, content=content, author=author)
+    sharding.save_new(post, sharding.for_user(author.id))
+
+    # Push the post into the followers' timelines and the search index
+    tasks.enqueue('fan_out_post', post.id, key=f'fan_out_post:{post.id}')
 
     # Return the post data
     response_data = {
@@ -136,66 +156,69 @@ def create_post(request):
 @csrf_exempt
 @require_http_methods(['DELETE','GET'])
 def delete_post(request, id):
-    # Retrieve the JWT token from the request headers
     if request.method == 'GET':
-        
-        post = get_object_or_404(Post, id=id)
-        data = {
+        # Serve the post from the response cache, revalidating with the ETag
+        body, etag = cache.get_post_response(id, lambda: _post_detail(id))
+        return cache.conditional_response(request, body, etag)
+    return _delete_post(request, id)
+
+def _post_detail(id):
+    alias = sharding.for_post(id)
+    post = get_object_or_404(sharding.with_authors(sharding.using(Post.objects, alias), alias), id=id)
+    if alias == 'default':
+        comments = list(post.comments.values('id', 'author__username', 'content', 'created_at'))
+    else:
+        # The authors are on 'default', so they cannot be joined in
+        comments = [
+            {'id': comment.id, 'author__username': comment.author.username, 'content': comment.content, 'created_at': comment.created_at}
+            for comment in sharding.with_authors(post.comments.only('id', 'author', 'content', 'created_at'), alias)
+        ]
+    data = {
         'id': post.id,
         'title': post.title,
         'content': post.content,
         'author': post.author.username,
         'created_at': post.created_at,
         'updated_at': post.updated_at,
-        'likes_count': post.likes.count(),
-        'comments': list(post.comments.annotate(like_count=Count('likes')).values('id', 'author__username', 'content', 'created_at', 'like_count')),
+        'likes_count': post.likes_count,
+        'comments_count': post.comments_count,
+        'comments': comments,
     }
-        return JsonResponse(data)
-
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-
-    user_id = decoded_token['user_id']
+    return render(data)
 
+@jwt_required(load_user=False)
+def _delete_post(request, id):
     # Retrieve the post and check if the authenticated user is the author
     try:
-        post = Post.objects.get(id=id)
+        post = sharding.using(Post.objects, sharding.for_post(id)).get(id=id)
     except Post.DoesNotExist:
         return JsonResponse({'error': 'Post does not exist'}, status=404)
 
-    if post.author.id != user_id:
+    if post.author_id != request.api_user_id:
         return JsonResponse({'error': 'You are not authorized to delete this post'}, status=403)
 
     # Delete the post and return a success message
     post.delete()
+    cache.invalidate_post(id)
     return JsonResponse({'success': 'Post deleted successfully'})
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@throttling.throttle('like')
+@jwt_required()
 def like_post(request, id):
-    # Retrieve the JWT token from the request headers
-    
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=400)
-    user_id = decoded_token['user_id']
-
-    # Retrieve the post to be liked and the user liking the post
-    post = Post.objects.get(id=id)
-    user = User.objects.get(id=user_id)
-
-    # Check if the user has already liked the post
-    if post.likes.filter(id=user_id).exists():
+    user = request.api_user
+
+    # Like the post and update the counter; nothing is written if the user
+    # has already liked the post
+    post = relations.like(id, user.id)
+    if post is None:
+        if not sharding.using(Post.objects, sharding.for_post(id)).filter(id=id).exists():
+            return JsonResponse({'error': 'Post does not exist'}, status=404)
         return JsonResponse({'error': 'Already liked this post'}, status=400)
-
-    # Like the post and save the user object
-    post.likes.add(user)
-    post.save()
+    cache.invalidate_post(id)
+    tasks.enqueue('trending', id, settings.TRENDING_LIKE_WEIGHT)
+    tasks.enqueue('notify', Notification.LIKE, post.author_id, user.id, id)
 
     return JsonResponse({
         'post_id': post.id,
@@ -206,92 +229,208 @@ def like_post(request, id):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@throttling.throttle('like')
+@jwt_required(status=401, load_user=False)
 def unlike_post(request, id):
-    # Retrieve the JWT token from the request headers
-    
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=401)
-    user_id = decoded_token['user_id']
-
-    # Retrieve the post and user objects
-    post = Post.objects.get(id=id)
-    user = User.objects.get(id=user_id)
-
-    # Check if the user has already liked the post
-    if not post.likes.filter(id=user_id).exists():
-        return JsonResponse({'error': 'You have not liked this post yet'}, status=400)
-
     # Remove the user from the list of users who liked the post
-    post.likes.remove(user)
+    if relations.unlike(id, request.api_user_id) is None:
+        if not sharding.using(Post.objects, sharding.for_post(id)).filter(id=id).exists():
+            return JsonResponse({'error': 'Post does not exist'}, status=404)
+        return JsonResponse({'error': 'You have not liked this post yet'}, status=400)
+    cache.invalidate_post(id)
+    tasks.enqueue('trending', id, -settings.TRENDING_LIKE_WEIGHT)
 
     return JsonResponse({'success': 'Post unliked successfully'})
 @csrf_exempt
 @require_http_methods(['POST'])
+@jwt_required(status=401)
 def add_comment(request, id):
-    # Retrieve the JWT token from the request headers
-    
-    try:
-        token = request.headers.get('Authorization').split(' ')[1]
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-    except:
-        return JsonResponse({'error': 'Please provide a valid token'}, status=401)
-    user_id = decoded_token['user_id']
-
-    # Retrieve the post and authenticated user
-    post = Post.objects.get(id=id)
-    user = User.objects.get(id=user_id)
-
     # Retrieve comment from the request body
     comment_content = request.POST.get('comment')
-    if len(comment_content) == 0 or comment_content.isspace():
+    if not comment_content or comment_content.isspace():
         return JsonResponse({'error': 'Please provide a comment'}, status=400)
 
+    # Retrieve the post's author
+    alias = sharding.for_post(id)
+    author_id = sharding.using(Post.objects, alias).filter(id=id).values_list('author_id', flat=True).first()
+    if author_id is None:
+        return JsonResponse({'error': 'Post does not exist'}, status=404)
+
     # Create the comment and save it to the database
-    comment = Comment(post=post, author=user, content=comment_content)
-    comment.save()
+    comment = Comment(post_id=id, author_id=request.api_user_id, content=comment_content)
+    with transaction.atomic(using=alias):
+        sharding.save_new(comment, alias)
+        sharding.using(Post.objects, alias).filter(id=id).update(comments_count=F('comments_count') + 1)
+    cache.invalidate_post(id)
+    tasks.enqueue('index_comments', id, comment_content, key=f'comment:{comment.id}')
+    tasks.enqueue('trending', id, settings.TRENDING_COMMENT_WEIGHT)
+    tasks.enqueue('notify', Notification.COMMENT, author_id, request.api_user_id, id)
 
     # Return the comment id in the response
     return JsonResponse({'comment_id': comment.id})
 
 @csrf_exempt
 @require_http_methods(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
 def all_posts(request):
-    # Get the JWT token from the request headers
-    
+    # Get a page of posts created by the authenticated user, sorted by post time
+    alias = sharding.for_user(request.api_user_id)
+    posts = prefetch_posts(sharding.using(Post.objects, alias).filter(author_id=request.api_user_id), alias)
     try:
-        token = request.headers.get('Authorization').split(' ')[1]
-    except:
-        return JsonResponse({'error': 'Unauthorized'}, status=401)
+        page, next_cursor = keyset_paginate(posts, request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    # Decode the JWT token to get the user ID
+    # Serialize the posts along with their comments and likes in a constant number of queries
+    serialized_posts = [serialize_post(post) for post in page]
+
+    return JsonResponse({'posts': serialized_posts, 'next_cursor': next_cursor},status=201)
+
+@csrf_exempt
+@require_http_methods(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+def export_posts(request):
+    # Stream every post of the authenticated user, with comments and likes, as
+    # newline-delimited JSON. ?after=<post id> resumes after a post already received.
     try:
-        decoded_token = jwt.decode(token, 'secret_key', algorithms=['HS256'])
-        user_id = decoded_token['user_id']
-    except jwt.ExpiredSignatureError:
-        return JsonResponse({'error': 'Token has expired'}, status=401)
-    except jwt.InvalidTokenError:
-        return JsonResponse({'error': 'Invalid token'}, status=401)
-
-    # Get all posts created by the authenticated user, sorted by post time
-    posts = Post.objects.filter(author_id=user_id).order_by('-created_at')
-
-    # Serialize the posts and their associated comments and likes
-    serialized_posts = []
-    for post in posts:
-        serialized_post = {
-            'id': post.id,
-            'title': post.title,
-            'description': post.content,
-            'created_at': post.created_at,
-            'comments': [{'id': comment.id, 'author': comment.author.username, 'content': comment.content, 'created_at': comment.created_at} for comment in post.comments.all()],
-            'likes': [{'id': user.id, 'username': user.username} for user in post.likes.all()],
-        }
-        serialized_posts.append(serialized_post)
-
-    return JsonResponse({'posts': serialized_posts},status=201)
+        position = export.get_start(request.api_user_id, request.GET.get('after'))
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(export.stream_posts(request.api_user_id, position), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="posts.ndjson"'
+    return response
+
+@csrf_exempt
+@require_http_methods(['GET'])
+def post_comments(request, id):
+    alias = sharding.for_post(id)
+    if not sharding.using(Post.objects, alias).filter(id=id).exists():
+        return JsonResponse({'error': 'Post does not exist'}, status=404)
+
+    # Get a page of the post's comments, oldest first
+    comments = sharding.with_authors(sharding.using(Comment.objects, alias).filter(post_id=id), alias)
+    try:
+        page, next_cursor = keyset_paginate(comments, request, descending=False)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'comments': [serialize_comment(comment) for comment in page], 'next_cursor': next_cursor})
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+def search_posts(request):
+    # Posts whose title, content or comments contain every word of ?q=, best match first
+    if not search.get_terms(request.GET.get('q', '')):
+        return JsonResponse({'error': 'Please provide a search query'}, status=400)
+    try:
+        page, next_cursor = search.search(request.GET['q'], request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except search.SearchUnavailable:
+        return JsonResponse({'error': 'Search is not available'}, status=501)
+
+    return JsonResponse({'posts': [serialize_feed_post(post) for post in page], 'next_cursor': next_cursor})
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+def trending_posts(request):
+    # The posts with the most likes and comments lately, best first, served
+    # from the in-memory ranking kept by api/trending.py
+    try:
+        limit = get_page_size(request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'posts': [{**serialize_feed_post(post), 'score': score} for post, score in trending.top(limit)]})
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+def suggested_users(request):
+    # Accounts followed by the most of the accounts the user follows
+    try:
+        limit = get_page_size(request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    ranking = suggestions.suggest(request.api_user_id, limit)
+    users = User.objects.in_bulk([user_id for user_id, _ in ranking])
+    return JsonResponse({'users': [
+        {'id': user_id, 'username': users[user_id].username, 'followers_count': users[user_id].followers_count, 'mutual_count': mutual}
+        for user_id, mutual in ranking if user_id in users
+    ]})
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+def home_feed(request):
+    # Get a page of posts from the accounts the user follows, newest first
+    try:
+        page, next_cursor = feed.read_feed(request.api_user_id, request)
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'posts': [serialize_feed_post(post) for post in page], 'next_cursor': next_cursor})
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+@jwt_required(status=401, errors=BEARER_ERRORS, load_user=False)
+def notifications_list(request):
+    # Get a page of the user's notifications, latest activity first. Likes,
+    # comments and follows were coalesced when written, so each entry may
+    # stand for many of them.
+    try:
+        page, next_cursor = keyset_paginate(notifications.stream(request.api_user_id), request, time_field='updated_at')
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'notifications': [serialize_notification(n) for n in page], 'next_cursor': next_cursor})
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+@throttling.throttle('batch')
+@jwt_required(load_user=False)
+def batch_actions(request):
+    # Apply a list of queued like, follow and comment actions in one request
+    try:
+        actions = batch.parse_actions(json.loads(request.body), settings.BATCH_MAX_ACTIONS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e) if isinstance(e, batch.BatchError) else 'Invalid JSON'}, status=400)
+
+    # Each like and follow costs what it would as a request of its own
+    counts = Counter(kind for kind, _, _ in actions)
+    for scope in ('like', 'follow'):
+        wait = throttling.check(request, scope, cost=counts[scope])
+        if wait:
+            return throttling.too_many_requests(wait)
+
+    # Loaded after the throttle checks, which cost no database work
+    if get_user(request.api_user_id) is None:
+        return JsonResponse({'error': 'User does not exist'}, status=404)
+
+    return JsonResponse({'results': batch.apply_actions(request.api_user_id, actions)})
+
+
+def _may_scrape(request):
+    if settings.DEBUG or request.META.get('REMOTE_ADDR') in settings.API_METRICS_ALLOWED_IPS:
+        return True
+    token = settings.API_METRICS_TOKEN
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@require_http_methods(['GET'])
+def request_metrics(request):
+    # Per-view latency and query histograms of this process, in Prometheus text
+    # format, for the scrapers allowed by the API_METRICS_* settings only
+    if not _may_scrape(request):
+        return JsonResponse({'error': 'Not found'}, status=404)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def index():
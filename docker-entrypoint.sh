@@ -0,0 +1,13 @@
+#!/bin/sh
+# Starts the API under gunicorn with the production settings profile.
+# SERVER=asgi serves the async views through uvicorn workers instead.
+set -e
+
+export DJANGO_SETTINGS_MODULE="${DJANGO_SETTINGS_MODULE:-reunion.settings_production}"
+
+if [ "${SERVER:-wsgi}" = "asgi" ]; then
+    # Connections are per request thread under ASGI; see settings_production.py
+    export DB_CONN_MAX_AGE="${DB_CONN_MAX_AGE:-0}"
+    exec gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker reunion.asgi:application
+fi
+exec gunicorn -c gunicorn.conf.py reunion.wsgi:application
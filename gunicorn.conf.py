@@ -0,0 +1,24 @@
+# Gunicorn configuration used by docker-entrypoint.sh. Every value can be
+# overridden from the environment.
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Preforked worker processes; the usual 2 x cores + 1 keeps the CPUs busy
+# while some workers wait on the database
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync' if threads == 1 else 'gthread')
+
+# Import the project once in the master so workers fork with it loaded
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+
+# Recycle workers now and then so a slow leak cannot grow unbounded
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
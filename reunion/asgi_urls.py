@@ -0,0 +1,13 @@
+"""URL configuration used by the ASGI application
+
+Same routes as reunion/urls.py, but the API is served by the async views.
+"""
+from django.conf import settings
+from django.contrib import admin
+from django.urls import include, path
+
+urlpatterns = [
+    path('api/', include('api.async_urls')),
+]
+if settings.ADMIN_ENABLED:
+    urlpatterns.insert(0, path("admin/", admin.site.urls))
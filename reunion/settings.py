@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'api.User'
 
 MIDDLEWARE = [
+    "api.middleware.RequestMetricsMiddleware",
+    "api.middleware.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -56,7 +58,8 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
-ROOT_URLCONF = "reunion.urls"
+# The ASGI entry point serves the async views (see reunion/asgi.py)
+ROOT_URLCONF = os.environ.get("DJANGO_ROOT_URLCONF", "reunion.urls")
 
 TEMPLATES = [
     {
@@ -91,6 +94,38 @@ DATABASES = {
     }
 }
 
+# Aliases in DATABASES holding read replicas of 'default'. Read-only requests
+# read from them; see api/routers.py
+DATABASE_REPLICAS = []
+
+# Aliases in DATABASES that posts, comments and likes are spread over by author;
+# see api/sharding.py. Change it only by running manage.py reshard, which moves
+# the rows to where the new list puts them.
+SHARDS = ['default']
+
+DATABASE_ROUTERS = ['api.routers.ReplicaRouter', 'api.routers.ShardRouter']
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Each process keeps its own local-memory cache unless REDIS_URL points the
+# workers at a shared Redis instance (requires the redis package)
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'reunion',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -109,6 +144,55 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing
+# https://docs.djangoproject.com/en/4.1/topics/auth/passwords/
+# New passwords are hashed with the hasher named by PASSWORD_HASHER (scrypt,
+# argon2 or pbkdf2; argon2 requires the argon2-cffi package). Hashes made by
+# the others still verify and are redone with it on the user's next login.
+
+API_PASSWORD_HASHERS = {
+    'scrypt': 'api.hashers.ScryptPasswordHasher',
+    'argon2': 'api.hashers.Argon2PasswordHasher',
+    'pbkdf2': 'api.hashers.PBKDF2PasswordHasher',
+}
+PASSWORD_HASHER = os.environ.get('PASSWORD_HASHER', 'scrypt')
+PASSWORD_HASHERS = list(dict.fromkeys([
+    API_PASSWORD_HASHERS[PASSWORD_HASHER],
+    *API_PASSWORD_HASHERS.values(),
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]))
+
+# Cost of each hasher. Raising one rehashes its users' passwords as they log in
+PASSWORD_SCRYPT_WORK_FACTOR = 2 ** 14
+PASSWORD_SCRYPT_BLOCK_SIZE = 8
+PASSWORD_SCRYPT_PARALLELISM = 1
+PASSWORD_ARGON2_TIME_COST = 2
+PASSWORD_ARGON2_MEMORY_COST = 102400
+PASSWORD_ARGON2_PARALLELISM = 8
+PASSWORD_PBKDF2_ITERATIONS = 600000
+
+
+# Logging
+# https://docs.djangoproject.com/en/4.1/topics/logging/
+# The api.metrics logger writes one JSON line per request at INFO, and a
+# WARNING for requests that repeat the same query; with DEBUG on only the
+# warnings are shown unless API_METRICS_LOG_LEVEL says otherwise
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.metrics': {
+            'handlers': ['console'],
+            'level': os.environ.get('API_METRICS_LOG_LEVEL', 'WARNING' if DEBUG else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
@@ -131,3 +215,150 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# API
+
+# Serve the Django admin. reunion/settings_production.py turns it off, along
+# with the middleware it depends on, unless DJANGO_ADMIN_ENABLED=1
+ADMIN_ENABLED = True
+
+# Signing key and algorithm of the bearer tokens issued by the authenticate endpoint
+JWT_SECRET = os.environ.get('JWT_SECRET', 'secret_key')
+JWT_ALGORITHM = 'HS256'
+
+# Seconds an access token is valid for, and a refresh token exchanged for new
+# ones at the token refresh endpoint
+JWT_ACCESS_TOKEN_LIFETIME = 60 * 60
+JWT_REFRESH_TOKEN_LIFETIME = 30 * 24 * 60 * 60
+
+# Number of verified tokens and user rows each process keeps in memory, and how
+# long (in seconds) a cached user row may be served before it is read again
+JWT_TOKEN_CACHE_SIZE = 10000
+JWT_USER_CACHE_SIZE = 10000
+JWT_USER_CACHE_TTL = 30
+
+# Dotted path of the class that encodes API responses. None uses
+# api.renderers.ORJSONRenderer when orjson is installed and
+# api.renderers.StdlibRenderer otherwise
+API_RENDERER = None
+
+# Let the renderer encode datetimes in its own format (orjson keeps the
+# microseconds) instead of the millisecond precision of DjangoJSONEncoder
+API_JSON_NATIVE_DATETIMES = False
+
+# Number of threads computing password hashes for logins, and how many more
+# logins may wait for one before further logins are answered 503
+PASSWORD_HASH_WORKERS = os.cpu_count() or 1
+PASSWORD_HASH_QUEUE = 16
+
+# How long (in seconds) a successful login is remembered so that logging in
+# again with the same credentials skips the password hash, and for how many
+# credentials each process remembers it
+LOGIN_CACHE_TTL = 300
+LOGIN_CACHE_SIZE = 10000
+
+# Default and maximum number of items returned per page by paginated endpoints
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+# Number of posts read (and whose comments and likes are prefetched) per
+# round trip while streaming an export
+EXPORT_CHUNK_SIZE = 500
+
+# Accounts with more followers than this are not fanned out on write; their
+# posts are merged into followers' feeds when the feed is read
+FEED_FANOUT_THRESHOLD = 10000
+
+# Number of recent posts copied into a timeline when a new account is followed
+FEED_BACKFILL_SIZE = 50
+
+# Maximum number of actions accepted by a single batch request
+BATCH_MAX_ACTIONS = 500
+
+# Cache alias holding rendered post detail responses, how long (in seconds) they
+# are kept, and how long concurrent misses wait for the request rebuilding one
+POST_CACHE_ALIAS = 'default'
+POST_CACHE_TIMEOUT = 300
+POST_CACHE_LOCK_TIMEOUT = 2
+
+# Number of slowest statements included in each request log line, and how many
+# times one statement may run in a request before it is reported as an N+1
+API_METRICS_SLOW_QUERIES = 3
+API_METRICS_DUPLICATE_THRESHOLD = 5
+
+# The Prometheus endpoint at /api/metrics/ answers 404 unless DEBUG is on, the
+# client address is one of API_METRICS_ALLOWED_IPS, or the request carries
+# "Authorization: Bearer <API_METRICS_TOKEN>"
+API_METRICS_TOKEN = os.environ.get('API_METRICS_TOKEN')
+API_METRICS_ALLOWED_IPS = [ip for ip in os.environ.get('API_METRICS_ALLOWED_IPS', '').split(',') if ip]
+
+# Trending posts: every like and comment adds its weight to the post's score,
+# and the weight halves every TRENDING_HALF_LIFE seconds. Scores are kept for
+# one to two TRENDING_WINDOW lengths after the post's last like or comment.
+TRENDING_LIKE_WEIGHT = 1.0
+TRENDING_COMMENT_WEIGHT = 2.0
+TRENDING_HALF_LIFE = 6 * 60 * 60
+TRENDING_WINDOW = 24 * 60 * 60
+
+# Number of trending posts each process keeps in memory, and how often (in
+# seconds) it reloads them to pick up likes and comments made by other processes
+TRENDING_SIZE = 1000
+TRENDING_REFRESH = 10
+
+# Follow suggestions: how many each user's cached ranking holds and for how
+# long (in seconds), how many users' rankings each process keeps, and after how
+# many seconds a process reloads its in-memory copy of the follow graph
+SUGGESTIONS_SIZE = 100
+SUGGESTIONS_CACHE_TTL = 300
+SUGGESTIONS_CACHE_SIZE = 10000
+SUGGESTIONS_GRAPH_MAX_AGE = 600
+
+# Maximum number of users whose follow state a single relationships request can look up
+RELATIONSHIPS_MAX_IDS = 500
+
+# Throttling of the write endpoints: per scope, the (requests, seconds) token
+# bucket of each user and of each client IP. Scopes left out are not throttled.
+# The buckets live in each process unless REDIS_URL gives the workers a shared
+# cache, which THROTTLE_CACHE_ALIAS then names.
+THROTTLE_RATES = {
+    'like': {'user': (120, 60), 'ip': (600, 60)},
+    'follow': {'user': (60, 60), 'ip': (300, 60)},
+    'batch': {'user': (20, 60), 'ip': (100, 60)},
+}
+THROTTLE_BACKEND = 'api.throttling.CacheBackend' if os.environ.get('REDIS_URL') else 'api.throttling.LocalBackend'
+THROTTLE_CACHE_ALIAS = 'default'
+
+# Read replicas: how long (in seconds) a user who wrote keeps reading from the
+# primary, and the cache alias remembering that; how often each process checks
+# a replica, and how far (in seconds) a Postgres replica may lag before reads
+# go to the primary instead
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_CACHE_ALIAS = 'default'
+REPLICA_HEALTH_INTERVAL = 5
+REPLICA_MAX_LAG = 2
+
+# Deferred work of the write endpoints (see api/tasks.py): run inline by
+# api.tasks.ImmediateBackend, on TASK_WORKERS threads per process by
+# api.tasks.LocalBackend, or by manage.py run_tasks workers with
+# api.tasks.DatabaseBackend
+TASK_BACKEND = os.environ.get('TASK_BACKEND', 'api.tasks.ImmediateBackend')
+TASK_WORKERS = 2
+
+# Jobs a worker takes at a time; attempts per job, and the delay (in seconds)
+# before the first retry, doubled on each later one; how long (in seconds) a
+# database worker holds a job before another may run it
+TASK_BATCH_SIZE = 100
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_DELAY = 1
+TASK_LEASE_SECONDS = 60
+
+# How long (in seconds) a job's idempotency key blocks another job with the
+# same key, and how many keys each process remembers for the local backend
+TASK_KEY_TTL = 60 * 60
+TASK_KEY_CACHE_SIZE = 10000
+
+# Likes, comments and follows about the same post (or the same user, for
+# follows) within one NOTIFICATION_WINDOW (in seconds) are coalesced into a
+# single notification
+NOTIFICATION_WINDOW = 6 * 60 * 60
@@ -0,0 +1,58 @@
+"""
+Settings for running the project on a workstation.
+
+Uses a SQLite database next to manage.py, or a local Postgres server when
+POSTGRES_DB is set, e.g. for `manage.py benchmark`:
+
+    DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py migrate
+    DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py benchmark endpoints
+
+DJANGO_LOCAL_REPLICAS=<n> adds n read replica aliases, replica1 to replica<n>,
+that connect to the same database. They stand in for real replicas to try out
+the read routing of api/routers.py.
+
+Two more databases, shard1 and shard2 (db_shard1.sqlite3 and db_shard2.sqlite3,
+or <POSTGRES_DB>_shard1 and _shard2), are always configured; the sharding
+tests use them. DJANGO_LOCAL_SHARDS=2 or 3 spreads posts over the first two or
+all three databases, after moving them there with manage.py reshard:
+
+    DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py migrate --database shard1
+    DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py migrate --database shard2
+    DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py reshard default shard1 shard2
+    DJANGO_LOCAL_SHARDS=3 DJANGO_SETTINGS_MODULE=reunion.settings_local python manage.py runserver
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR
+
+if os.environ.get('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', ''),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
+for i in range(1, int(os.environ.get('DJANGO_LOCAL_REPLICAS', 0)) + 1):
+    DATABASES[f'replica{i}'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica')]
+
+for i in (1, 2):
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES[f'shard{i}'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / f'db_shard{i}.sqlite3'}
+    else:
+        DATABASES[f'shard{i}'] = {**DATABASES['default'], 'NAME': f"{DATABASES['default']['NAME']}_shard{i}"}
+SHARDS = ['default', 'shard1', 'shard2'][:int(os.environ.get('DJANGO_LOCAL_SHARDS', 1))]
@@ -0,0 +1,83 @@
+"""
+Settings for serving the API in production.
+
+    DJANGO_SETTINGS_MODULE=reunion.settings_production gunicorn -c gunicorn.conf.py reunion.wsgi:application
+
+or run ./docker-entrypoint.sh, which does the same. Compared to reunion/settings.py:
+
+- DEBUG is off, so executed queries are no longer buffered per request
+- database connections are kept open between requests and health-checked
+  before reuse
+- the session, CSRF, auth and messages middleware (and the admin, which needs
+  them) are left out unless ADMIN_ENABLED is set; the API authenticates with
+  bearer tokens and does not use them
+
+Database credentials come from the same POSTGRES_* variables as
+reunion/settings_local.py, falling back to the ones in reunion/settings.py.
+POSTGRES_REPLICA_HOSTS lists the hosts of read replicas, separated by commas,
+which are reached with the same database name and credentials.
+POSTGRES_SHARD_HOSTS likewise lists the hosts of the shards that posts are
+spread over besides the primary (see api/sharding.py); set it only after
+moving the posts there with manage.py reshard.
+
+The deferred work of the write endpoints runs on background threads of each
+worker process after the response (api.tasks.LocalBackend). Setting
+TASK_BACKEND=api.tasks.DatabaseBackend queues it in the database instead, for
+manage.py run_tasks processes to run.
+"""
+
+import copy
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import ALLOWED_HOSTS, DATABASES, INSTALLED_APPS, LOGGING, MIDDLEWARE, SECRET_KEY
+
+DEBUG = os.environ.get('DJANGO_DEBUG') == '1'
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+
+if os.environ.get('DJANGO_ALLOWED_HOSTS'):
+    ALLOWED_HOSTS = os.environ['DJANGO_ALLOWED_HOSTS'].split(',')
+
+default = DATABASES['default']
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', default['NAME']),
+        'USER': os.environ.get('POSTGRES_USER', default['USER']),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', default['PASSWORD']),
+        'HOST': os.environ.get('POSTGRES_HOST', default['HOST']),
+        'PORT': os.environ.get('POSTGRES_PORT', default['PORT']),
+        # Seconds a connection is reused for. Set DB_CONN_MAX_AGE=0 under ASGI,
+        # where every request runs on a new thread with its own connection, and
+        # pool with PgBouncer instead.
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+for i, host in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{i}'] = {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica')]
+for i, host in enumerate(filter(None, os.environ.get('POSTGRES_SHARD_HOSTS', '').split(',')), 1):
+    DATABASES[f'shard{i}'] = {**DATABASES['default'], 'HOST': host}
+SHARDS = ['default', *(alias for alias in DATABASES if alias.startswith('shard'))]
+del default
+
+TASK_BACKEND = os.environ.get('TASK_BACKEND', 'api.tasks.LocalBackend')
+
+ADMIN_ENABLED = os.environ.get('DJANGO_ADMIN_ENABLED') == '1'
+
+if not ADMIN_ENABLED:
+    INSTALLED_APPS = [
+        app for app in INSTALLED_APPS
+        if app not in ('django.contrib.admin', 'django.contrib.sessions', 'django.contrib.messages')
+    ]
+    MIDDLEWARE = [
+        "api.middleware.RequestMetricsMiddleware",
+        "api.middleware.ReplicaRoutingMiddleware",
+        "django.middleware.security.SecurityMiddleware",
+        "django.middleware.common.CommonMiddleware",
+    ]
+
+LOGGING = copy.deepcopy(LOGGING)
+LOGGING['loggers']['api.metrics']['level'] = os.environ.get('API_METRICS_LOG_LEVEL', 'WARNING' if DEBUG else 'INFO')